@@ -0,0 +1,64 @@
+# vim:ts=4:sw=4:expandtab
+"""Helpers shared by the benchmarks"""
+
+import os
+import sys
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def rss():
+    """Returns the resident set size of this process in bytes."""
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    raise RuntimeError('measuring memory requires psutil on this platform')
+
+def trim_heap():
+    """Hands the memory the C allocator keeps after frees back to the OS
+    where it can be told to (glibc malloc_trim()). Returns True if it could.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        trim = libc.malloc_trim
+    except (OSError, AttributeError, TypeError):
+        return False
+    trim(0)
+    return True
+
+def deep_sizeof(obj):
+    """Returns the size of obj and all containers/values reachable from it.
+    Arrays are accounted by their buffer; objects are counted once.
+    """
+    seen = set()
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.iterkeys())
+            pending.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            pending.append(vars(obj))
+    return size
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    if psutil is not None and hasattr(psutil.Process(), 'memory_full_info') \
+            and sys.platform == 'win32':
+        return psutil.Process(os.getpid()).memory_info().peak_wset
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac os
+    return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,86 @@
+# vim:ts=4:sw=4:expandtab
+"""Diff engine benchmark.
+
+Diffs two snapshots of a synthetic series (see synthlog) with
+Backtrace.diff_with() - the sorted column engine of pyumdh.heapdiff - and
+with the per-trace frozenset comparison it replaced, checks that both agree
+and reports the speedup. Snapshots are diffed as parsed (dict heaps) and as
+loaded from binary snapshots.
+
+    python diff_engine.py 1M [datadir]
+"""
+
+import os
+import sys
+import tempfile
+from timeit import default_timer
+import stubsymbols
+import synthlog
+
+
+def _reference_diff(old, new):
+    """diff_with() as it was: a frozenset of samples per common trace"""
+    from pyumdh.backtrace import Backtrace
+    diff = Backtrace(stacks=new._stacks)
+    diff._modules = new._modules
+    for handle, heap in old._heaps.iteritems():
+        otherheap = new._heaps.get(handle)
+        if otherheap:
+            otherheapset = frozenset(otherheap.iterkeys())
+            difftraces = otherheapset.difference(heap.iterkeys())
+            diffallocs = {t: diff._intern(otherheap[t]) for t in difftraces}
+            if not diffallocs:
+                continue
+            diffheap = diff._heaps.setdefault(handle, diffallocs)
+            diff._allocs.update(diffallocs)
+            for trace in otherheapset.intersection(heap):
+                alloc = otherheap.get(trace)
+                adiff = list(frozenset(alloc.allocs) - \
+                                frozenset(heap.get(trace).allocs))
+                if adiff:
+                    diffalloc = Backtrace.allocation( \
+                                    stack=diff._stacks.stack(alloc.stack), \
+                                    aliases=[], allocs=adiff)
+                    diffheap.setdefault(trace, diffalloc)
+                    diff._allocs.update({trace: diffalloc})
+    return diff
+
+def _allocs(diff):
+    return dict((handle, dict((t, frozenset(alloc.allocs)) for t, alloc in \
+                    heap.iteritems())) for handle, heap in \
+                    diff._heaps.iteritems())
+
+def _time(fn):
+    start = default_timer()
+    result = fn()
+    return (default_timer() - start, result)
+
+
+if __name__ == '__main__':
+    if not sys.argv[1:]:
+        print 'Syntax: diff_engine[.py] allocations [datadir]'
+        sys.exit(1)
+    stubsymbols.install()
+    from pyumdh.backtrace import Backtrace
+    import pyumdh.heapdiff as heapdiff
+    allocations = synthlog.parse_count(sys.argv[1])
+    datadir = sys.argv[2] if sys.argv[2:] else tempfile.mkdtemp()
+    logs = [synthlog.snapshot_path(datadir, i) for i in xrange(2)]
+    if not all(os.path.exists(log) for log in logs):
+        logs = synthlog.generate_series(datadir, allocations)
+    traces = [Backtrace(log, fast=True) for log in logs]
+    print 'engine: %s' % ('numpy' if heapdiff.numpy is not None else 'python')
+    for name in ('parsed', 'loaded'):
+        if name == 'loaded':
+            for i, trace in enumerate(traces):
+                trace.save(logs[i] + '.bin')
+                traces[i] = Backtrace()
+                traces[i].load(logs[i] + '.bin')
+        old, new = traces
+        elapsed, diff = _time(lambda: old.diff_with(new))
+        reference, expected = _time(lambda: _reference_diff(old, new))
+        if _allocs(diff) != _allocs(expected):
+            print 'diff_with output differs from the reference!'
+            sys.exit(2)
+        print '%-7s diff_with %7.2fs, per-trace sets %7.2fs: %5.1fx' % \
+                (name, elapsed, reference, reference / max(elapsed, 1e-9))
@@ -0,0 +1,93 @@
+# vim:ts=4:sw=4:expandtab
+"""Duplicate compression benchmark.
+
+Clusters the traces of the largest heap of a synthetic snapshot (see
+synthlog) with duplicates.similar_clusters() - MinHash signatures and LSH
+bands - and compares it to what compress_duplicates() did before: a
+SequenceMatcher.quick_ratio() > 0.88 check of every pair of traces.
+
+As that is quadratic, the reference runs on the first |sample| traces only
+and reports
+
+    recall      share of the pairs the reference finds similar that end up
+                in the same cluster
+    clusters    number of clusters of either (similar pairs merged
+                transitively)
+
+the time of both on the sample and of similar_clusters() on the whole heap.
+
+    python duplicates.py 100k [sample] [datadir]
+"""
+
+import difflib
+import os
+import sys
+import tempfile
+from itertools import combinations
+from timeit import default_timer
+import stubsymbols
+import synthlog
+
+
+def _reference_pairs(traces, threshold):
+    """Pairs of trace ids whose stacks compare as quick_ratio() > threshold"""
+    pairs = []
+    for (traceid1, stack1), (traceid2, stack2) in combinations(traces, 2):
+        matcher = difflib.SequenceMatcher(None, stack1, stack2, \
+                                            autojunk=False)
+        if matcher.quick_ratio() > threshold:
+            pairs.append((traceid1, traceid2))
+    return pairs
+
+def _components(traceids, pairs):
+    parents = dict((traceid, traceid) for traceid in traceids)
+    def root(traceid):
+        while parents[traceid] != traceid:
+            traceid = parents[traceid]
+        return traceid
+    for traceid1, traceid2 in pairs:
+        parents[root(traceid2)] = root(traceid1)
+    return len(set(root(traceid) for traceid in traceids))
+
+def _time(fn):
+    start = default_timer()
+    result = fn()
+    return (default_timer() - start, result)
+
+
+if __name__ == '__main__':
+    if not sys.argv[1:]:
+        print 'Syntax: duplicates[.py] allocations [sample] [datadir]'
+        sys.exit(1)
+    stubsymbols.install()
+    from pyumdh.backtrace import Backtrace
+    import pyumdh.duplicates as duplicates
+    allocations = synthlog.parse_count(sys.argv[1])
+    sample = int(sys.argv[2]) if sys.argv[2:] else 2000
+    datadir = sys.argv[3] if sys.argv[3:] else tempfile.mkdtemp()
+    log = synthlog.snapshot_path(datadir, 0)
+    if not os.path.exists(log):
+        log = synthlog.generate_series(datadir, allocations, snapshots=1)[0]
+    trace = Backtrace(log, fast=True)
+    heap = max(trace._heaps.itervalues(), key=len)
+    traces = sorted((traceid, list(alloc.stack)) for traceid, alloc in \
+                        heap.iteritems())
+    print 'engine: %s' % ('numpy' if duplicates.numpy is not None \
+                            else 'python')
+    subset = traces[:sample]
+    reference, pairs = _time(lambda: _reference_pairs(subset, \
+                                                duplicates.SIMILARITY))
+    elapsed, clusters = _time(lambda: duplicates.similar_clusters(subset))
+    cluster = dict((traceid, i) for i, members in enumerate(clusters) \
+                    for traceid in members)
+    found = sum(1 for traceid1, traceid2 in pairs \
+                    if cluster[traceid1] == cluster[traceid2])
+    print 'sample of %d traces: %d similar pairs' % (len(subset), len(pairs))
+    print 'recall %.4f, clusters %d (reference %d)' % (found / \
+            float(max(len(pairs), 1)), len(clusters), \
+            _components([traceid for traceid, _ in subset], pairs))
+    print 'minhash %7.2fs, pairwise quick_ratio %7.2fs: %5.1fx' % \
+            (elapsed, reference, reference / max(elapsed, 1e-9))
+    elapsed, clusters = _time(lambda: duplicates.similar_clusters(traces))
+    print 'heap of %d traces: %d clusters in %.2fs' % (len(traces), \
+            len(clusters), elapsed)
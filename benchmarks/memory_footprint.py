@@ -0,0 +1,51 @@
+# vim:ts=4:sw=4:expandtab
+"""Memory footprint benchmark.
+
+Parses an UMDH log into dict based and columnar Backtraces, each in a fresh
+process, and reports the resident memory they hold on to, the same once the
+C allocator has returned the memory freed while parsing (where it can be
+told to, see benchutil.trim_heap(); resident otherwise) and the size of the
+heaps themselves.
+"""
+
+import gc
+import subprocess
+import sys
+from benchutil import rss, deep_sizeof, trim_heap
+import stubsymbols
+# the child processes import pyumdh through this module as well
+stubsymbols.install()
+from pyumdh.backtrace import Backtrace
+
+_MODES = ('dict', 'columnar')
+
+def _measure(path, mode):
+    gc.collect()
+    before = rss()
+    trace = Backtrace(path, fast=True, columnar=(mode == 'columnar'))
+    gc.collect()
+    resident = rss() - before
+    trim_heap()
+    trimmed = rss() - before
+    return (resident, trimmed, deep_sizeof(trace._heaps))
+
+
+if __name__ == '__main__':
+    if not sys.argv[1:]:
+        print 'Syntax: memory_footprint[.py] datafile'
+        sys.exit(1)
+    if sys.argv[2:]:
+        # child: measure a single mode
+        print '%d %d %d' % _measure(sys.argv[1], sys.argv[2])
+        sys.exit(0)
+    results = {}
+    print '%-10s %12s %12s %12s' % ('storage', 'resident', 'trimmed', \
+                                        'heaps')
+    for mode in _MODES:
+        results[mode] = map(int, subprocess.check_output([sys.executable, \
+                            __file__, sys.argv[1], mode]).split())
+        print '%-10s %9.2f MB %9.2f MB %9.2f MB' % ((mode, ) + tuple(size / \
+                float(1 << 20) for size in results[mode]))
+    print 'columnar footprint is %.1fx smaller (%.1fx trimmed, %.1fx for ' \
+            'the heaps)' % tuple(a / float(max(b, 1)) for a, b in \
+                                zip(results['dict'], results['columnar']))
@@ -0,0 +1,46 @@
+# vim:ts=4:sw=4:expandtab
+"""Parser throughput benchmark.
+
+Parses an UMDH log with both the line and the bulk parser, checks that they
+agree and reports throughput in MB/s.
+"""
+
+import os
+import sys
+from timeit import default_timer
+import stubsymbols
+# before pyumdh.backtrace imports the symbol provider
+stubsymbols.install()
+from pyumdh.backtrace import Backtrace, iter_allocations
+
+
+def _measure(path, fast, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = default_timer()
+        for record in iter_allocations(path, fast=fast):
+            pass
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _same_result(path):
+    trace, fasttrace = (Backtrace(path), Backtrace(path, fast=True))
+    return trace._heaps == fasttrace._heaps and \
+            trace._modules == fasttrace._modules
+
+
+if __name__ == '__main__':
+    if not sys.argv[1:]:
+        print 'Syntax: parse_throughput[.py] datafile [repeat]'
+        sys.exit(1)
+    path = sys.argv[1]
+    repeat = int(sys.argv[2]) if sys.argv[2:] else 3
+    size = os.path.getsize(path) / float(1 << 20)
+    if not _same_result(path):
+        print 'bulk parser output differs from the line parser!'
+        sys.exit(2)
+    for name, fast in (('line', False), ('bulk', True)):
+        elapsed = _measure(path, fast, repeat)
+        print '%-6s %8.2f MB in %6.2fs: %8.2f MB/s' % (name, size, elapsed, \
+                size / elapsed)
@@ -0,0 +1,69 @@
+# vim:ts=4:sw=4:expandtab
+"""Symbol provider stand-in for running pyumdh w/o dbghelp (e.g. on linux).
+
+pyumdh.symprovider loads dbghelp.dll when it is imported. install() puts a
+stub module in its place when that fails, so pyumdh.backtrace and
+pyumdh.filters import anywhere. StubSymbolProvider names the functions of
+synthetic logs (see synthlog.symbol_name()).
+"""
+
+import ntpath
+import os
+import sys
+import types
+from contextlib import contextmanager
+from ctypes import c_ulonglong
+from synthlog import symbol_name
+
+__all__ = ['StubSymbolProvider', 'install']
+
+
+class StubSymbolProvider(object):
+    """Implements sym_from_addr() of symprovider.SymbolProvider"""
+    def __init__(self, *args, **kwargs):
+        self.lookups = 0
+
+    def cleanup(self):
+        pass
+
+    def sym_from_addr(self, moduleregistry, addr):
+        self.lookups += 1
+        module = moduleregistry.map_to_module(addr)
+        if not module:
+            return (None, c_ulonglong(), '<no module>')
+        rva = addr - module.BaseOfImage
+        return (symbol_name(module.ModuleName, rva), \
+                c_ulonglong(rva & 0xFF), module.ModuleName)
+
+
+def _format_symbol_module(module):
+    name = ntpath.basename(module).lower()
+    if name.endswith('.dll') or name.endswith('.exe'):
+        name = name[:-4]
+    return name
+
+@contextmanager
+def _symbols(bin_path=None, sym_path=None):
+    provider = StubSymbolProvider()
+    yield provider
+    provider.cleanup()
+
+def install():
+    """Registers the stub as pyumdh.symprovider unless the real one can be
+    imported. Returns True if the stub has been installed.
+    """
+    try:
+        import pyumdh.symprovider
+        return False
+    except (ImportError, ValueError, OSError, AttributeError):
+        pass
+    module = types.ModuleType('pyumdh.symprovider')
+    module.format_symbol_module = _format_symbol_module
+    module.symbols = _symbols
+    module.SymbolProvider = StubSymbolProvider
+    sys.modules['pyumdh.symprovider'] = module
+    import pyumdh
+    pyumdh.symprovider = module
+    # filters tell system modules apart by their location
+    os.environ.setdefault('windir', r'C:\Windows')
+    return True
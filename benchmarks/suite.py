@@ -0,0 +1,227 @@
+# vim:ts=4:sw=4:expandtab
+"""End-to-end benchmark suite.
+
+Generates a pair of synthetic snapshots per size (see synthlog) and times
+the steps of a diff session on them:
+
+    parse           Backtrace(log) with the line parser
+    parse_bulk      Backtrace(log, fast=True)
+    save            Backtrace.save() of the parsed snapshot
+    load            Backtrace.load() and decoding every allocation
+    diff            Backtrace.diff_with() of the two snapshots
+    filter_foreign  diff_with() through filters.filter_on_foreign_module
+    filter_grep     filters.grep_filter over the allocations of the diff
+    dump_allocs     Backtrace.dump_allocs() of the diff
+    duplicates      Backtrace.compress_duplicates() of the diff (aggressive);
+                    skipped for diffs above --duplicates-limit
+
+Each step runs in a fresh process that reports its time, the resident set
+after its setup (baseline_rss) and the peak resident set (peak_rss).
+Symbols come from stubsymbols, so the suite runs w/o dbghelp. Results are
+written as JSON; --compare prints the ratio to the results of an earlier
+run.
+
+    python suite.py --sizes 10k,100k --out results.json
+    python suite.py --sizes 10k,100k --compare results.json
+"""
+
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from optparse import OptionParser
+from timeit import default_timer
+from benchutil import rss, peak_rss
+import stubsymbols
+import synthlog
+
+STEPS = ('parse', 'parse_bulk', 'save', 'load', 'diff', 'filter_foreign', \
+            'filter_grep', 'dump_allocs', 'duplicates')
+
+_DUPLICATES_LIMIT = 200000
+
+
+def _load(path):
+    from pyumdh.backtrace import Backtrace
+    trace = Backtrace()
+    trace.load(path)
+    return trace
+
+def _diff(logs):
+    return _load(logs[0] + '.bin').diff_with(_load(logs[1] + '.bin'))
+
+def _walk(trace):
+    for heap in trace._heaps.itervalues():
+        for _ in heap.iteritems():
+            pass
+
+def _numtraces(trace):
+    return sum(len(heap) for heap in trace._heaps.itervalues())
+
+def _setup(step, logs, symbols):
+    """Returns (callable timed, extra results) for step"""
+    from pyumdh.backtrace import Backtrace
+    import pyumdh.filters as filters
+    import pyumdh.utils as utils
+    if step == 'parse':
+        return (lambda: Backtrace(logs[0]), {})
+    if step == 'parse_bulk':
+        return (lambda: Backtrace(logs[0], fast=True), {})
+    if step == 'save':
+        trace = Backtrace(logs[0], fast=True)
+        return (lambda: trace.save(tempfile.TemporaryFile()), {})
+    if step == 'load':
+        return (lambda: _walk(_load(logs[0] + '.bin')), {})
+    if step == 'filter_foreign':
+        old, new = (_load(logs[0] + '.bin'), _load(logs[1] + '.bin'))
+        grepfn = filters.filter_on_foreign_module(new, symbols=symbols)
+        return (lambda: old.diff_with(new, grepfn=grepfn), {})
+    if step == 'diff':
+        old, new = (_load(logs[0] + '.bin'), _load(logs[1] + '.bin'))
+        return (lambda: old.diff_with(new), {})
+    diff = _diff(logs)
+    extra = {'diff_traces': _numtraces(diff)}
+    if step == 'filter_grep':
+        grepfn = filters.grep_filter(diff, symbols, r'!operator new')
+        return (lambda: [item for heap in diff._heaps.itervalues() \
+                            for item in heap.iteritems() if grepfn(item)], \
+                extra)
+    if step == 'dump_allocs':
+        devnull = open(os.devnull, 'w')
+        return (lambda: diff.dump_allocs(symbols=symbols, \
+                                            fileobject=devnull), extra)
+    if step == 'duplicates':
+        return (lambda: diff.compress_duplicates( \
+                            utils.duplicate_levels.aggressive), extra)
+    raise ValueError('unknown step: %s' % step)
+
+def _run_step(step, logs):
+    """Runs step in this process and returns its results"""
+    symbols = stubsymbols.StubSymbolProvider()
+    fn, results = _setup(step, logs, symbols)
+    gc.collect()
+    results['baseline_rss'] = rss()
+    start = default_timer()
+    fn()
+    results['seconds'] = default_timer() - start
+    results['peak_rss'] = peak_rss()
+    if symbols.lookups:
+        results['symbol_lookups'] = symbols.lookups
+    return results
+
+def _prepare(datadir, size, seed):
+    """Generates the snapshots of size (unless present) and their binary
+    form. Returns the paths of the logs.
+    """
+    sizedir = os.path.join(datadir, '%s-%d' % (size, seed))
+    logs = [synthlog.snapshot_path(sizedir, i) for i in xrange(2)]
+    if not all(os.path.exists(path) for path in logs):
+        logs = synthlog.generate_series(sizedir, synthlog.parse_count(size), \
+                                        2, seed)
+    from pyumdh.backtrace import Backtrace
+    for log in logs:
+        if not os.path.exists(log + '.bin'):
+            Backtrace(log, fast=True).save(log + '.bin')
+    return logs
+
+def run(sizes, steps, datadir, seed=0, duplicateslimit=_DUPLICATES_LIMIT, \
+        verbose=False):
+    """Runs steps for each size, each in a child process.
+    Returns the results as a JSON serializable dict.
+    """
+    results = []
+    for size in sizes:
+        logs = _prepare(datadir, size, seed)
+        diff = None
+        for step in steps:
+            if step == 'duplicates':
+                if diff is None:
+                    diff = _numtraces(_diff(logs))
+                if diff > duplicateslimit:
+                    results.append({'size': size, 'step': step, \
+                                    'skipped': 'diff has %d traces' % diff})
+                    continue
+            output = subprocess.check_output([sys.executable, \
+                        os.path.abspath(__file__), '--child', step] + logs)
+            result = json.loads(output)
+            result.update({'size': size, 'step': step, \
+                            'allocations': synthlog.parse_count(size), \
+                            'log_bytes': os.path.getsize(logs[0])})
+            results.append(result)
+            if verbose:
+                print >> sys.stderr, '%6s %-15s %9.3fs %9.2f MB peak' % \
+                        (size, step, result['seconds'], \
+                            result['peak_rss'] / float(1 << 20))
+    return {'python': platform.python_version(), \
+            'platform': platform.platform(), \
+            'seed': seed, 'results': results}
+
+def compare(report, baseline, fileobject=sys.stdout):
+    """Prints time and peak memory of report relative to baseline"""
+    def index(data):
+        return dict(((r['size'], r['step']), r) for r in data['results'] \
+                    if 'seconds' in r)
+    old = index(baseline)
+    fileobject.write('%6s %-15s %10s %8s %10s %8s\n' % ('size', 'step', \
+                        'seconds', 'ratio', 'peak MB', 'ratio'))
+    for result in report['results']:
+        if 'seconds' not in result:
+            continue
+        key = (result['size'], result['step'])
+        then = old.get(key)
+        fileobject.write('%6s %-15s %10.3f %8s %10.2f %8s\n' % (key + \
+                (result['seconds'], '%.2fx' % (result['seconds'] / \
+                    max(then['seconds'], 1e-9)) if then else '-', \
+                result['peak_rss'] / float(1 << 20), '%.2fx' % \
+                    (result['peak_rss'] / float(max(then['peak_rss'], 1))) \
+                    if then else '-')))
+
+
+if __name__ == '__main__':
+    stubsymbols.install()
+    if sys.argv[1:2] == ['--child']:
+        print json.dumps(_run_step(sys.argv[2], sys.argv[3:]))
+        sys.exit(0)
+
+    parser = OptionParser(usage='suite[.py] [options]')
+    parser.add_option('--sizes', default='10k,100k', \
+            help='comma separated allocation counts of the generated logs ' \
+            '(e.g. 10k,100k,1M,10M; defaults to %default)')
+    parser.add_option('--steps', default=','.join(STEPS), \
+            help='comma separated steps to run (defaults to all)')
+    parser.add_option('--data-dir', dest='datadir', \
+            help='directory to keep generated logs in for later runs ' \
+            '(defaults to a temporary directory)')
+    parser.add_option('--seed', type='int', default=0, \
+            help='seed of the generated logs (defaults to %default)')
+    parser.add_option('--duplicates-limit', dest='duplicateslimit', \
+            type='int', default=_DUPLICATES_LIMIT, \
+            help='skip duplicate compression of diffs with more traces ' \
+            '(defaults to %default)')
+    parser.add_option('--out', help='file to write the JSON results to ' \
+            '(defaults to stdout)')
+    parser.add_option('--compare', help='JSON results of an earlier run to ' \
+            'compare with')
+    (opts, args) = parser.parse_args()
+
+    steps = opts.steps.split(',')
+    for step in steps:
+        if step not in STEPS:
+            parser.error('unknown step: %s' % step)
+    datadir = opts.datadir or tempfile.mkdtemp(prefix='pyumdh-bench-')
+    report = run(opts.sizes.split(','), steps, datadir, opts.seed, \
+                    opts.duplicateslimit, verbose=True)
+    if opts.out:
+        with open(opts.out, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    elif not opts.compare:
+        print json.dumps(report, indent=1, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(report, json.load(f))
+    if not opts.datadir:
+        import shutil
+        shutil.rmtree(datadir, ignore_errors=True)
@@ -0,0 +1,242 @@
+# vim:ts=4:sw=4:expandtab
+"""Synthetic UMDH log generator.
+
+Writes logs that look like UMDH output - a module table, several heaps (one
+of them empty), stacks dumped once per trace, the odd aliased stack - and
+are fully determined by (allocations, snapshot, seed).
+
+Snapshots of a series grow: snapshot k holds the allocations of snapshot
+k-1 minus the transient ones freed since, plus `growth' new allocations,
+some of them made from traces that did not exist before. Stacks share
+call chains, and traces come in families of near-duplicate stacks, so that
+stack interning and duplicate compression have something to work on.
+
+    python synthlog.py outdir 100k [snapshots] [seed]
+
+writes outdir/1234_snapshot_0.log, outdir/1234_snapshot_1.log, ...
+"""
+
+import ntpath
+import os
+import random
+import sys
+
+__all__ = ['MODULES', 'PID', 'parse_count', 'symbol_name', 'generate', \
+            'generate_series', 'snapshot_path']
+
+PID = 1234
+
+# (base, size, path) in the order UMDH lists them
+MODULES = [
+    (0x400000, 0x11D000, r'D:\synth\bin\app.exe'),
+    (0x77650000, 0x180000, r'C:\Windows\SysWOW64\ntdll.dll'),
+    (0x75980000, 0x100000, r'C:\Windows\syswow64\kernel32.dll'),
+    (0x75A80000, 0x46000, r'C:\Windows\syswow64\KERNELBASE.dll'),
+    (0x76F20000, 0x8F000, r'C:\Windows\syswow64\OLEAUT32.dll'),
+    (0x767C0000, 0xCC000, r'C:\Windows\syswow64\MSCTF.dll'),
+    (0x74700000, 0x51000, r'C:\Windows\system32\WINSPOOL.DRV'),
+    (0x72E50000, 0xA3000, r'C:\Windows\WinSxS\x86_microsoft.vc90.crt_' \
+                            '1fc8b3b9a1e18e3b_9.0.30729.6161_none_' \
+                            '50934f2ebcb7eb57\MSVCR90.dll'),
+    (0x1B090000, 0x26000, r'D:\synth\bin\runtime.dll'),
+    (0x60AC0000, 0x2A0000, r'D:\synth\bin\QtCore4.dll'),
+    (0x61400000, 0x9C0000, r'D:\synth\bin\QtGui4.dll'),
+    (0x642F0000, 0x140000, r'D:\synth\bin\document.dll'),
+    (0x650C0000, 0xC0000, r'D:\synth\bin\render.dll'),
+    (0x65470000, 0x110000, r'D:\synth\bin\layout.dll'),
+    (0x658E0000, 0x60000, r'D:\synth\bin\network.dll'),
+]
+
+# heaps and the share of allocations they get; the last heap stays empty
+_HEAPS = [(0x2E60000, 0.7), (0x5E0000, 0.2), (0x4A30000, 0.1), \
+            (0x1D890000, 0.0)]
+
+# functions of the system allocators (module basename, rva range, name)
+_ALLOCATORS = [
+    ('ntdll.dll', 0x1000, 0x1400, 'RtlAllocateHeap'),
+    ('ntdll.dll', 0x1400, 0x1800, 'RtlReAllocateHeap'),
+    ('MSVCR90.dll', 0x1000, 0x1400, 'malloc'),
+    ('MSVCR90.dll', 0x1400, 0x1800, 'operator new'),
+    ('MSVCR90.dll', 0x1800, 0x1C00, 'realloc'),
+]
+
+_COUNT_SUFFIXES = {'k': 1000, 'm': 1000000}
+_SAMPLE_SIZES = [0x8, 0xC, 0x10, 0x18, 0x20, 0x28, 0x40, 0x64, 0x80, 0x100, \
+                    0x200, 0x1000]
+# fraction of the allocations of a snapshot added by the next one
+_GROWTH = 0.1
+# fraction of allocations freed by the snapshot following their own
+_CHURN = 0.05
+# fraction of traces with an alias stack
+_ALIASES = 0.01
+# traces per family of near-duplicate stacks
+_FAMILY = 4
+_NUMCHAINS = 512
+
+
+def parse_count(text):
+    """Parses allocation counts like 10k or 1M"""
+    text = text.strip().lower()
+    if text[-1:] in _COUNT_SUFFIXES:
+        return int(float(text[:-1]) * _COUNT_SUFFIXES[text[-1]])
+    return int(text)
+
+def _module(name):
+    for base, size, path in MODULES:
+        if ntpath.basename(path).lower() == name.lower():
+            return (base, size, path)
+
+def symbol_name(modulename, rva):
+    """Returns the name of the synthetic function at rva of a module.
+    Allocator frames of the generated stacks resolve to the names the
+    filters look for, everything else to sub_<rva>.
+    """
+    name = ntpath.basename(modulename).lower()
+    for module, start, end, function in _ALLOCATORS:
+        if name == module.lower() and start <= rva < end:
+            return function
+    return 'sub_%X' % (rva & ~0xFF)
+
+
+class _Stacks(object):
+    """Derives the stack of a trace from its index"""
+    def __init__(self, seed):
+        rng = random.Random(seed)
+        self._seed = seed
+        allocators = []
+        for module, start, end, _ in _ALLOCATORS:
+            base = _module(module)[0]
+            allocators.append(base + rng.randrange(start, end))
+        self._ntdll = allocators[:2]
+        self._crt = allocators[2:]
+        appmodules = [m for m in MODULES if m[2].startswith('D:')]
+        # call chains: runs of frames within one module
+        self._chains = []
+        for _ in xrange(_NUMCHAINS):
+            base, size, _ = rng.choice(appmodules)
+            self._chains.append([base + rng.randrange(0x1000, size) \
+                                    for _ in xrange(rng.randint(2, 8))])
+        app = MODULES[0][0]
+        kernel32, ntdll = (_module('kernel32.dll')[0], \
+                            _module('ntdll.dll')[0])
+        self._bottom = [app + 0x8EE0, app + 0x49DB8, kernel32 + 0x11E23, \
+                        ntdll + 0x89A60, ntdll + 0x89A33]
+
+    def stack(self, index):
+        """Returns (stack, alias) of the trace; alias may be None"""
+        family = random.Random(self._seed * 7919 + index / _FAMILY)
+        stack = list(family.choice(self._ntdll) for _ in \
+                        xrange(family.randint(1, 3)))
+        if family.random() < 0.7:
+            stack.append(family.choice(self._crt))
+        for _ in xrange(family.randint(2, 5)):
+            stack.extend(family.choice(self._chains))
+        stack.extend(self._bottom[:family.randint(2, len(self._bottom))])
+        rng = random.Random(self._seed * 104729 + index)
+        if index % _FAMILY:
+            # a near-duplicate of its family head
+            frame = rng.randrange(len(stack))
+            stack[frame] += rng.randrange(1, 0x100)
+        alias = None
+        if rng.random() < _ALIASES:
+            alias = list(stack)
+            alias[0] = rng.choice(self._ntdll)
+        return (stack, alias)
+
+
+def _traceid(heapindex, index):
+    return 0x10000000 + index * 0x58 + heapindex * 4
+
+def _write_header(f, pid):
+    f.write('// \n// UMDH: version 6.1.7650.0: Logtime 2012-04-30 12:09 - '
+            'Machine=SYNTH - PID=%d\n// \n\n' % pid)
+    f.write('// Debug privilege has been enabled.\n// OS version 6.1 \n'
+            '// Umdh OS version 6.1\n// \n'
+            '// Preparing to dump heap allocations.\n// \n'
+            '// Connecting to process %d ...\n'
+            '// Process %d opened handle=44.\n'
+            '// Loaded modules: \n//     Base Size Module\n' % (pid, pid))
+    for base, size, path in MODULES:
+        f.write('//      %14X %8X %s\n' % (base, size, path))
+    f.write('//\n// Process modules enumerated.\n'
+            '// Debug library initialized ...\n\n')
+
+def _write_heap(f, heapindex, handle, numallocs, snapshot, stacks, seed):
+    f.write('*- - - - - - - - - - Start of data for heap @ %X - - - - - - - - '
+            '- -\n\nREQUESTED bytes + OVERHEAD at ADDRESS by BackTraceID\n'
+            '     STACK if not already dumped.\n\n*- - - - - - - - - - Heap '
+            '%X Hogs - - - - - - - - - -\n\n' % (handle, handle))
+    # every event draws the same numbers whatever the snapshot, so snapshot
+    # k+1 sees the very allocations of snapshot k
+    rng = random.Random(seed * 31 + heapindex)
+    growth = max(1, int(numallocs * _GROWTH))
+    numevents = numallocs + snapshot * growth if numallocs else 0
+    address = handle + 0x3FA20
+    dumped = set()
+    lines = []
+    for event in xrange(numevents):
+        # new traces keep appearing as the heap grows
+        numtraces = max(_FAMILY, event / 8)
+        index = int(numtraces * rng.random() ** 2)
+        requested = rng.choice(_SAMPLE_SIZES) + rng.randrange(0, 8)
+        overhead = -requested % 16 + 8
+        address += requested + overhead + rng.choice((0, 0, 0, 0x10, 0x80))
+        freed = rng.random() < _CHURN
+        birth = 0 if event < numallocs else 1 + (event - numallocs) / growth
+        if freed and snapshot > birth:
+            continue
+        lines.append('%X bytes + %X at %X by BackTrace%X\n' % (requested, \
+                        overhead, address, _traceid(heapindex, index)))
+        if index not in dumped:
+            dumped.add(index)
+            stack, alias = stacks.stack(index)
+            lines.extend('\t%X\n' % frame for frame in stack)
+            if alias:
+                lines.append('\tAlias\n')
+                lines.extend('\t%X\n' % frame for frame in alias)
+            lines.append('\n')
+        if len(lines) >= 1 << 16:
+            f.write(''.join(lines))
+            del lines[:]
+    f.write(''.join(lines))
+    f.write('\n*- - - - - - - - - - End of data for heap @ %X - - - - - - - - '
+            '- -\n\n' % handle)
+
+def generate(fileobject, allocations, snapshot=0, seed=0, pid=PID):
+    """Writes snapshot number |snapshot| of a series whose first snapshot
+    holds about |allocations| allocations.
+    """
+    stacks = _Stacks(seed)
+    _write_header(fileobject, pid)
+    for heapindex, (handle, share) in enumerate(_HEAPS):
+        _write_heap(fileobject, heapindex, handle, \
+                    int(allocations * share), snapshot, stacks, seed)
+
+def snapshot_path(datadir, snapshot, pid=PID):
+    return os.path.join(datadir, '%d_snapshot_%d.log' % (pid, snapshot))
+
+def generate_series(datadir, allocations, snapshots=2, seed=0, pid=PID):
+    """Writes |snapshots| logs named like the ones pyumdh takes to datadir.
+    Returns their paths.
+    """
+    if not os.path.exists(datadir):
+        os.makedirs(datadir)
+    paths = []
+    for snapshot in xrange(snapshots):
+        path = snapshot_path(datadir, snapshot, pid)
+        with open(path, 'w') as f:
+            generate(f, allocations, snapshot, seed, pid)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print 'Syntax: synthlog[.py] outdir allocations [snapshots] [seed]'
+        print '    allocations: count such as 10k, 100k, 1M or 10M'
+        sys.exit(1)
+    snapshots = int(sys.argv[3]) if sys.argv[3:] else 2
+    seed = int(sys.argv[4]) if sys.argv[4:] else 0
+    for path in generate_series(sys.argv[1], parse_count(sys.argv[2]), \
+                                snapshots, seed):
+        print path
@@ -3,18 +3,24 @@
 
 import re
 import operator
-import difflib
 import math
 import os
 import sys
 import struct
 import io
 from collections import namedtuple
-from itertools import combinations, groupby, ifilter, chain, izip, takewhile
+from itertools import ifilter, chain, izip, islice
 from pyumdh.symprovider import format_symbol_module
 import pyumdh.config as config
 from pyumdh.symprovider import symbols
 import pyumdh.utils as utils
+import pyumdh.snapshot as snapshot
+import pyumdh.store as store
+import pyumdh.heapdiff as heapdiff
+from pyumdh.blockindex import BlockIndex
+from pyumdh.moduleindex import ModuleTable
+import pyumdh.duplicates as duplicates
+import pyumdh.symtable as symtable
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -22,13 +28,6 @@ except ImportError:
 import pdb
 
 
-def _quick_compare_stacks(stack1, stack2, threshold=0.7):
-    """Compare stacks given a tolerance level."""
-    stacklen = max(len(stack1), len(stack2))
-    matchlen = len([a for a in takewhile(lambda x: x[0] == x[1], izip(stack1, \
-                        stack2))])
-    return matchlen >= int(stacklen * threshold)
-
 # parsing helpers
 def _next_line(f):
     """Skip empty lines and comments"""
@@ -74,6 +73,264 @@ def _parse_stack(f):
     return (originalstack or addrs, aliases)
 
 
+def _parse_modules(f, modules):
+    """Parse the module table into |modules|.
+    Returns the first line following the table.
+    """
+    line = f.readline()
+    # rewind to module list
+    while line and 'Base Size Module' not in line:
+        line = f.readline()
+    # set ptr on the first module
+    line = f.readline()
+    while line and not line.startswith('*-'):
+        m = Backtrace._module_re_.search(line)
+        if m:
+            address, size, path = m.group(1, 2, 3)
+            modules.update( \
+                {os.path.basename(path): \
+                        Backtrace.module(BaseOfImage=int(address, 16), \
+                                    SizeOfImage=int(size, 16), \
+                                    ModuleName=path) \
+                })
+        line = f.readline()
+    return line
+
+
+def _iter_heap(f):
+    """Yield (traceid, allocation) for every allocation sample of the heap
+    the file is positioned on.
+    """
+    line = _next_line(f)
+    while line:
+        m = Backtrace._allocstats_re_.search(line)
+        if m:
+            requested, overhead, addr, traceid = m.group(1, 2, 3, 4)
+            # parse allocation
+            stack, aliases = _parse_stack(f)
+            sample = Backtrace.sample(requested=int(requested, 16), \
+                                overhead=int(overhead, 16), \
+                                address=int(addr, 16))
+            yield (int(traceid, 16), Backtrace.allocation(stack=stack, \
+                                        aliases=aliases, allocs=[sample]))
+        elif line.startswith('*- - - - - - - - - - End of data for heap'):
+            break
+        line = _next_line(f)
+
+
+# size of the blocks read by the bulk parser; larger blocks do not parse
+# faster but leave the memory of their copies behind in the C heap
+_PARSE_BLOCKSIZE = 1 << 16
+
+# traces dumped per batch of frames symbolized at once
+_DUMP_BATCH = 1 << 12
+
+def _iter_blocks(f, line, blocksize=_PARSE_BLOCKSIZE):
+    """Yield |line| followed by the rest of the file in large blocks.
+    Blocks are cut after an empty line, so that no record spans two blocks;
+    the last block is terminated by an empty line as well.
+    """
+    tail = line
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        block = tail + block
+        cut = block.rfind('\n\n')
+        if cut == -1:
+            # no record boundary yet, keep reading
+            tail = block
+            continue
+        tail = block[cut+2:]
+        yield block[:cut+2]
+    if tail:
+        # an empty line at the end of file does not alter the parse
+        if not tail.endswith('\n'):
+            tail += '\n'
+        if not tail.endswith('\n\n'):
+            tail += '\n'
+        yield tail
+
+
+def _parse_allocstats(line):
+    """Split an allocation line into (traceid, sample).
+    Returns None if the line is not an allocation line.
+    """
+    parts = line.split(' ')
+    try:
+        if len(parts) == 8 and parts[1] == 'bytes' and parts[2] == '+' \
+                and parts[4] == 'at' and parts[6] == 'by' and \
+                parts[7].startswith('BackTrace'):
+            return (int(parts[7][9:], 16), Backtrace.sample(int(parts[0], 16), \
+                    int(parts[3], 16), int(parts[5], 16)))
+    except ValueError:
+        pass
+    # not the canonical layout - leave it to the regex
+    m = Backtrace._allocstats_re_.search(line)
+    if m:
+        requested, overhead, addr, traceid = m.group(1, 2, 3, 4)
+        return (int(traceid, 16), Backtrace.sample(int(requested, 16), \
+                int(overhead, 16), int(addr, 16)))
+
+
+def _decode_frames(frames):
+    """Hex-decode a list of frames in bulk."""
+    return map(int, frames, [16] * len(frames))
+
+
+def _split_aliases(frames):
+    """Split frames at `Alias' markers into (stack, aliases).
+    Mirrors _parse_stack: the stack is the first non-empty list of frames
+    and aliases are all lists following a marker.
+    """
+    segments = []
+    start = 0
+    while True:
+        try:
+            i = frames.index('Alias', start)
+        except ValueError:
+            segments.append(_decode_frames(frames[start:]))
+            break
+        segments.append(_decode_frames(frames[start:i]))
+        start = i + 1
+    stack = next((seg for seg in segments if seg), segments[-1])
+    return (stack, segments[1:])
+
+
+def _parse_stack_block(block, pos):
+    """Block counterpart of _parse_stack for stacks that do not fit the
+    plain layout (aliases or no terminating empty line).
+    Returns (stack, aliases, pos) with pos past the consumed lines.
+    """
+    (addrs, originalstack) = ([], [])
+    aliases = []
+    while block.startswith('\t', pos):
+        eol = block.find('\n', pos)
+        addr = block[pos:eol].strip('\t')
+        if addr == 'Alias': # alias stack follows
+            if not originalstack:
+                originalstack = addrs
+            addrs = []
+            aliases.append(addrs)
+        else:
+            addrs.append(int(addr, 16))
+        pos = eol + 1
+    # the line terminating a stack is consumed
+    return (originalstack or addrs, aliases, block.find('\n', pos) + 1)
+
+
+def _iter_allocations_fast(f, line, heaps, heaphandle=None):
+    """Bulk counterpart of the iter_allocations() loop.
+    Reads the log in large blocks and decodes a whole stack with a single
+    split instead of readline/seek and a regex per line.
+
+    |heaphandle|    if given, f is parsed as (a part of) the body of that heap
+    """
+    allocation, sample = (Backtrace.allocation, Backtrace.sample)
+    # namedtuples w/o the python level __new__ of their own
+    new = tuple.__new__
+    inheap = heaphandle is not None
+    for block in _iter_blocks(f, line):
+        pos = 0
+        end = len(block)
+        while pos < end:
+            eol = block.find('\n', pos)
+            line = block[pos:eol]
+            pos = eol + 1
+            if not inheap:
+                if line.startswith('*- - - - - - - - - - Heap'):
+                    heaphandle = int(Backtrace._heaphandle_re_.search( \
+                                                        line).group(1), 16)
+                    if heaps is not None:
+                        heaps.append(heaphandle)
+                    inheap = True
+                continue
+            # allocation lines first, they are the bulk of a heap
+            if ' by BackTrace' not in line:
+                if line.startswith('*- - - - - - - - - - End of data for heap'):
+                    inheap = False
+                continue
+            if line.startswith('//'):
+                continue
+            # the canonical layout is decoded inline (see _parse_allocstats())
+            stats = None
+            parts = line.split(' ')
+            if len(parts) == 8 and parts[1] == 'bytes' and parts[2] == '+' \
+                    and parts[4] == 'at' and parts[6] == 'by' and \
+                    parts[7].startswith('BackTrace'):
+                try:
+                    stats = (int(parts[7][9:], 16), new(sample, \
+                                (int(parts[0], 16), int(parts[3], 16), \
+                                    int(parts[5], 16))))
+                except ValueError:
+                    pass
+            if stats is None:
+                stats = _parse_allocstats(line)
+                if not stats:
+                    continue
+            (stack, aliases) = ([], [])
+            if block.startswith('\t', pos):
+                eos = block.find('\n\n', pos)
+                frames = block[pos+1:eos]
+                # plain layout: tab-indented frames up to an empty line
+                plain = frames.count('\n') == frames.count('\n\t')
+                if plain:
+                    numaliases = frames.count('Alias')
+                    frames = frames.split('\n\t')
+                    plain = numaliases == frames.count('Alias')
+                if plain:
+                    if numaliases:
+                        stack, aliases = _split_aliases(frames)
+                    else:
+                        stack = _decode_frames(frames)
+                    # skip the empty line terminating the stack
+                    pos = eos + 2
+                else:
+                    stack, aliases, pos = _parse_stack_block(block, pos)
+            elif block.startswith('\n', pos):
+                # empty line following an allocation is consumed
+                pos += 1
+            yield (heaphandle, stats[0], new(allocation, (stack, aliases, \
+                                                            [stats[1]])))
+
+
+def iter_allocations(datafile, modules=None, heaps=None, fast=False):
+    """Stream allocation records from an UMDH log.
+
+    Yields a (heaphandle, traceid, allocation) tuple for every allocation
+    sample in file order; each allocation carries a single sample.  Since
+    UMDH dumps a stack only once, the stack is empty for samples whose trace
+    has already been seen.
+    Only the record being parsed is held in memory.
+
+    |datafile|      path or file object to read the log from
+    |modules|       optional dict to receive the module table
+    |heaps|         optional list to receive heap handles (including these
+                    of empty heaps) as they are encountered
+    |fast|          use the bulk parser; it reads the log in large blocks and
+                    yields the very same records
+    """
+    f, close = utils.file_open(datafile, 'r')
+    try:
+        line = _parse_modules(f, modules if modules is not None else {})
+        if fast:
+            for record in _iter_allocations_fast(f, line, heaps):
+                yield record
+            return
+        while line:
+            if line.startswith('*- - - - - - - - - - Heap'):
+                heaphandle = \
+                        int(Backtrace._heaphandle_re_.search(line).group(1), 16)
+                if heaps is not None:
+                    heaps.append(heaphandle)
+                for traceid, allocation in _iter_heap(f):
+                    yield (heaphandle, traceid, allocation)
+            line = _next_line(f)
+    finally:
+        if close:
+            f.close()
+
+
 class Backtrace(object):
     """Process memory snapshot.
 
@@ -93,30 +350,66 @@ class Backtrace(object):
     module = namedtuple('module', 'BaseOfImage SizeOfImage ModuleName')
     magic = 'hdmuyp'
 
-    def __init__(self, datafile=None):
-        """Constructs a Backtrace by parsing the specified file"""
+    def __init__(self, datafile=None, fast=False, columnar=False, \
+                    stacks=None, processes=None):
+        """Constructs a Backtrace by parsing the specified file
+
+        |fast|      use the bulk parser (see iter_allocations())
+        |columnar|  keep allocations in columnar storage (see compact())
+        |stacks|    store.StackTable to intern stacks with; share one between
+                    Backtraces of the same process to keep a single copy of
+                    each stack
+        |processes| parse the log in this many processes (see
+                    pyumdh.parallel); alias stacks are not kept then
+        """
         # heaps is a dict of dicts each representing an individual allocation
         self._heaps = {}
         # top-level allocations dict (this is where _all_ allocations
         # irregardless of heap they belong to are stored)
         self._allocs = {}
-        self._modules = {}
+        # modules by name (see moduleindex)
+        self._modules = ModuleTable()
         # unique traces
         self._uniqueallocs = {}
+        # memory mapped binary snapshot (if loaded from one)
+        self._snapshot = None
+        # columnar storage (if compacted)
+        self._store = None
+        # interval index of the blocks (if loaded from a snapshot)
+        self._blockindex = None
+        # symbols of the frames (see symbolize())
+        self._symtable = None
+        self._stacks = stacks if stacks is not None else store.StackTable()
+        # stamp of the parsed log (see snapshot.source_stamp())
+        self._source = None
         if datafile:
             if isinstance(datafile, basestring):
                 self._path = datafile
+                self._source = snapshot.source_stamp(datafile)
+                if processes:
+                    import pyumdh.parallel as parallel
+                    parallel.parse_into(self, datafile, processes)
+                    if columnar:
+                        self.compact()
+                    return
                 with open(datafile, 'r') as f:
-                    self._parse(f)
+                    self._parse(f, fast, columnar)
             else:
-                self._parse(datafile)
+                self._parse(datafile, fast, columnar)
 
     # module registry protocol
     def map_to_module(self, addr):
-        for module in self._modules.itervalues():
-            if module.BaseOfImage <= addr < module.BaseOfImage + \
-                                            module.SizeOfImage:
-                return module
+        return self.module_index().find(addr)
+
+    def module_index(self):
+        """Returns the moduleindex.ModuleIndex of the modules; its
+        module_ids() maps many addresses at once
+        """
+        modules = self._modules
+        if not isinstance(modules, ModuleTable):
+            # a plain dict assigned to the Backtrace
+            modules = self._modules = ModuleTable(modules)
+        return modules.index()
 
     def dump_stats(self, fileobject=None):
         def alloc_key(alloc):
@@ -155,6 +448,8 @@ class Backtrace(object):
             heaps = self._heaps.iteritems()
         if not grepfn:
             grepfn = bool
+        if symbols is not None:
+            symbols = self.symbolize(symbols, ())
         self._print('Allocations:', fileobject=fileobject)
         for handle, heap in heaps:
             self._print('Heap @ 0x%X' % handle, fileobject=fileobject)
@@ -163,7 +458,8 @@ class Backtrace(object):
                                     heap.iteritems())
             else:
                 iterable = heap.iteritems()
-            for traceid, alloc in ifilter(grepfn, iterable):
+            for traceid, alloc in self._symbolized(ifilter(grepfn, \
+                                                    iterable), symbols):
                 mergeallocs = self._uniqueallocs.get(traceid) or []
                 self._print('Traceid: 0x%x' % traceid, fileobject=fileobject)
                 self._print('Memory entries: %d' % \
@@ -178,252 +474,404 @@ class Backtrace(object):
                 self._dump_stack(alloc.stack, symbols=symbols, \
                         fileobject=fileobject)
 
-    def diff_with(self, backtrace, grepfn=None):
+    def diff_with(self, backtrace, grepfn=None, crossheap=False):
         """Compute a diff to backtrace and return a new instance of
         Backtrace.
 
         |grepfn|     filter to run on allocations
                      must comply to the filter protocol
+        |crossheap|  compare every heap of backtrace to the blocks of all
+                     heaps of this snapshot by address and trace id (see
+                     heapdiff.diff_global()) rather than to the heap with
+                     the same handle; blocks of recreated heaps or blocks
+                     that moved between heaps are not new then
         """
-        def diff_filter(traces):
-            def _filter(item):
-                return item[0] in traces
-            return _filter
         if not grepfn:
             grepfn = bool
-        diff = Backtrace()
+        diff = Backtrace(stacks=backtrace._stacks)
         diff._modules = backtrace._modules
-        for handle, heap in self._heaps.iteritems():
+        if crossheap:
+            index = heapdiff.AddressIndex(self._heaps)
+            heaps = ((handle, index) for handle in backtrace._heaps)
+        else:
+            heaps = self._heaps.iteritems()
+        for handle, heap in heaps:
             # work for each overlapping heap
             otherheap = backtrace._heaps.get(handle)
             if otherheap:
-                otherheapset = frozenset(otherheap.iterkeys())
-                # filter all traces not present in original heap
-                difftraces = otherheapset.difference(heap.iterkeys())
-                # FIXME maybe treat dicts and iterables alike as values for
-                # self._heaps???
-                diffdct = {t: otherheap[t] for t in difftraces}
+                # traces not present in original heap and common traces
+                # with new allocations
+                if crossheap:
+                    difftraces, growntraces = heapdiff.diff_global(heap, \
+                                                                otherheap)
+                else:
+                    difftraces, growntraces = heapdiff.diff_heap(heap, \
+                                                                otherheap)
+                diffdct = {t: diff._intern(otherheap[t]) for t in difftraces}
                 diffallocs = dict(filter(grepfn, diffdct.iteritems()))
                 if not diffallocs:
                     # do not persist an empty heap
                     continue
                 diffheap = diff._heaps.setdefault(handle, diffallocs)
                 diff._allocs.update(diffallocs)
-                # now, compute the differences on the allocation level
-                commontraces = otherheapset.intersection(heap)
-                for trace in commontraces:
-                    alloc = otherheap.get(trace)
-                    a0 = frozenset(heap.get(trace).allocs)
-                    a1 = frozenset(otherheap.get(trace).allocs)
-                    adiff = list(a1 - a0)
+                # now, the differences on the allocation level
+                for trace, adiff in growntraces:
+                    alloc = otherheap[trace]
                     # skip over this trace if the grep is negative
-                    if adiff and grepfn((None, alloc)):
-                        diffalloc = self.allocation(stack=alloc.stack, \
-                                                    aliases=[],
-                                                    allocs=adiff)
+                    if grepfn((None, alloc)):
+                        diffalloc = self.allocation( \
+                                        stack=diff._stacks.stack(alloc.stack), \
+                                        aliases=[], \
+                                        allocs=[self.sample(*s) for s in adiff])
                         diffheap.setdefault(trace, diffalloc)
                         diff._allocs.update({trace: diffalloc})
         return diff
 
-    def compress_duplicates(self, level):
+    def top_growth(self, backtrace, limit=20, metric='bytes', grepfn=None):
+        """Returns the |limit| traces that grew the most from this snapshot
+        to backtrace as heapdiff.delta records, largest first. Unlike
+        diff_with() freed blocks count: deltas are net changes in live
+        blocks and bytes (requested + overhead) per heap and trace.
+
+        |metric|    'bytes' or 'count'; prefix with '-' for the traces that
+                    shrank the most
+        |grepfn|    filter to run on allocations
+                    must comply to the filter protocol
+        """
+        sign = -1 if metric.startswith('-') else 1
+        key = operator.attrgetter(metric.lstrip('-'))
+        def deltas():
+            for handle in sorted(set(self._heaps).union(backtrace._heaps)):
+                for traceid, count, size in heapdiff.heap_deltas( \
+                        self._heaps.get(handle, {}), \
+                        backtrace._heaps.get(handle, {})):
+                    yield heapdiff.delta(handle, traceid, count, size)
+        def accept(delta):
+            return grepfn((delta.traceid, self._growth_allocation( \
+                                backtrace, delta)))
+        return heapdiff.top_deltas(deltas(), limit, \
+                                    lambda delta: sign * key(delta), \
+                                    accept if grepfn else None)
+
+    def dump_growth(self, backtrace, limit=20, metric='bytes', symbols=None, \
+            grepfn=None, fileobject=None):
+        """Dumps the traces that grew the most (see top_growth())"""
+        self._print('Growth:', fileobject)
+        deltas = self.top_growth(backtrace, limit, metric, grepfn)
+        if symbols is not None:
+            symbols = self.symbolize(symbols, (self._growth_allocation( \
+                            backtrace, delta).stack for delta in deltas))
+        for delta in deltas:
+            self._print('Heap @ 0x%X Traceid: 0x%x' % (delta.handle, \
+                        delta.traceid), fileobject)
+            self._print('Net entries: %+d' % delta.count, fileobject)
+            self._print('Net size: %s%s' % ('-' if delta.bytes < 0 else '+', \
+                        utils.fmt_size(abs(delta.bytes))), fileobject)
+            if symbols is not None:
+                self._dump_stack(self._growth_allocation(backtrace, \
+                        delta).stack, symbols=symbols, fileobject=fileobject)
+
+    def block_index(self):
+        """Returns the blockindex.BlockIndex of the blocks of all heaps. The
+        index stored in a snapshot is used as is (it covers the heaps left
+        out by load(heaps=) too), otherwise it is built.
+        """
+        if self._blockindex is not None:
+            return self._blockindex
+        return BlockIndex.from_heaps(self._heaps)
+
+    def dump_blocks(self, addresses, symbols=None, fileobject=None):
+        """Dumps the block containing each of addresses along with the
+        stack of its trace
+        """
+        self._print('Blocks:', fileobject)
+        blocks = self.block_index().lookup(addresses)
+        if symbols is not None:
+            symbols = self.symbolize(symbols, (self._block_stack(block) \
+                            for block in blocks if block is not None))
+        for address, block in zip(addresses, blocks):
+            if block is None:
+                self._print('0x%X: no block' % address, fileobject)
+                continue
+            self._print('0x%X: [0x%X, 0x%X) +0x%X Heap @ 0x%X Traceid: 0x%x' \
+                        % (address, block.start, block.end, \
+                            address - block.start, block.handle, \
+                            block.traceid), fileobject)
+            if symbols is not None:
+                self._dump_stack(self._block_stack(block), symbols=symbols, \
+                        fileobject=fileobject)
+
+    def symbolize(self, symbols, stacks=None):
+        """Resolves the unique frames of stacks at once, each a single time
+        (see symtable). Returns the symbol table of the Backtrace, which
+        serves sym_from_addr() for its frames from then on; the table is
+        kept for further calls with the same symbols provider (or table).
+
+        |stacks|    stacks to symbolize (defaults to those of all heaps)
+        """
+        table = self._symtable
+        if table is None or (symbols is not table and \
+                                symbols is not table.symbols):
+            table = self._symtable = symtable.symbol_table(symbols)
+        if stacks is None:
+            stacks = (alloc.stack for heap in self._heaps.itervalues() \
+                        for alloc in heap.itervalues())
+        table.add(self, symtable.frames(stacks))
+        return table
+
+    def compact(self):
+        """Moves allocations into columnar storage (see store.ColumnStore).
+
+        Heaps become read-only views over flat arrays, which cuts the
+        memory footprint of large snapshots several times; alias stacks are
+        dropped.
+        """
+        for handle in self._heaps.keys():
+            self._compact_heap(handle)
+        self._allocs = store.AllocationsView(self._heaps)
+
+    def compress_duplicates(self, level, cache=None):
+        """Merges likely duplicate traces of each heap (see duplicates):
+        only the first trace of a cluster is dumped or saved afterwards,
+        along with the samples of the others.
+
+        |level|     utils.duplicate_levels; strict merges traces with a
+                    common stack prefix, aggressive similar stacks
+        |cache|     duplicates.ClusterCache to look the clusters of known
+                    stacks up in (and to add the others to)
+        """
         assert(level is not None)
-        duplicates = []
-        def aggressively(heap):
-            for pair in combinations(heap.iterkeys(), 2):
-                seq1 = heap[pair[0]]
-                seq2 = heap[pair[1]]
-                foo = difflib.SequenceMatcher(None, seq1.stack, \
-                                        seq2.stack, autojunk=False)
-                if foo.quick_ratio() > 0.88:
-                    yield pair
-
-        def strictly(heap):
-            for pair in combinations(heap.iterkeys(), 2):
-                if _quick_compare_stacks(seq1.stack, seq2.stack):
-                    yield pair
-
-        compressor = aggressively if level == \
-                        utils.duplicate_levels.aggressive else strictly
-        # FIXME maybe return a copy of Backtrace with duplicates removed
+        if level == utils.duplicate_levels.aggressive:
+            clusterfn = duplicates.similar_clusters
+        else:
+            clusterfn = duplicates.prefix_clusters
         for heap in self._heaps.itervalues():
-            if len(heap) > 0:
-                duplicates = [_ for _ in compressor(heap)]
-            if duplicates:
-                seen = set() # traces we've seen so far
-                mergeallocs = {}
-                for key, group in groupby(duplicates, \
-                                            key=operator.itemgetter(0)):
-                    #if key not in seen:
-                    #    self._uniqueallocs.update({key: self._allocs.get(key)})
-
-                    # update seen set with items that need not be repeated in
-                    # uniqueallocs
-                    tracelist = map(operator.itemgetter(1), group)
-                    seen.update(tracelist)
-                    if key not in seen:
-                        # associate each trace that makes it into uniqueallocs
-                        # with the list of its duplicate so that we can merge
-                        # allocations later
-                        mergeallocs[key] = tracelist
-                # now, accommodate all allocations that weren't flagged as duplicates
-                # into self._uniqueallocs paired with allocations from duplicates
-                uniqueallocs = set(set(self._allocs.keys()) - seen)
-                for traceid in uniqueallocs:
-                    allocs = []
-                    mergegroup = mergeallocs.get(traceid)
-                    if mergegroup:
-                        for tid in mergegroup:
-                            allocs.extend(self._allocs[tid].allocs)
-                    self._uniqueallocs[traceid] = allocs
-                #self._uniqueallocs.update({key: self._allocs[key] for key in \
-                #    self._allocs.iterkeys() if key not in seen})
-
-    def save(self, fileobject):
-        """Saves a Backtrace to fileobject in binary form"""
+            traces = ((traceid, alloc.stack) \
+                        for traceid, alloc in heap.iteritems())
+            if cache is not None:
+                clusters = cache.clusters(traces, clusterfn)
+            else:
+                clusters = clusterfn(traces)
+            for cluster in clusters:
+                allocs = self._uniqueallocs.setdefault(cluster[0], [])
+                for traceid in cluster[1:]:
+                    allocs.extend(heap[traceid].allocs)
+
+    def save(self, fileobject, version=snapshot.VERSION, compress=False, \
+                index=False):
+        """Saves a Backtrace to fileobject in binary form
+
+        |version|   binary format version; 1 selects the legacy native-size
+                    format
+        |compress|  write a compressed snapshot (several times smaller,
+                    decompressed block by block when loaded)
+        |index|     store the interval index of the blocks (see
+                    block_index())
+        """
         try:
             fileobject, close = utils.file_open(fileobject, 'wb')
-
-            fileobject.write(self.magic)
-            # modules
-            fileobject.write(struct.pack('L', len(self._modules)))
+            if version == 1:
+                self._save_legacy(fileobject)
+                return
+            writer = snapshot.SnapshotWriter(fileobject, self._source, \
+                                                compress, index)
             for m in self._modules.itervalues():
-                fileobject.write(struct.pack('LLL%ds' % len(m.ModuleName), \
-                                    m.BaseOfImage, m.SizeOfImage, \
-                                    len(m.ModuleName), m.ModuleName))
-            # heaps
-            fileobject.write(struct.pack('L', len(self._heaps)))
-            for handle, heap in self._heaps.iteritems():
-                if self._uniqueallocs:
-                    iterable = ifilter(lambda i: i[0] in self._uniqueallocs, \
-                                        heap.iteritems())
-                    numallocs = len(self._uniqueallocs)
-                else:
-                    iterable = heap.iteritems()
-                    numallocs = len(heap)
-                fileobject.write(struct.pack('LL', handle, numallocs))
-                for traceid, allocation in iterable:
-                    mergeallocs = self._uniqueallocs.get(traceid) or []
-                    numaddrs = len(allocation.allocs) + len(mergeallocs)
-                    fileobject.write(struct.pack('LLL', traceid, \
-                            len(allocation.stack), \
-                            numaddrs))
-                    # allocation
-                    for addr in allocation.stack:
-                        fileobject.write(struct.pack('L', addr))
-                    for m, sample in enumerate(chain(allocation.allocs, \
-                                                    mergeallocs)):
-                        fileobject.write(struct.pack('LLL', sample.requested, \
-                            sample.overhead, sample.address))
-                    #else:
-                    #    assert(m+1 == numallocs)
+                writer.add_module(m)
+            for handle in sorted(self._heaps):
+                writer.add_heap(handle, self._iter_unique( \
+                                                    self._heaps[handle]))
+            writer.close()
         finally:
             if close:
                 fileobject.close()
 
-    def load(self, fileobject):
+    def load(self, fileobject, heaps=None):
         """Loads a Backtrace from a binary representation.
         See self.save() for the persisting counterpart.
+        Snapshots (v2) are memory mapped and decoded on access, the legacy
+        format is read upfront.
+
+        |heaps|     handles of the heaps to load (defaults to all); other
+                    heaps are skipped w/o being decoded
         """
         try:
             fileobject, close = utils.file_open(fileobject, 'rb')
 
-            data = fileobject
-            #data = StringIO(fileobject.read())
-            if data.read(len(self.magic)) != self.magic:
+            magic = fileobject.read(len(snapshot.MAGIC))
+            if magic == snapshot.MAGIC:
+                fileobject.seek(-len(magic), os.SEEK_CUR)
+                self._snapshot = snapshot.Snapshot(fileobject, self, \
+                                                    self._stacks)
+                self._source = self._snapshot.source()
+                for m in self._snapshot.modules():
+                    self._modules.setdefault(os.path.basename(m.ModuleName), m)
+                self._heaps.update(self._snapshot.heaps(heaps))
+                # covers the blocks of all heaps, loaded or not
+                self._blockindex = self._snapshot.block_index()
+                self._allocs = store.AllocationsView(self._heaps)
+            elif magic.startswith(self.magic):
+                fileobject.seek(len(self.magic) - len(magic), os.SEEK_CUR)
+                self._load_legacy(fileobject, heaps)
+            else:
                 raise ValueError('not binary trace file')
-            dword = struct.calcsize('L')
-            # modules
-            nummodules = struct.unpack_from('L', data.read(dword))[0]
-            for i in xrange(nummodules):
-                base, size, modulenamelen = struct.unpack_from('LLL', \
-                        data.read(dword*3))
-                strfmt = '%ds' % modulenamelen
-                strlen = struct.calcsize(strfmt)
-                modulename = struct.unpack_from(strfmt, data.read(strlen))[0]
-                self._modules.setdefault(os.path.basename(modulename), \
-                                        self.module(base, size, modulename))
-            # heaps
-            numheaps = struct.unpack_from('L', data.read(dword))[0]
-            for i in xrange(numheaps):
-                handle, numallocs = struct.unpack_from('LL', data.read(dword*2))
-                heap = {}
-                for j in xrange(numallocs):
-                    traceid, stacklen, allocslen = struct.unpack_from('LLL', \
-                            data.read(dword*3))
-                    # allocation
-                    stack = []
-                    for k in xrange(stacklen):
-                        stack.append(struct.unpack_from('L', data.read(dword))[0])
-                    allocs = []
-                    for k in xrange(allocslen):
-                        allocs.append(self.sample(*struct.unpack_from('LLL', \
-                            data.read(dword*3))))
-                    allocation = self.allocation(stack=stack, aliases=[], \
-                                                    allocs=allocs)
-                    heap.setdefault(traceid, allocation)
-                    self._allocs.setdefault(traceid, allocation)
-                self._heaps.setdefault(handle, heap)
         finally:
             if close:
                 fileobject.close()
 
-    def _parse(self, f):
-        """Parse the data"""
-        line = self._parse_modules(f)
-        while line:
-            if line.startswith('*- - - - - - - - - - Heap'):
-                heaphandle = \
-                        int(self._heaphandle_re_.search(line).group(1), 16)
-                heapallocs = self._parse_heap(f)
-                self._allocs.update(heapallocs)
-                self._heaps.update({heaphandle: heapallocs})
-            line = _next_line(f)
-
-    def _parse_heap(self, f):
-        allocs = {}
-        line = _next_line(f)
-        while line:
-            m = self._allocstats_re_.search(line)
-            if m:
-                requested, overhead, addr, traceid = m.group(1, 2, 3, 4)
-                traceid = int(traceid, 16)
-                item = allocs.setdefault(traceid, None)
-                # parse allocation
-                stack, aliases = _parse_stack(f)
-                sample = self.sample(requested=int(requested, 16), \
-                                    overhead=int(overhead, 16), \
-                                    address=int(addr, 16))
-                if item:
-                    # add this allocation stats to the already existent trace
-                    # sample
-                    item.allocs.append(sample)
-                else:
-                    allocs.update({traceid: self.allocation(stack=stack, \
-                                            aliases=aliases, allocs=[sample])})
-            elif line.startswith('*- - - - - - - - - - End of data for heap'):
-                break
-            line = _next_line(f)
-        return allocs
+    def _iter_unique(self, heap):
+        """Yield (traceid, stack, samples) for traces of the heap that are
+        left after duplicate compression, sorted by trace id.
+        """
+        for traceid in sorted(heap):
+            if self._uniqueallocs and traceid not in self._uniqueallocs:
+                continue
+            allocation = heap[traceid]
+            mergeallocs = self._uniqueallocs.get(traceid) or []
+            yield (traceid, allocation.stack, \
+                    list(chain(allocation.allocs, mergeallocs)))
+
+    def _save_legacy(self, fileobject):
+        fileobject.write(self.magic)
+        # modules
+        fileobject.write(struct.pack('L', len(self._modules)))
+        for m in self._modules.itervalues():
+            fileobject.write(struct.pack('LLL%ds' % len(m.ModuleName), \
+                                m.BaseOfImage, m.SizeOfImage, \
+                                len(m.ModuleName), m.ModuleName))
+        # heaps
+        fileobject.write(struct.pack('L', len(self._heaps)))
+        for handle, heap in self._heaps.iteritems():
+            traces = list(self._iter_unique(heap))
+            fileobject.write(struct.pack('LL', handle, len(traces)))
+            for traceid, stack, samples in traces:
+                fileobject.write(struct.pack('LLL', traceid, len(stack), \
+                        len(samples)))
+                # allocation
+                for addr in stack:
+                    fileobject.write(struct.pack('L', addr))
+                for sample in samples:
+                    fileobject.write(struct.pack('LLL', sample.requested, \
+                        sample.overhead, sample.address))
+
+    def _load_legacy(self, data, heaps=None):
+        """Loads the legacy format (past the magic).
+        Traces of heaps not in |heaps| are skipped over.
+        """
+        dword = struct.calcsize('L')
+        # modules
+        nummodules = struct.unpack_from('L', data.read(dword))[0]
+        for i in xrange(nummodules):
+            base, size, modulenamelen = struct.unpack_from('LLL', \
+                    data.read(dword*3))
+            strfmt = '%ds' % modulenamelen
+            strlen = struct.calcsize(strfmt)
+            modulename = struct.unpack_from(strfmt, data.read(strlen))[0]
+            self._modules.setdefault(os.path.basename(modulename), \
+                                    self.module(base, size, modulename))
+        # heaps
+        numheaps = struct.unpack_from('L', data.read(dword))[0]
+        for i in xrange(numheaps):
+            handle, numallocs = struct.unpack_from('LL', data.read(dword*2))
+            heap = {}
+            for j in xrange(numallocs):
+                traceid, stacklen, allocslen = struct.unpack_from('LLL', \
+                        data.read(dword*3))
+                if heaps is not None and handle not in heaps:
+                    data.seek(dword * (stacklen + allocslen*3), os.SEEK_CUR)
+                    continue
+                # allocation
+                stack = []
+                for k in xrange(stacklen):
+                    stack.append(struct.unpack_from('L', data.read(dword))[0])
+                allocs = []
+                for k in xrange(allocslen):
+                    allocs.append(self.sample(*struct.unpack_from('LLL', \
+                        data.read(dword*3))))
+                allocation = self.allocation( \
+                        stack=self._stacks.stack(stack), aliases=[], \
+                        allocs=allocs)
+                heap.setdefault(traceid, allocation)
+                self._allocs.setdefault(traceid, allocation)
+            if heaps is None or handle in heaps:
+                self._heaps.setdefault(handle, heap)
 
-    def _parse_modules(self, f):
-        line = f.readline()
-        # rewind to module list
-        while line and 'Base Size Module' not in line:
-            line = f.readline()
-        # set ptr on the first module
-        line = f.readline()
-        while line and not line.startswith('*-'):
-            m = self._module_re_.search(line)
-            if m:
-                address, size, path = m.group(1, 2, 3)
-                self._modules.update( \
-                    {os.path.basename(path): \
-                            self.module(BaseOfImage=int(address, 16), \
-                                        SizeOfImage=int(size, 16), \
-                                        ModuleName=path) \
-                    })
-            line = f.readline()
-        return line
+    def _parse(self, f, fast=False, columnar=False):
+        """Parse the data"""
+        heaps = []
+        # the heap being built (columnar); UMDH dumps a heap in one piece
+        builder = current = None
+        if columnar:
+            self._store = store.ColumnStore(self)
+        for heaphandle, traceid, allocation in iter_allocations(f, \
+                self._modules, heaps, fast):
+            if columnar:
+                if heaphandle != current:
+                    if builder is not None:
+                        self._heaps[current] = builder.finish()
+                    if heaphandle in self._heaps:
+                        raise ValueError('Heap 0x%X dumped twice' % \
+                                            heaphandle)
+                    builder = store.HeapBuilder(self._store)
+                    current = heaphandle
+                builder.add(traceid, allocation)
+                continue
+            heap = self._heaps.setdefault(heaphandle, {})
+            item = heap.get(traceid)
+            if item:
+                # add this allocation stats to the already existent trace
+                # sample
+                item.allocs.extend(allocation.allocs)
+            else:
+                heap[traceid] = allocation = self._intern(allocation)
+                self._allocs[traceid] = allocation
+        if builder is not None:
+            self._heaps[current] = builder.finish()
+        for heaphandle in heaps:
+            # keep empty heaps around
+            self._heaps.setdefault(heaphandle, {})
+        if columnar:
+            self.compact()
+
+    def _intern(self, allocation):
+        """Returns allocation with its stacks interned"""
+        return allocation._replace(stack=self._stacks.stack(allocation.stack), \
+                aliases=map(self._stacks.stack, allocation.aliases))
+
+    def _compact_heap(self, handle):
+        if self._store is None:
+            self._store = store.ColumnStore(self)
+        heap = self._heaps[handle]
+        if isinstance(heap, dict):
+            self._heaps[handle] = self._store.add_heap(handle, heap)
+
+    def _block_stack(self, block):
+        """Stack of the trace of a block (see dump_blocks())"""
+        heap = self._heaps.get(block.handle)
+        if heap is None:
+            # a heap left out by load(heaps=), the stored index covers it
+            heap = self._snapshot.heaps([block.handle])[block.handle]
+        return heap[block.traceid].stack
+
+    def _growth_allocation(self, backtrace, delta):
+        """Allocation of a delta: the newer one unless the trace is gone"""
+        heap = backtrace._heaps.get(delta.handle)
+        if heap is not None and delta.traceid in heap:
+            return heap[delta.traceid]
+        return self._heaps[delta.handle][delta.traceid]
+
+    def _symbolized(self, items, symbols):
+        """Yields items ((traceid, allocation)) symbolizing their stacks a
+        batch at a time (see symbolize())
+        """
+        items = iter(items)
+        while True:
+            batch = list(islice(items, _DUMP_BATCH))
+            if not batch:
+                return
+            if symbols is not None:
+                self.symbolize(symbols, (alloc.stack for _, alloc in batch))
+            for item in batch:
+                yield item
 
     def _dump_stack(self, stack, symbols=None, fileobject=None):
         """Dump stack for the specified allocation."""
@@ -442,6 +890,21 @@ class Backtrace(object):
         fileobject.write(message + '\n')
 
 
+def load_backtrace(path, stacks=None):
+    """Loads a binary snapshot or parses a log (into columnar storage),
+    whichever path holds.
+
+    |stacks|    store.StackTable to load the snapshot with
+    """
+    with open(path, 'rb') as f:
+        binary = snapshot.is_snapshot(f) or \
+                    f.read(len(Backtrace.magic)) == Backtrace.magic
+    if binary:
+        trace = Backtrace(stacks=stacks)
+        trace.load(path)
+        return trace
+    return Backtrace(path, fast=True, columnar=True, stacks=stacks)
+
 if __name__ == '__main__':
     if not sys.argv[1:]:
         print 'Syntax: backtrace[.py] datafile [sym-cache]'
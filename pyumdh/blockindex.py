@@ -0,0 +1,194 @@
+# vim:ts=4:sw=4:expandtab
+"""Interval index of the live blocks of a snapshot.
+
+Every sample is a block [address, address + requested + overhead) of some
+trace in some heap. The index keeps the blocks of all heaps as columns
+sorted by start address:
+
+    starts      first address of the block
+    ends        address past the block
+    maxends     largest end of the blocks up to this one
+    handles     heap of the block
+    traceids    trace of the block
+
+Live blocks do not overlap, so ends are sorted too and a point or range
+query is a bisection of starts. maxends keeps the queries exact should
+blocks overlap all the same (e.g. a snapshot of a heap being modified):
+a block before the bisection point can only contain an address below its
+maxend.
+
+The columns are written to binary snapshots (see snapshot.SnapshotWriter)
+and viewed in place once the file is mapped, so loading the index costs
+nothing. With numpy, lookup() resolves many addresses in one searchsorted.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import izip
+from pyumdh.heapdiff import columns, column_array, column_list
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['block', 'BlockIndex', 'index_columns']
+
+block = namedtuple('block', 'start end handle traceid')
+
+
+def index_columns(starts, ends, handles, traceids):
+    """Sorts the blocks given as columns by (start, end). Returns the
+    (starts, ends, maxends, handles, traceids) columns of an index as
+    numpy arrays if numpy is available, lists otherwise.
+    """
+    if numpy is not None:
+        starts, ends, handles, traceids = map(column_array, (starts, ends, \
+                                                handles, traceids))
+        order = numpy.lexsort((ends, starts))
+        ends = ends[order]
+        maxends = numpy.maximum.accumulate(ends) if len(ends) else ends
+        return (starts[order], ends, maxends, handles[order], \
+                traceids[order])
+    rows = sorted(izip(*map(column_list, (starts, ends, handles, traceids))))
+    maxends, maxend = ([], 0)
+    for _, end, _, _ in rows:
+        maxend = max(maxend, end)
+        maxends.append(maxend)
+    starts, ends, handles, traceids = (map(list, izip(*rows)) if rows else \
+                                        ([], [], [], []))
+    return (starts, ends, maxends, handles, traceids)
+
+
+class BlockIndex(object):
+    """Sorted interval index of the blocks of a snapshot.
+
+    |starts|, |ends|, |maxends|, |handles|, |traceids|
+                columns as returned by index_columns(); sequences of ints
+                or snapshot.QwordViews
+    """
+    def __init__(self, starts, ends, maxends, handles, traceids):
+        self._starts = starts
+        self._ends = ends
+        self._maxends = maxends
+        self._handles = handles
+        self._traceids = traceids
+
+    @classmethod
+    def from_heaps(cls, heaps):
+        """Builds the index of a dict of handle -> heap"""
+        starts, ends, handles, traceids = ([], [], [], [])
+        for handle in sorted(heaps):
+            heaptraceids, sampoff, requested, overhead, address = \
+                    columns(heaps[handle])
+            if numpy is not None:
+                address = column_array(address)
+                starts.append(address)
+                ends.append(address + column_array(requested) + \
+                                column_array(overhead))
+                handles.append(numpy.repeat(numpy.uint64(handle), \
+                                            len(address)))
+                traceids.append(numpy.repeat(column_array(heaptraceids), \
+                        numpy.diff(column_array(sampoff)).astype(numpy.intp)))
+                continue
+            heaptraceids, sampoff, requested, overhead, address = \
+                    map(column_list, (heaptraceids, sampoff, requested, \
+                                        overhead, address))
+            starts.extend(address)
+            ends.extend(a + r + o for a, r, o in \
+                            izip(address, requested, overhead))
+            handles.extend([handle] * len(address))
+            for i, traceid in enumerate(heaptraceids):
+                traceids.extend([traceid] * (sampoff[i+1] - sampoff[i]))
+        if numpy is not None:
+            starts, ends, handles, traceids = [numpy.concatenate(c) if c \
+                    else [] for c in (starts, ends, handles, traceids)]
+        return cls(*index_columns(starts, ends, handles, traceids))
+
+    def __len__(self):
+        return len(self._starts)
+
+    def columns(self):
+        """Returns the (starts, ends, maxends, handles, traceids) columns"""
+        return (self._starts, self._ends, self._maxends, self._handles, \
+                self._traceids)
+
+    def _block(self, row):
+        return block(int(self._starts[row]), int(self._ends[row]), \
+                        int(self._handles[row]), int(self._traceids[row]))
+
+    def _arrays(self):
+        """Returns the columns as numpy arrays or None w/o numpy"""
+        if numpy is None:
+            return None
+        arrays = [getattr(c, 'array', c) for c in self.columns()]
+        if not all(isinstance(c, numpy.ndarray) for c in arrays):
+            return None
+        return arrays
+
+    def _find(self, address, row):
+        """Returns the row of a block containing address at or before row
+        (the last block starting at or below address), None if there is none
+        """
+        while row >= 0 and self._maxends[row] > address:
+            if self._ends[row] > address:
+                return row
+            row -= 1
+        return None
+
+    def find(self, address):
+        """Returns the block containing address or None"""
+        if self._arrays() is not None:
+            return self.lookup([address])[0]
+        row = self._find(address, bisect_right(self._starts, address) - 1)
+        return self._block(row) if row is not None else None
+
+    def lookup(self, addresses):
+        """Returns the block containing each of addresses (None for
+        addresses outside of any block)
+        """
+        arrays = self._arrays()
+        if arrays is None:
+            return map(self.find, addresses)
+        starts, ends, maxends, handles, traceids = arrays
+        addresses = column_array(addresses)
+        if not len(starts):
+            return [None] * len(addresses)
+        rows = numpy.searchsorted(starts, addresses, side='right') - 1
+        valid = rows >= 0
+        clipped = numpy.where(valid, rows, 0)
+        hit = valid & (ends[clipped] > addresses)
+        # the block before the bisection point ends too early, an earlier
+        # one might still hold the address (overlapping blocks only)
+        for i in numpy.flatnonzero(valid & ~hit & \
+                                    (maxends[clipped] > addresses)).tolist():
+            row = self._find(int(addresses[i]), int(rows[i]) - 1)
+            if row is not None:
+                clipped[i], hit[i] = (row, True)
+        found = [None] * len(addresses)
+        hits = numpy.flatnonzero(hit)
+        rows = clipped[hits]
+        for i, start, end, handle, traceid in izip(hits.tolist(), \
+                starts[rows].tolist(), ends[rows].tolist(), \
+                handles[rows].tolist(), traceids[rows].tolist()):
+            found[i] = block(start, end, handle, traceid)
+        return found
+
+    def overlapping(self, first, last):
+        """Returns the blocks overlapping addresses [first, last) sorted by
+        start address
+        """
+        arrays = self._arrays()
+        if arrays is not None:
+            starts, ends, maxends, handles, traceids = arrays
+            row = int(numpy.searchsorted(maxends, numpy.uint64(first), \
+                                            side='right'))
+            end = int(numpy.searchsorted(starts, numpy.uint64(last)))
+            rows = row + numpy.flatnonzero(ends[row:end] > \
+                                            numpy.uint64(first))
+            return [block(*values) for values in izip(starts[rows].tolist(), \
+                    ends[rows].tolist(), handles[rows].tolist(), \
+                    traceids[rows].tolist())]
+        row = bisect_right(self._maxends, first)
+        end = bisect_left(self._starts, last)
+        return [self._block(i) for i in xrange(row, end) \
+                    if self._ends[i] > first]
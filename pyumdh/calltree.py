@@ -0,0 +1,198 @@
+# vim:ts=4:sw=4:expandtab
+"""Call tree of the allocations of a snapshot or a diff.
+
+The stacks of all traces are merged into a tree, either top-down - from the
+thread entry points to the allocators, the way flame graphs draw them - or
+bottom-up - from the allocators outwards, to see who calls them most. Every
+node carries the blocks and bytes (requested + overhead) of the traces
+through it (inclusive) and of those whose stack ends there (exclusive).
+
+Stacks are interned (see store.StackTable), so traces are summed per stack
+first. The paths (stacks in the order of the tree) are then sorted, which
+is the depth first order of the tree: a path only adds nodes for the frames
+past its common prefix with the path before (see duplicates), and the
+inclusive totals are summed up in one pass over the nodes in reverse.
+Nodes are kept as columns indexed by node id, the root being node 0:
+
+    parents     node id of the caller (callee bottom-up); -1 for the root
+    frames      frame address; None for the root
+    counts      blocks of the traces through the node
+    bytes       bytes of the traces through the node
+    selfcounts  blocks of the traces ending at the node
+    selfbytes   bytes of the traces ending at the node
+
+Frames are symbolized once each, and only when the tree is dumped or folded:
+all of them at once (see Backtrace.symbolize()).
+
+folded() exports folded stacks, the input of flamegraph.pl:
+
+    ntdll.dll!RtlUserThreadStart;app.exe!main;MSVCR90.dll!malloc 4096
+"""
+
+import ntpath
+from itertools import ifilter, izip
+from pyumdh.duplicates import common_prefix
+from pyumdh.heapdiff import column_list
+
+__all__ = ['CallTree']
+
+
+class CallTree(object):
+    """Call tree of the traces of a Backtrace (see above for its columns).
+
+    |bottomup|  root the tree at the allocation points rather than at the
+                thread entry points
+    |handle|    heap to aggregate (defaults to all)
+    |grepfn|    filter to run on allocations
+                must comply to the filter protocol
+    """
+    def __init__(self, backtrace, bottomup=False, handle=None, grepfn=None):
+        self._backtrace = backtrace
+        self.bottomup = bottomup
+        # stack -> [blocks, bytes]
+        self._stacks = {}
+        heaps = backtrace._heaps.iteritems() if handle is None else \
+                    [(handle, backtrace._heaps[handle])]
+        for _, heap in heaps:
+            items = heap.iteritems()
+            if grepfn:
+                items = ifilter(grepfn, items)
+            for _, alloc in items:
+                stack = tuple(alloc.stack)
+                totals = self._stacks.get(stack)
+                if totals is None:
+                    totals = self._stacks[stack] = [0, 0]
+                totals[0] += len(alloc.allocs)
+                totals[1] += sum(s.requested + s.overhead \
+                                    for s in alloc.allocs)
+        self.parents, self.frames = ([-1], [None])
+        self.selfcounts, self.selfbytes = ([0], [0])
+        # stacks list the allocation point first
+        paths = sorted((stack if bottomup else stack[::-1], totals) \
+                        for stack, totals in self._stacks.iteritems())
+        # nodes of the frames of the last path
+        trail = [0]
+        previous = ()
+        for path, (count, size) in paths:
+            del trail[common_prefix(previous, path) + 1:]
+            for frame in path[len(trail) - 1:]:
+                self.parents.append(trail[-1])
+                self.frames.append(frame)
+                self.selfcounts.append(0)
+                self.selfbytes.append(0)
+                trail.append(len(self.frames) - 1)
+            self.selfcounts[trail[-1]] += count
+            self.selfbytes[trail[-1]] += size
+            previous = path
+        self.counts, self.bytes = (list(self.selfcounts), \
+                                    list(self.selfbytes))
+        # children come after their parents
+        for node in xrange(len(self.parents) - 1, 0, -1):
+            parent = self.parents[node]
+            self.counts[parent] += self.counts[node]
+            self.bytes[parent] += self.bytes[node]
+        self._names, self._symbols = ({}, None)
+
+    def __len__(self):
+        """Returns the number of distinct stacks"""
+        return len(self._stacks)
+
+    def frame_name(self, frame, symbols=None):
+        """Returns module!symbol of a frame (module+offset w/o symbols)"""
+        if symbols is not self._symbols:
+            # names are cached per symbol provider
+            self._names, self._symbols = ({}, symbols)
+        name = self._names.get(frame)
+        if name is None:
+            if symbols is not None:
+                symbol, _, modulename = symbols.sym_from_addr( \
+                                            self._backtrace, frame)
+                modulename = ntpath.basename(modulename or '')
+                name = '%s!%s' % (modulename, symbol) if symbol else \
+                        modulename or '0x%x' % frame
+            else:
+                name = self._offset_name(frame, \
+                                    self._backtrace.map_to_module(frame))
+            # ; separates frames in folded stacks
+            name = self._names[frame] = name.replace(';', ':')
+        return name
+
+    def _offset_name(self, frame, module):
+        if module is None:
+            return '0x%x' % frame
+        return '%s+0x%x' % (ntpath.basename(module.ModuleName), \
+                            frame - module.BaseOfImage)
+
+    def _symbolize(self, symbols):
+        """Names all frames at once: symbolizes them (see
+        Backtrace.symbolize()) or maps them to their modules w/o symbols
+        """
+        if symbols is not None:
+            return self._backtrace.symbolize(symbols, [self.frames[1:]])
+        if self._symbols is not None:
+            self._names, self._symbols = ({}, None)
+        index = self._backtrace.module_index()
+        frames = [frame for frame in set(self.frames[1:]) \
+                    if frame not in self._names]
+        for frame, moduleid in izip(frames, \
+                                    column_list(index.module_ids(frames))):
+            module = index.modules[moduleid] if moduleid >= 0 else None
+            self._names[frame] = self._offset_name(frame, module) \
+                                    .replace(';', ':')
+        return None
+
+    def folded(self, symbols=None, metric='bytes'):
+        """Returns folded stacks (root first, see above) sorted by stack;
+        stacks that symbolize alike are merged.
+
+        |metric|    'bytes' or 'count' (blocks)
+        """
+        field = 0 if metric == 'count' else 1
+        symbols = self._symbolize(symbols)
+        names = dict((frame, self.frame_name(frame, symbols)) \
+                        for frame in set(self.frames[1:]))
+        folded = {}
+        for stack, totals in self._stacks.iteritems():
+            line = ';'.join(map(names.__getitem__, reversed(stack))) or \
+                    '[unknown]'
+            folded[line] = folded.get(line, 0) + totals[field]
+        return ['%s %d' % item for item in sorted(folded.iteritems()) \
+                    if item[1]]
+
+    def dump_folded(self, symbols=None, metric='bytes', fileobject=None):
+        """Writes folded stacks (see folded()), a line each"""
+        for line in self.folded(symbols, metric):
+            self._backtrace._print(line, fileobject)
+
+    def children(self):
+        """Returns the list of child node ids of every node"""
+        children = [[] for _ in xrange(len(self.parents))]
+        for node in xrange(1, len(self.parents)):
+            children[self.parents[node]].append(node)
+        return children
+
+    def dump(self, symbols=None, threshold=0.01, fileobject=None):
+        """Dumps the tree, children by inclusive bytes; subtrees holding
+        less than |threshold| of all bytes are left out
+        """
+        print_ = self._backtrace._print
+        symbols = self._symbolize(symbols)
+        minbytes = self.bytes[0] * threshold
+        print_('Call tree (%s): %d blocks, %d bytes' % ('bottom-up' if \
+                self.bottomup else 'top-down', self.counts[0], \
+                self.bytes[0]), fileobject)
+        children = self.children()
+        # the largest child last, to be popped first
+        order = lambda node: sorted(children[node], \
+                                    key=lambda n: (self.bytes[n], n))
+        pending = [(child, 1) for child in order(0)]
+        while pending:
+            node, depth = pending.pop()
+            if self.bytes[node] < minbytes:
+                continue
+            print_('%s%s [%d bytes, %d blocks, self %d bytes, %d blocks]' % \
+                    ('  ' * depth, self.frame_name(self.frames[node], \
+                        symbols), self.bytes[node], self.counts[node], \
+                        self.selfbytes[node], self.selfcounts[node]), \
+                    fileobject)
+            pending.extend((child, depth + 1) for child in order(node))
@@ -34,8 +34,11 @@ WORK_DIR = 'data'
 # This is an optimization that will compress likely duplicate traces into a
 # single trace
 # Possible values are:
-#   'strict'        - faster compression mode that tolerates up to 30% on top
-#   'aggressive'
+#   'strict'        - merges traces sharing at least 70% of the longer stack
+#                     (from the allocation point outwards) with the first
+#                     trace of a group
+#   'aggressive'    - merges traces whose stacks have 88% of their frames in
+#                     common, wherever they differ
 #   '' or None      - switches duplicate compression off
 COMPRESS_DUPLICATES = 'aggressive'
 
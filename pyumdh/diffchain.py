@@ -0,0 +1,334 @@
+# vim:ts=4:sw=4:expandtab
+"""Diffs between any two snapshots of a series composed of cached steps.
+
+Every pair of consecutive snapshots k, k+1 is compared once and the step is
+cached next to the newer snapshot as two binary snapshots (see snapshot):
+
+    <k>-<k+1>.added.bin     blocks of k+1 missing from k
+    <k>-<k+1>.freed.bin     blocks of k missing from k+1
+
+Each of them lists every heap of its snapshot (the empty ones too) and is
+stamped with the source stamps of both snapshots, so steps of snapshots that
+have changed since are recomputed.
+
+The diff i -> j is composed by replaying steps i .. j-1 over the blocks new
+since i: blocks added by a step join them unless the step brings back a
+block of i, blocks freed by a step leave them. What is left are the blocks
+of j missing from i, i.e. what Backtrace.diff_with() reports; snapshots i
+and j themselves are only looked up (trace ids, stacks), never compared.
+lookup_snapshot() reads no more of them than that.
+"""
+
+import os
+import pyumdh.heapdiff as heapdiff
+import pyumdh.snapshot as snapshot
+import pyumdh.utils as utils
+from pyumdh.backtrace import Backtrace, load_backtrace
+from pyumdh.store import StackTable
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['DiffChain', 'step_paths', 'lookup_snapshot']
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def step_paths(old, new):
+    """Returns the paths of the cached (added, freed) step old -> new"""
+    prefix = os.path.join(os.path.dirname(os.path.abspath(new)), \
+                            '%s-%s' % (_stem(old), _stem(new)))
+    return (prefix + '.added.bin', prefix + '.freed.bin')
+
+def lookup_snapshot(path, stacks=None):
+    """Returns a Backtrace of a binary snapshot holding the modules and the
+    trace ids of each heap (as a frozenset) only - what DiffChain.diff()
+    looks the snapshots up for - w/o decoding any allocation.
+
+    |stacks|    store.StackTable the diff is to intern its stacks with
+    """
+    trace = Backtrace(stacks=stacks)
+    with open(path, 'rb') as f:
+        s = snapshot.Snapshot(f, Backtrace)
+    try:
+        for m in s.modules():
+            trace._modules.setdefault(os.path.basename(m.ModuleName), m)
+        for handle, first, count in s.directory():
+            trace._heaps[handle] = frozenset(s.trace_ids(first, count))
+    finally:
+        s.close()
+    return trace
+
+def _step_heap(old, new):
+    """Yields (traceid, stack, samples) of the blocks of heap new missing
+    from heap old, sorted by trace id
+    """
+    added, grown = heapdiff.diff_heap(old, new)
+    grown = dict(grown)
+    for traceid in sorted(added + grown.keys()):
+        allocation = new[traceid]
+        samples = grown.get(traceid)
+        if samples is None:
+            samples = heapdiff.unique_samples(map(tuple, allocation.allocs))
+        yield (traceid, list(allocation.stack), samples)
+
+def _events(s, handle, row, count, step, added, source):
+    """Returns a row per sample of the heap of a step file: handle, traceid,
+    address, requested, overhead, step, added, source snapshot and row of
+    the trace
+    """
+    traceids, sampoff, requested, overhead, address = s.columns(row, \
+                                                                row + count)
+    counts = numpy.diff(sampoff).astype(numpy.intp)
+    events = numpy.empty((len(address), 9), dtype=numpy.uint64)
+    events[:, 0] = handle
+    events[:, 1] = numpy.repeat(traceids, counts)
+    events[:, 2] = address
+    events[:, 3] = requested
+    events[:, 4] = overhead
+    events[:, 5:8] = (step, added, source)
+    events[:, 8] = numpy.repeat(numpy.arange(row, row + count, \
+                                    dtype=numpy.uint64), counts)
+    return events
+
+def _write_step(fileobject, old, new, stamp):
+    """Writes the blocks of new missing from old (both Backtraces)"""
+    writer = snapshot.SnapshotWriter(fileobject, stamp)
+    for m in new._modules.itervalues():
+        writer.add_module(m)
+    for handle in sorted(new._heaps):
+        writer.add_heap(handle, _step_heap(old._heaps.get(handle, {}), \
+                                            new._heaps[handle]))
+    writer.close()
+
+
+class DiffChain(object):
+    """Cached steps between consecutive snapshots of a series.
+
+    |paths|     snapshots (logs or binary snapshots) in the order they were
+                taken
+    |load|      callable loading a snapshot from its path (defaults to
+                backtrace.load_backtrace()); used for steps not cached yet
+    """
+    def __init__(self, paths, load=None):
+        self._paths = list(paths)
+        self._load = load or load_backtrace
+        self._stamps = {}
+
+    def __len__(self):
+        return len(self._paths)
+
+    def _stamp(self, k):
+        path = self._paths[k]
+        if path not in self._stamps:
+            self._stamps[path] = snapshot.source_stamp(path)
+        return self._stamps[path]
+
+    def _step_stamp(self, k):
+        return self._stamp(k) + self._stamp(k + 1)
+
+    def is_cached(self, k):
+        """Checks if step k -> k+1 is cached for the current snapshots"""
+        stamp = self._step_stamp(k)
+        for path in step_paths(self._paths[k], self._paths[k+1]):
+            try:
+                with open(path, 'rb') as f:
+                    if snapshot.read_stamp(f) != stamp:
+                        return False
+            except IOError:
+                return False
+        return True
+
+    def update(self, first=0, last=None):
+        """Computes the steps between snapshots first .. last missing from
+        the cache. Returns the number of steps computed.
+        """
+        last = len(self) - 1 if last is None else last
+        computed = 0
+        traces = {}
+        stacks = StackTable()
+        for k in xrange(first, last):
+            if self.is_cached(k):
+                continue
+            for i in (k, k + 1):
+                if i not in traces:
+                    traces[i] = self._load(self._paths[i], stacks)
+            old, new = (traces[k], traces[k+1])
+            stamp = self._step_stamp(k)
+            added, freed = step_paths(self._paths[k], self._paths[k+1])
+            with utils.atomic_file(added) as f:
+                _write_step(f, old, new, stamp)
+            with utils.atomic_file(freed) as f:
+                _write_step(f, new, old, stamp)
+            # snapshots before k+1 are not needed any more
+            for i in traces.keys():
+                if i <= k:
+                    del traces[i]
+            computed += 1
+        return computed
+
+    def _step(self, k):
+        """Returns (added, freed) of step k -> k+1 as dicts of handle ->
+        {traceid: (stack, samples)}
+        """
+        step = []
+        for path in step_paths(self._paths[k], self._paths[k+1]):
+            with open(path, 'rb') as f:
+                s = snapshot.Snapshot(f, Backtrace)
+                heaps = {}
+                for handle, first, count in s.directory():
+                    heaps[handle] = dict((traceid, (stack, samples)) for \
+                            traceid, stack, samples in \
+                            s.iter_traces(first, count))
+                s.close()
+            step.append(heaps)
+        return step
+
+    def blocks(self, first, last):
+        """Returns the blocks of snapshot last missing from snapshot first
+        as a dict of handle -> {traceid: (stack, samples)}, samples sorted by
+        address; the steps in between must be cached (see update())
+        """
+        if numpy is not None:
+            return self._blocks_numpy(first, last)
+        return self._blocks_python(first, last)
+
+    def _blocks_numpy(self, first, last):
+        """A block is new since first iff the first step that touches it
+        adds it (blocks of first can only be freed first) and so does the
+        last one. All events are sorted by block and step at once.
+        """
+        files, snapshots, events = ([], [], [])
+        try:
+            for k in xrange(first, last):
+                for added, path in zip((1, 0), step_paths(self._paths[k], \
+                                                        self._paths[k+1])):
+                    f = open(path, 'rb')
+                    files.append(f)
+                    s = snapshot.Snapshot(f, Backtrace)
+                    snapshots.append(s)
+                    for handle, row, count in s.directory():
+                        if count:
+                            events.append(_events(s, handle, row, count, \
+                                            k, added, len(snapshots) - 1))
+            if not events:
+                return {}
+            events = numpy.concatenate(events)
+            # handle, traceid, address, requested, overhead, step
+            events = events[numpy.lexsort(events[:, [5, 4, 3, 2, 1, 0]].T)]
+            bounds = numpy.flatnonzero((events[1:, :5] != \
+                                        events[:-1, :5]).any(axis=1)) + 1
+            starts = numpy.concatenate(([0], bounds))
+            ends = numpy.concatenate((bounds, [len(events)])) - 1
+            keep = (events[starts, 6] == 1) & (events[ends, 6] == 1)
+            events = events[ends[keep]]
+            heaps = {}
+            blocks = events[:, :5].tolist()
+            for i, (handle, traceid, address, requested, overhead) in \
+                    enumerate(blocks):
+                heap = heaps.setdefault(handle, {})
+                trace = heap.get(traceid)
+                if trace is None:
+                    # the stack as of the last step adding the block
+                    s = snapshots[int(events[i, 7])]
+                    row = int(events[i, 8])
+                    stackoff = int(s.stackoff.array[row])
+                    stack = s.frames.tolist(stackoff, \
+                                    stackoff + int(s.stacklen.array[row]))
+                    trace = heap[traceid] = (stack, [])
+                trace[1].append((requested, overhead, address))
+            return heaps
+        finally:
+            for s in snapshots:
+                s.close()
+            for f in files:
+                f.close()
+
+    def _blocks_python(self, first, last):
+        live = {}
+        # blocks of first freed by the steps so far
+        gone = {}
+        for k in xrange(first, last):
+            added, freed = self._step(k)
+            for handle, traces in freed.iteritems():
+                heap = live.get(handle, {})
+                heapgone = gone.setdefault(handle, {})
+                for traceid, (_, samples) in traces.iteritems():
+                    samples = set(samples)
+                    if traceid in heap:
+                        blocks = heap[traceid][1]
+                        samples, freedblocks = (samples - blocks, samples)
+                        blocks -= freedblocks
+                        if not blocks:
+                            del heap[traceid]
+                    if samples:
+                        heapgone.setdefault(traceid, set()).update(samples)
+            for handle, traces in added.iteritems():
+                heap = live.setdefault(handle, {})
+                heapgone = gone.get(handle, {})
+                for traceid, (stack, samples) in traces.iteritems():
+                    samples = set(samples)
+                    if traceid in heapgone:
+                        # blocks of first that are back
+                        back = heapgone[traceid] & samples
+                        heapgone[traceid] -= back
+                        samples -= back
+                    if not samples:
+                        continue
+                    if traceid in heap:
+                        heap[traceid] = (stack, heap[traceid][1] | samples)
+                    else:
+                        heap[traceid] = (stack, samples)
+        for heap in live.itervalues():
+            for traceid, (stack, samples) in heap.items():
+                heap[traceid] = (stack, sorted(samples, \
+                                    key=lambda s: (s[2], s[0], s[1])))
+        return live
+
+    def diff(self, old, new, first=0, last=None, grepfn=None):
+        """Composes the diff of snapshot first to snapshot last from cached
+        steps (computing the missing ones) and returns it as
+        Backtrace.diff_with() does. Samples are sorted by address and
+        grepfn sees the stack and the new samples of grown traces rather
+        than all their samples.
+
+        |old|, |new|    Backtraces of snapshots first and last; only their
+                        heap handles and the trace ids of old are looked up
+                        (see lookup_snapshot())
+        |grepfn|        filter to run on allocations
+                        must comply to the filter protocol
+        """
+        last = len(self) - 1 if last is None else last
+        self.update(first, last)
+        if not grepfn:
+            grepfn = bool
+        diff = Backtrace(stacks=new._stacks)
+        diff._modules = new._modules
+        for handle, traces in self.blocks(first, last).iteritems():
+            heap, otherheap = (old._heaps.get(handle), new._heaps.get(handle))
+            if heap is None or not otherheap or not traces:
+                continue
+            if not isinstance(heap, (dict, frozenset)):
+                # a set of the trace ids beats looking them up one by one
+                heap = set(heapdiff.column_list(heapdiff.columns(heap)[0]))
+            diffallocs, grown = ({}, {})
+            for traceid, (stack, samples) in traces.iteritems():
+                alloc = Backtrace.allocation(stack=diff._stacks.stack(stack), \
+                        aliases=[], allocs=[Backtrace.sample(*s) \
+                                            for s in samples])
+                if traceid not in heap:
+                    if grepfn((traceid, alloc)):
+                        diffallocs[traceid] = alloc
+                # skip over this trace if the grep is negative
+                elif grepfn((None, alloc)):
+                    grown[traceid] = alloc
+            if not diffallocs:
+                # do not persist an empty heap
+                continue
+            diff._allocs.update(diffallocs)
+            diff._allocs.update(grown)
+            diffallocs.update(grown)
+            diff._heaps[handle] = diffallocs
+        return diff
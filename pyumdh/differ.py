@@ -4,13 +4,23 @@
 
 from multiprocessing import Pool, cpu_count, freeze_support
 import pyumdh.config as config
+from pyumdh.calltree import CallTree
+from pyumdh.diffchain import DiffChain, lookup_snapshot
+from pyumdh.duplicates import ClusterCache
 from pyumdh.backtrace import Backtrace
+import pyumdh.parallel as parallel
+import pyumdh.snapshot as snapshot
+from pyumdh.streamdiff import StreamingDiff
+from pyumdh.store import StackTable
+import pyumdh.trend as trend
 from pyumdh.utils import SymProxy
 from pyumdh.symprovider import symbols
 from pyumdh.filters import filter_on_foreign_module, grep_filter
 import pyumdh.utils as utils
 from optparse import OptionParser
 from fnmatch import fnmatch
+from functools import partial
+from glob import glob
 import imp
 import logging
 import operator
@@ -24,38 +34,132 @@ def _binary_backtrace_path(filepath):
     binfn = '%s.bin' % binfn[:-4]
     return os.path.abspath(os.path.join(os.path.dirname(filepath), binfn))
 
-def _generate_binary_backtrace(datafile):
-    binpath = _binary_backtrace_path(datafile)
-    if not os.path.exists(binpath):
-        trace = Backtrace(datafile)
-        trace.save(binpath)
+def _is_binary_up_to_date(datafile):
+    """Checks if the binary backtrace of datafile was converted from its
+    current contents.
+    """
+    try:
+        with open(_binary_backtrace_path(datafile), 'rb') as f:
+            stamp = snapshot.read_stamp(f)
+    except IOError:
+        return False
+    return stamp is not None and stamp == snapshot.source_stamp(datafile)
+
+def _generate_binary_backtrace(datafile, processes=None, compress=False):
+    """Converts datafile unless its binary backtrace is up-to-date.
+    Returns True if the file has been converted.
+
+    |compress|  write a compressed snapshot
+    """
+    if _is_binary_up_to_date(datafile):
+        return False
+    # a half-written file never takes the place of the binary backtrace
+    with utils.atomic_file(_binary_backtrace_path(datafile)) as f:
+        # a single log is split across all cores
+        parallel.convert(datafile, f, processes, compress=compress)
+    return True
 
-def _load_binary_backtrace(datafile):
-    trace = Backtrace()
+def _generate_binary_backtrace_serially(datafile, compress=False):
+    return _generate_binary_backtrace(datafile, processes=1, \
+                                        compress=compress)
+
+def _load_binary_backtrace(datafile, stacks=None):
+    trace = Backtrace(stacks=stacks)
     trace.load(_binary_backtrace_path(datafile))
     return trace
 
 def _is_backtrace_binary(datafile):
+    datafile, close = utils.file_open(datafile, 'rb')
     try:
-        if isinstance(datafile, basestring):
-            close = True
-            datafile = io.open(datafile, 'rb')
-        if datafile.read(len(Backtrace.magic)) != magic:
-            return False
-        return True
+        if snapshot.is_snapshot(datafile):
+            return True
+        return datafile.read(len(Backtrace.magic)) == Backtrace.magic
     finally:
         if close:
             datafile.close()
 
-def _load_backtraces(tracefiles):
+def _load_backtraces(tracefiles, compress=False):
     """Helper to load trace logs from original or binary store.
     It assumes that (trace) binary representation files end with `.bin'
     """
-    p = Pool(len(tracefiles) if len(tracefiles) < cpu_count() else None)
-    p.map(_generate_binary_backtrace, tracefiles)
-    p.close()
-    p.join()
-    return map(_load_binary_backtrace, tracefiles)
+    _convert_logs(tracefiles, compress)
+    # snapshots of a process share most of their stacks
+    stacks = StackTable()
+    return [_load_binary_backtrace(tracefile, stacks) \
+                for tracefile in tracefiles]
+
+def _lookup_backtraces(tracefiles, compress=False):
+    """Converts trace logs as _load_backtraces() does but reads only their
+    modules and trace ids (see diffchain.lookup_snapshot())
+    """
+    _convert_logs(tracefiles, compress)
+    stacks = StackTable()
+    return [lookup_snapshot(_binary_backtrace_path(tracefile), stacks) \
+                for tracefile in tracefiles]
+
+def _snapshot_index(datafile):
+    return int(re.search(r'_snapshot_(\d+)\.log$', datafile).group(1))
+
+def _snapshot_series(old, new):
+    """Returns the snapshot logs of the process from old to new (both
+    included) in the order they were taken
+    """
+    try:
+        first, last = (_snapshot_index(old), _snapshot_index(new))
+    except AttributeError:
+        # not named like snapshots, no series to speak of
+        return [old, new]
+    prefix = os.path.basename(new)[:-len('_snapshot_%d.log' % last)]
+    logs = glob(os.path.join(os.path.dirname(new), '%s_snapshot_*.log' % \
+                prefix))
+    series = dict((_snapshot_index(log), log) for log in logs)
+    series.update({first: old, last: new})
+    return [series[i] for i in sorted(series) if first <= i <= last]
+
+def _load_chained_backtrace(datafile, stacks=None, compress=False):
+    _generate_binary_backtrace(datafile, compress=compress)
+    return _load_binary_backtrace(datafile, stacks)
+
+def _analyze_trend(tracefiles, compress=False):
+    """Aggregates the growth of traces over tracefiles (in order).
+    Snapshots are loaded one at a time.
+    """
+    _convert_logs(tracefiles, compress)
+    return trend.analyze(map(_binary_backtrace_path, tracefiles), \
+                            StackTable())
+
+def _convert_logs(tracefiles, compress=False):
+    """Converts the tracefiles that have no up-to-date binary backtrace.
+    Returns the list of converted files.
+
+    Logs parsed in one piece (see parallel.is_single_chunk()) are converted
+    side by side, one process each; larger ones are split across all cores
+    one at a time (pool workers cannot have children).
+    """
+    stale = []
+    for tracefile in tracefiles:
+        if tracefile not in stale and not _is_binary_up_to_date(tracefile):
+            stale.append(tracefile)
+    small = filter(parallel.is_single_chunk, stale)
+    if len(small) > 1:
+        p = Pool(min(len(small), cpu_count()))
+        p.map(partial(_generate_binary_backtrace_serially, \
+                        compress=compress), small)
+        p.close()
+        p.join()
+    else:
+        small = []
+    for tracefile in stale:
+        if tracefile not in small:
+            _generate_binary_backtrace(tracefile, compress=compress)
+    return stale
+
+def _convert_all(datadir, compress=False):
+    """Converts all snapshot logs in datadir that have no up-to-date binary
+    backtrace. Returns the list of converted files.
+    """
+    return _convert_logs(sorted(glob(os.path.join(datadir, \
+                            '*_snapshot_*.log'))), compress)
 
 # FIXME tbd
 _USAGE = """
@@ -103,6 +207,55 @@ if __name__ == '__main__':
             default=os.path.join(config.WORK_DIR, 'cache.sym'), \
             help='specify file to use for symbol caching; this will ' \
             'significantly speed symbol lookups (default is %default)')
+    parser.add_option('--convert-all', dest='convertall', \
+            action='store_true', help='convert all snapshot logs in the ' \
+            'working directory to binary form (skips up-to-date ones) and ' \
+            'exit')
+    parser.add_option('--compress', action='store_true', default=False, \
+            help='write compressed binary backtraces (several times ' \
+            'smaller, decompressed when loaded)')
+    parser.add_option('--trend', action='store_true', default=False, \
+            help='rank traces by growth over all given snapshots (defaults ' \
+            'to all snapshots of the active process) instead of diffing ' \
+            'the last two')
+    parser.add_option('--top', type='int', default=20, \
+            help='number of traces --trend and --growth report (defaults ' \
+            'to %default)')
+    parser.add_option('--growth', action='store_true', default=False, \
+            help='report the --top traces with the largest net growth ' \
+            '(freed blocks included) of the last two files instead of the ' \
+            'full diff')
+    parser.add_option('--metric', default='bytes', \
+            choices=['bytes', 'count', '-bytes', '-count'], \
+            help='what --growth ranks traces by: bytes or count, prefixed ' \
+            'with - for the largest decrease (defaults to %default)')
+    parser.add_option('--cross-heap', dest='crossheap', action='store_true', \
+            default=False, help='match blocks by address and trace id ' \
+            'across all heaps instead of heap by heap, so that recreated ' \
+            'heaps and blocks moved between heaps are not reported as new')
+    parser.add_option('--chain', action='store_true', default=False, \
+            help='compose the diff from cached diffs of consecutive ' \
+            'snapshots between the two files (computing and caching the ' \
+            'missing ones next to the snapshots)')
+    parser.add_option('--stream', action='store_true', default=False, \
+            help='diff the binary backtraces of the last two files as they ' \
+            'are read instead of loading them (memory use does not depend ' \
+            'on their size; duplicates are not compressed)')
+    parser.add_option('--parallel-diff', dest='paralleldiff', \
+            action='store_true', default=False, help='diff the binary ' \
+            'backtraces of the last two files heap by heap on all cores ' \
+            '(ignored with --compress)')
+    parser.add_option('--folded', action='store_true', default=False, \
+            help='write the diff as folded stacks (bytes per stack, the ' \
+            'input of flamegraph.pl) instead of dumping its allocations')
+    parser.add_option('--call-tree', dest='calltree', \
+            choices=['top-down', 'bottom-up'], help='dump the diff as a ' \
+            'call tree rooted at the thread entry points (top-down) or at ' \
+            'the allocators (bottom-up) instead of dumping its allocations')
+    parser.add_option('--owner', dest='addresses', action='append', \
+            default=[], help='report the block of the last file holding ' \
+            'this (hex) address and its stack instead of diffing; may be ' \
+            'given several times')
     parser.add_option('--verbose', action='store_true', \
             help='increase output verbosity')
 
@@ -115,8 +268,7 @@ if __name__ == '__main__':
 
     log = logging.getLogger('umdh')
     log.addHandler(logging.StreamHandler())
-    if opts.verbose:
-        log.setLevel(logging.DEBUG)
+    log.setLevel(logging.DEBUG if opts.verbose else logging.INFO)
 
     if args:
         log.debug('unqualified files=%s' % args)
@@ -132,6 +284,11 @@ if __name__ == '__main__':
                                 os.path.join(datadir, cachefile))
         cachedopts = utils.Attributify(cachedconfig)
         config.update(cachedopts)
+    if opts.convertall:
+        for logfile in _convert_all(datadir, opts.compress):
+            log.debug('converted %s' % logfile)
+        sys.exit(0)
+
     # in case we receive ids for log files on the command line
     # guess them by probing files in the configured working directory
     # given options from the cached config
@@ -145,22 +302,107 @@ if __name__ == '__main__':
                     (config.active_pid, _id)) for _id in _ids]
         log.debug('deduced file names from ids: %s' % files)
 
-    traces = _load_backtraces(files)
+    if opts.trend:
+        if not files:
+            files = sorted(glob(os.path.join(datadir, '%d_snapshot_*.log' % \
+                        config.active_pid)), key=_snapshot_index)
+        series = _analyze_trend(files, opts.compress)
+        with symbols(bin_path=';'.join(config.DBG_BIN_PATHS), \
+                        sym_path=';'.join(config.DBG_SYMBOL_PATHS)) as _sym:
+            sym = SymProxy(_sym, opts.symcache)
+            fileobject = open(opts.outfile, 'w') if opts.outfile else \
+                            sys.stdout
+            series.dump(symbols=sym, limit=opts.top, fileobject=fileobject)
+            if opts.outfile:
+                fileobject.close()
+            if opts.symcache:
+                sym.save()
+        sys.exit(0)
+
+    if opts.stream:
+        for tracefile in files[-2:]:
+            _generate_binary_backtrace(tracefile, compress=opts.compress)
+        diff = StreamingDiff(*map(_binary_backtrace_path, files[-2:]))
+        with symbols(bin_path=';'.join(config.DBG_BIN_PATHS), \
+                        sym_path=';'.join(config.DBG_SYMBOL_PATHS)) as _sym:
+            sym = SymProxy(_sym, opts.symcache)
+            grepfn = filter_on_foreign_module( \
+                        diff.trace, symbols=sym, \
+                        trustedmodules=config.get('TRUSTED_MODULES', []), \
+                        trustedpatterns=config.get('TRUSTED_PATTERNS', []) + \
+                            [re.compile(p, re.IGNORECASE) \
+                                for p in opts.patterns])
+            # symbol table the filter resolves frames into
+            table = diff.trace.symbolize(sym, ())
+            if not opts.savebin:
+                fileobject = open(opts.outfile, 'w') if opts.outfile else \
+                                sys.stdout
+                diff.dump_allocs(symbols=table, grepfn=grepfn, \
+                                    fileobject=fileobject)
+                if opts.outfile:
+                    fileobject.close()
+            else:
+                with utils.atomic_file(opts.outfile) as f:
+                    diff.save(f, grepfn=grepfn, compress=opts.compress)
+            if opts.symcache:
+                sym.save()
+        diff.close()
+        sys.exit(0)
+
+    if opts.chain and not (opts.addresses or opts.growth):
+        traces = _lookup_backtraces(files[-2:], opts.compress)
+    else:
+        traces = _load_backtraces(files, opts.compress)
     with symbols(bin_path=';'.join(config.DBG_BIN_PATHS), \
                     sym_path=';'.join(config.DBG_SYMBOL_PATHS)) as _sym:
         sym = SymProxy(_sym, opts.symcache)
         patterns = config.get('TRUSTED_PATTERNS', [])
         for p in opts.patterns:
-            patterns.append(re.compile(p), re.IGNORECASE)
+            patterns.append(re.compile(p, re.IGNORECASE))
         modules = config.get('TRUSTED_MODULES', [])
         grepfn = filter_on_foreign_module( \
                     traces[-1], symbols=sym, \
                     trustedmodules=modules, \
                     trustedpatterns=patterns)
+        # symbols the filter resolves, shared with the dumps (the stacks of
+        # the diff are those of the newest snapshot)
+        table = traces[-1].symbolize(sym, ())
+        if opts.addresses:
+            fileobject = open(opts.outfile, 'w') if opts.outfile else \
+                            sys.stdout
+            traces[-1].dump_blocks([int(a, 16) for a in opts.addresses], \
+                                    symbols=table, fileobject=fileobject)
+            if opts.outfile:
+                fileobject.close()
+            if opts.symcache:
+                sym.save()
+            sys.exit(0)
+        if opts.growth:
+            fileobject = open(opts.outfile, 'w') if opts.outfile else \
+                            sys.stdout
+            traces[-2].dump_growth(traces[-1], limit=opts.top, \
+                                    metric=opts.metric, symbols=table, \
+                                    grepfn=grepfn, fileobject=fileobject)
+            if opts.outfile:
+                fileobject.close()
+            if opts.symcache:
+                sym.save()
+            sys.exit(0)
         # compute diff for the last two data files
         if not utils.frozen():
             pdb.set_trace()
-        diff = traces[-2].diff_with(traces[-1], grepfn=grepfn)
+        if opts.chain:
+            series = _snapshot_series(files[-2], files[-1])
+            chain = DiffChain(series, load=partial(_load_chained_backtrace, \
+                                                    compress=opts.compress))
+            diff = chain.diff(traces[-2], traces[-1], grepfn=grepfn)
+        elif opts.paralleldiff and not opts.compress and \
+                not opts.crossheap:
+            diff = parallel.diff(*map(_binary_backtrace_path, files[-2:]), \
+                                    grepfn=grepfn)
+        else:
+            diff = traces[-2].diff_with(traces[-1], grepfn=grepfn, \
+                                        crossheap=opts.crossheap)
         #if not opts.duplicates and config.REMOVE_DUPLICATES:
         if config.COMPRESS_DUPLICATES:
             try:
@@ -169,14 +411,28 @@ if __name__ == '__main__':
                 log.warning('Invalid duplicate compression level: %s' \
                         % level)
             else:
-                diff.compress_duplicates(level)
+                # clusters of the stacks of earlier diffs of the session
+                cache = ClusterCache(os.path.join(datadir, \
+                            '.duplicates.cache'), \
+                            (level, config.get('active_pid')))
+                diff.compress_duplicates(level, cache)
+                cache.save()
+                log.info('duplicate clusters: %d stacks cached, %d new' % \
+                            (cache.hits, cache.misses))
 
         if not opts.savebin:
             if opts.outfile:
                 fileobject = open(opts.outfile, 'w')
             else:
                 fileobject = sys.stdout
-            diff.dump_allocs(symbols=sym, fileobject=fileobject)
+            if opts.folded:
+                CallTree(diff).dump_folded(symbols=table, \
+                                            fileobject=fileobject)
+            elif opts.calltree:
+                CallTree(diff, bottomup=opts.calltree == 'bottom-up').dump( \
+                            symbols=table, fileobject=fileobject)
+            else:
+                diff.dump_allocs(symbols=table, fileobject=fileobject)
             if opts.outfile:
                 fileobject.close()
         else:
@@ -2,7 +2,6 @@
 """Collection of useful filters"""
 
 from functools import wraps
-from symprovider import format_symbol_module
 import re
 import os
 import pdb
@@ -24,9 +23,6 @@ def _sys_module(module):
         return module.lower().startswith(sysdir)
     return _sys_module(module)
 
-def _format_symbol(sym, module):
-    return '%s!%s' % (format_symbol_module(module), sym)
-
 class ForeignModule(object):
     """Heuristics-based foreign module detection.
 
@@ -34,6 +30,11 @@ class ForeignModule(object):
     and checking if the allocation code belongs to a foreign module.
     Foreign modules are detected based on a list of system modules and a list
     of known low-level (system) allocators.
+
+    Frames are looked up in the symbol table of the trace (see
+    Backtrace.symbolize()) as they are met, so only the frames of the
+    stacks filtered are resolved, each once; patterns are matched once per
+    symbol.
     """
     def __init__(self, trace, symbols=None, trustedmodules=None, \
                     trustedpatterns=None, allocatorpatterns=None):
@@ -53,9 +54,12 @@ class ForeignModule(object):
                 self._allocpatterns.append(p)
         self._sysmodules = map(str.lower, trustedmodules or [])
         self._trustedpatterns = trustedpatterns or []
-        self._symbols = symbols
+        # resolves frames on first use
+        self._symbols = trace.symbolize(symbols, ())
         self._trace = trace
         self._toinclude = False
+        # symbol id -> bool, a dict per pattern list
+        self._matches = {}
 
     def __call__(self, item):
         allocation = item[1]
@@ -81,34 +85,39 @@ class ForeignModule(object):
         def _trusted_module(module):
             return _sys_module(module) or os.path.basename(module).lower() in self._sysmodules
 
-        def _pattern(symbol, patterns):
-            for p in patterns:
-                if p.search(symbol):
-                    return True
+        def _pattern(symid, patterns):
+            matches = self._matches.setdefault(id(patterns), {})
+            match = matches.get(symid)
+            if match is None:
+                symbol = self._symbols.name(symid)
+                match = matches[symid] = any(p.search(symbol) \
+                                                for p in patterns)
+            return match
+
+        def _frame(addr):
+            symid = self._symbols.symbol_id(self._trace, addr)
+            return (symid, self._symbols.symbol(symid)[1])
 
         matched = False
         while not matched:
-            sym, _, module = self._symbols.sym_from_addr(self._trace, (yield))
-            symbol = _format_symbol(sym, module)
-            if _pattern(symbol, self._allocpatterns):
+            symid, module = _frame((yield))
+            if _pattern(symid, self._allocpatterns):
                 # State: system allocator matched
                 # Since system allocators can be chained, skip over as many as
                 # possible until we run out of frames or a foreign module has been
                 # matched
                 while not matched:
-                    sym, _, module = self._symbols.sym_from_addr(self._trace, (yield))
-                    symbol = _format_symbol(sym, module)
-                    if not _pattern(symbol, self._allocpatterns):
+                    symid, module = _frame((yield))
+                    if not _pattern(symid, self._allocpatterns):
                         if _trusted_module(module):
                             matched, self._toinclude = (True, False)
                         elif self._trustedpatterns:
                             # otherwise, complete stack processing looking for
                             # a trusted pattern (which need not be the one
                             # following the allocator!)
-                            while not _pattern(symbol, self._trustedpatterns):
+                            while not _pattern(symid, self._trustedpatterns):
                                 # State: matching a trusted pattern (if any)
-                                sym, _, module = self._symbols.sym_from_addr(self._trace, (yield))
-                                symbol = _format_symbol(sym, module)
+                                symid, module = _frame((yield))
                             matched, self._toinclude = (True, False)
                         else:
                             matched, self._toinclude = (True, True)
@@ -139,18 +148,28 @@ def grep_filter(trace, symbols, pattern):
     |pattern|       regex pattern to match (compiled or string)
     |trace|         trace to work on
     |symbols|       symbols provider
+
+    Frames are looked up in the symbol table of the trace (see
+    Backtrace.symbolize()) as they are met, each resolved once; the pattern
+    is matched once per symbol.
     """
+    # resolves frames on first use
+    table = trace.symbolize(symbols, ())
+    repattern = pattern
+    if isinstance(pattern, basestring):
+        repattern = re.compile(pattern)
+    # symbol id -> bool
+    matches = {}
 
     def _grepfn(item):
         allocation = item[1]
-        stack = allocation.stack
-        repattern = pattern
-        if isinstance(pattern, basestring):
-            repattern = re.compile(pattern)
-        for addr in stack:
-            sym, _, module = symbols.sym_from_addr(trace, addr)
-            symbol = _format_symbol(sym, module)
-            if repattern.search(symbol):
+        for addr in allocation.stack:
+            symid = table.symbol_id(trace, addr)
+            match = matches.get(symid)
+            if match is None:
+                match = matches[symid] = bool(repattern.search( \
+                                                    table.name(symid)))
+            if match:
                 return True
 
     return _grepfn
@@ -0,0 +1,359 @@
+# vim:ts=4:sw=4:expandtab
+"""Set difference of heaps on sorted sample columns.
+
+Instead of intersecting the allocation dicts of two heaps and comparing the
+samples of each common trace as sets, both heaps are flattened into columns
+ordered by trace id (see store.ColumnStore.columns()):
+
+    traceids    trace id - per trace (sorted)
+    sampoff     offset of the first sample - per trace (+1)
+    requested, overhead, address - per sample
+
+and the traces and samples of the newer heap missing from the older one
+are found in a few passes over whole columns. With numpy these are sorted
+merges (in1d); w/o it the samples of the older heap go into a single set.
+Two dict heaps (as parsed) are compared trace by trace instead.
+
+heap_deltas() and top_deltas() compare heaps by the net number of blocks
+and bytes (requested + overhead) per trace instead, freed blocks included,
+and select the traces that changed most w/o sorting all of them.
+
+diff_global() compares a heap to an AddressIndex of all heaps of the older
+snapshot instead of the heap with the same handle: blocks are matched by
+address and trace id, so heaps that were destroyed and recreated under a
+new handle or blocks that moved between heaps are not reported as new.
+"""
+
+import heapq
+from bisect import bisect_left
+from array import array
+from collections import namedtuple
+from itertools import izip
+from pyumdh.store import QWORD_TYPECODE, _ints
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['columns', 'column_list', 'column_array', 'unique_samples', \
+            'diff_heap', 'AddressIndex', 'diff_global', 'totals', 'delta', \
+            'heap_deltas', 'top_deltas']
+
+delta = namedtuple('delta', 'handle traceid count bytes')
+
+
+def columns(heap):
+    """Returns (traceids, sampoff, requested, overhead, address) of heap.
+    Heaps backed by a store provide them w/o decoding allocations, dict
+    heaps are flattened.
+    """
+    if hasattr(heap, 'columns'):
+        return heap.columns()
+    traceids = sorted(heap)
+    sampoff = [0]
+    samples = []
+    for traceid in traceids:
+        allocs = heap[traceid].allocs
+        samples.extend(allocs)
+        sampoff.append(sampoff[-1] + len(allocs))
+    return (traceids, sampoff, [s[0] for s in samples], \
+            [s[1] for s in samples], [s[2] for s in samples])
+
+def unique_samples(samples):
+    """Drops repeated samples keeping the order"""
+    if len(set(samples)) == len(samples):
+        return samples
+    seen = set()
+    return [s for s in samples if not (s in seen or seen.add(s))]
+
+def column_list(values):
+    """Returns a column as a list of ints"""
+    if isinstance(values, array):
+        return _ints(values)
+    if hasattr(values, 'tolist'):
+        # numpy
+        return values.tolist()
+    return list(values)
+
+def column_array(values):
+    """Returns a column as a numpy array of uint64 (a view of 64-bit
+    arrays)
+    """
+    if isinstance(values, array) and values.typecode != 'd':
+        if not values:
+            return numpy.empty(0, dtype=numpy.uint64)
+        if values.typecode == QWORD_TYPECODE:
+            # shares the buffer of 64-bit arrays
+            return numpy.frombuffer(values, dtype=numpy.uint64)
+        # 32-bit columns (see store)
+        return numpy.frombuffer(values, dtype=values.typecode).astype( \
+                                                            numpy.uint64)
+    return numpy.asarray(values, dtype=numpy.uint64)
+
+def _rows(traceids, sampoff, requested, overhead, address):
+    """Returns a (traceid, address, requested, overhead) record per sample
+    as a 1-d array of opaque 32 byte items
+    """
+    counts = numpy.diff(column_array(sampoff)).astype(numpy.intp)
+    rows = numpy.empty((len(address), 4), dtype=numpy.uint64)
+    rows[:, 0] = numpy.repeat(column_array(traceids), counts)
+    rows[:, 1] = column_array(address)
+    rows[:, 2] = column_array(requested)
+    rows[:, 3] = column_array(overhead)
+    return rows.view('V32').ravel()
+
+def _diff_numpy(old, new):
+    traceids, sampoff, requested, overhead, address = new
+    traceids, sampoff = (column_array(traceids), column_array(sampoff))
+    common = numpy.in1d(traceids, column_array(old[0]), assume_unique=True)
+    added = traceids[~common].tolist()
+    # samples of common traces not in the old heap
+    counts = numpy.diff(sampoff).astype(numpy.intp)
+    fresh = numpy.repeat(common, counts)
+    if fresh.any():
+        fresh &= ~numpy.in1d(_rows(*new), _rows(*old))
+    rows = numpy.flatnonzero(fresh)
+    if not len(rows):
+        return (added, [])
+    # trace of each fresh sample
+    owners = numpy.searchsorted(sampoff, rows, side='right') - 1
+    values = zip(column_array(requested)[rows].tolist(), \
+                    column_array(overhead)[rows].tolist(), \
+                    column_array(address)[rows].tolist())
+    bounds = numpy.flatnonzero(numpy.diff(owners)) + 1
+    starts = [0] + bounds.tolist()
+    ends = bounds.tolist() + [len(rows)]
+    grown = [(traceid, unique_samples(values[start:end])) for traceid, start, \
+                end in izip(traceids[owners[starts]].tolist(), starts, ends)]
+    return (added, grown)
+
+def _diff_python(old, new):
+    oldtraceids, oldsampoff, oldrequested, oldoverhead, oldaddress = \
+            map(column_list, old)
+    traceids, sampoff, requested, overhead, address = map(column_list, new)
+    oldtraces = set(oldtraceids)
+    oldsamples = set()
+    for i, traceid in enumerate(oldtraceids):
+        start, end = oldsampoff[i:i+2]
+        oldsamples.update((traceid, r, o, a) for r, o, a in \
+                            izip(oldrequested[start:end], \
+                                oldoverhead[start:end], oldaddress[start:end]))
+    added, grown = ([], [])
+    for i, traceid in enumerate(traceids):
+        if traceid not in oldtraces:
+            added.append(traceid)
+            continue
+        start, end = sampoff[i:i+2]
+        samples = [(r, o, a) for r, o, a in izip(requested[start:end], \
+                    overhead[start:end], address[start:end]) \
+                    if (traceid, r, o, a) not in oldsamples]
+        if samples:
+            grown.append((traceid, unique_samples(samples)))
+    return (added, grown)
+
+def _diff_dicts(old, new):
+    """Dict heaps are compared trace by trace; flattening them costs more
+    than the comparison saves. Equal sample lists are skipped w/o building
+    sets.
+    """
+    added, grown = ([], [])
+    for traceid in sorted(new):
+        allocation = old.get(traceid)
+        if allocation is None:
+            added.append(traceid)
+            continue
+        samples = new[traceid].allocs
+        if samples == allocation.allocs:
+            continue
+        oldsamples = frozenset(allocation.allocs)
+        samples = [tuple(s) for s in samples if s not in oldsamples]
+        if samples:
+            grown.append((traceid, unique_samples(samples)))
+    return (added, grown)
+
+def diff_heap(old, new):
+    """Compares two versions of a heap.
+
+    Returns (added, grown): added lists the ids of traces only in new,
+    grown is [(traceid, samples)] for traces of both heaps with samples
+    only in new; samples are (requested, overhead, address) tuples in the
+    order of new. Both are sorted by trace id.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        return _diff_dicts(old, new)
+    old, new = (columns(old), columns(new))
+    if numpy is not None:
+        return _diff_numpy(old, new)
+    return _diff_python(old, new)
+
+class AddressIndex(object):
+    """Sorted index of the blocks of several heaps keyed on (address,
+    traceid), whatever heap they were allocated from.
+
+    |heaps|     dict of handle -> heap
+    """
+    def __init__(self, heaps):
+        handles = sorted(heaps)
+        parts = [columns(heaps[handle]) for handle in handles]
+        if numpy is not None:
+            self._init_numpy(handles, parts)
+        else:
+            self._init_python(handles, parts)
+
+    def _init_numpy(self, handles, parts):
+        keys, owners, traceids = ([], [], [])
+        for handle, (heaptraceids, sampoff, _, _, address) in \
+                izip(handles, parts):
+            keys.append(_keys(heaptraceids, sampoff, address))
+            owners.append(numpy.repeat(numpy.uint64(handle), len(address)))
+            traceids.append(column_array(heaptraceids))
+        keys = numpy.concatenate(keys) if keys else _keys([], [0], [])
+        order = numpy.argsort(keys, kind='mergesort')
+        self._keys = keys[order]
+        self._handles = numpy.concatenate(owners)[order] if owners else \
+                            numpy.empty(0, dtype=numpy.uint64)
+        self._traceids = numpy.unique(numpy.concatenate(traceids)) \
+                            if traceids else numpy.empty(0, dtype=numpy.uint64)
+
+    def _init_python(self, handles, parts):
+        keys, traceids = ([], set())
+        for handle, (heaptraceids, sampoff, _, _, address) in \
+                izip(handles, parts):
+            heaptraceids, sampoff, address = map(column_list, (heaptraceids, \
+                                                    sampoff, address))
+            for i, traceid in enumerate(heaptraceids):
+                keys.extend((a, traceid, handle) for a in \
+                            address[sampoff[i]:sampoff[i+1]])
+            traceids.update(heaptraceids)
+        keys.sort()
+        self._keys = keys
+        self._traceids = traceids
+
+    def __len__(self):
+        return len(self._keys)
+
+    def find(self, traceids, sampoff, address):
+        """Returns the handle of the heap holding each sample of the columns
+        (see columns()) at the same address for the same trace, None for
+        samples missing from the index
+        """
+        if numpy is not None:
+            keys = _keys(traceids, sampoff, address)
+            if not len(self._keys):
+                return [None] * len(keys)
+            rows = numpy.searchsorted(self._keys, keys)
+            rows[rows == len(self._keys)] = 0
+            found = self._keys[rows] == keys
+            return [int(h) if f else None for h, f in \
+                    izip(self._handles[rows].tolist(), found.tolist())]
+        traceids, sampoff, address = map(column_list, (traceids, sampoff, \
+                                                        address))
+        handles = []
+        for i, traceid in enumerate(traceids):
+            for a in address[sampoff[i]:sampoff[i+1]]:
+                row = bisect_left(self._keys, (a, traceid))
+                if row < len(self._keys) and \
+                        self._keys[row][:2] == (a, traceid):
+                    handles.append(self._keys[row][2])
+                else:
+                    handles.append(None)
+        return handles
+
+    def has_traces(self, traceids):
+        """Returns whether each of traceids has a block in the index"""
+        if numpy is not None:
+            return numpy.in1d(column_array(traceids), self._traceids).tolist()
+        return [traceid in self._traceids for traceid in column_list(traceids)]
+
+
+def _keys(traceids, sampoff, address):
+    """Returns an (address, traceid) key per sample as opaque 16 byte items"""
+    counts = numpy.diff(column_array(sampoff)).astype(numpy.intp)
+    keys = numpy.empty((len(address), 2), dtype=numpy.uint64)
+    keys[:, 0] = column_array(address)
+    keys[:, 1] = numpy.repeat(column_array(traceids), counts)
+    return keys.view('V16').ravel()
+
+def diff_global(index, new):
+    """Compares a heap to the blocks of an AddressIndex of all heaps of the
+    older snapshot, so that blocks which moved between heaps or outlived a
+    heap handle do not show up as new.
+
+    Returns (added, grown) as diff_heap() does: added lists the ids of
+    traces w/o a block in the index, grown is [(traceid, samples)] for the
+    other traces with samples at addresses the index has no block of theirs.
+    """
+    traceids, sampoff, requested, overhead, address = map(column_list, \
+                                                            columns(new))
+    found = index.find(traceids, sampoff, address)
+    added, grown = ([], [])
+    for i, (traceid, known) in enumerate(izip(traceids, \
+                                        index.has_traces(traceids))):
+        if not known:
+            added.append(traceid)
+            continue
+        start, end = sampoff[i:i+2]
+        samples = [(requested[k], overhead[k], address[k]) for k in \
+                    xrange(start, end) if found[k] is None]
+        if samples:
+            grown.append((traceid, unique_samples(samples)))
+    return (added, grown)
+
+def totals(heap):
+    """Returns (traceids, counts, bytes) of the traces of heap: the number
+    of live blocks and their bytes (requested + overhead) per trace id
+    """
+    traceids, sampoff, requested, overhead, _ = columns(heap)
+    if numpy is not None and len(traceids):
+        sampoff = column_array(sampoff).astype(numpy.intp)
+        sums = numpy.zeros(len(requested) + 1, dtype=numpy.uint64)
+        numpy.cumsum(column_array(requested) + column_array(overhead), \
+                        out=sums[1:])
+        return (column_array(traceids).tolist(), \
+                numpy.diff(sampoff).tolist(), \
+                (sums[sampoff[1:]] - sums[sampoff[:-1]]).tolist())
+    traceids, sampoff, requested, overhead = map(column_list, (traceids, \
+                                                sampoff, requested, overhead))
+    counts, sizes = ([], [])
+    for start, end in izip(sampoff, sampoff[1:]):
+        counts.append(end - start)
+        sizes.append(sum(requested[start:end]) + sum(overhead[start:end]))
+    return (traceids, counts, sizes)
+
+def heap_deltas(old, new):
+    """Yields (traceid, count, bytes) of the traces whose blocks changed
+    from old to new: the net change in live blocks and bytes, negative for
+    traces that shrank or are gone.
+    """
+    oldtotals = totals(old)
+    oldtotals = dict(izip(oldtotals[0], izip(*oldtotals[1:])))
+    for traceid, count, size in izip(*totals(new)):
+        oldcount, oldsize = oldtotals.pop(traceid, (0, 0))
+        if count != oldcount or size != oldsize:
+            yield (traceid, count - oldcount, size - oldsize)
+    for traceid, (oldcount, oldsize) in oldtotals.iteritems():
+        yield (traceid, -oldcount, -oldsize)
+
+def top_deltas(deltas, limit, key, accept=None):
+    """Selects the |limit| largest deltas by key with a bounded min-heap,
+    largest first.
+
+    |accept|    optional predicate; it only sees the deltas that would make
+                it into the current selection, so that costly filters run
+                for a few of them
+    """
+    if limit <= 0:
+        return []
+    selection = []
+    for i, item in enumerate(deltas):
+        # i keeps equal keys from comparing the items
+        entry = (key(item), -i, item)
+        if len(selection) == limit and entry <= selection[0]:
+            continue
+        if accept is not None and not accept(item):
+            continue
+        if len(selection) < limit:
+            heapq.heappush(selection, entry)
+        else:
+            heapq.heapreplace(selection, entry)
+    return [item for _, _, item in sorted(selection, reverse=True)]
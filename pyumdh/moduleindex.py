@@ -0,0 +1,117 @@
+# vim:ts=4:sw=4:expandtab
+"""Address range index of the modules of a process.
+
+Every frame of every stack is mapped to its module (the module registry
+protocol of the symbol providers, see Backtrace.map_to_module()), so the
+modules are kept sorted by base address and an address is mapped with a
+bisection instead of a scan of all modules. Modules of a process do not
+overlap: the module of an address is the last one based at or below it,
+if the address falls short of its end.
+
+Module ids are the positions of the modules in base address order.
+module_ids() maps many addresses at once - in one searchsorted with numpy.
+
+ModuleTable is the dict of modules (keyed by module name) of a Backtrace;
+it drops its index whenever it changes and builds it anew on demand.
+"""
+
+from bisect import bisect_right
+from pyumdh.heapdiff import column_array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['ModuleIndex', 'ModuleTable']
+
+
+class ModuleIndex(object):
+    """Sorted address ranges of modules.
+
+    |modules|   iterable of modules (BaseOfImage, SizeOfImage, ModuleName)
+    """
+    def __init__(self, modules):
+        self.modules = sorted(modules, key=lambda m: (m.BaseOfImage, \
+                                                        m.SizeOfImage))
+        self._bases = [m.BaseOfImage for m in self.modules]
+        self._ends = [m.BaseOfImage + m.SizeOfImage for m in self.modules]
+
+    def __len__(self):
+        return len(self.modules)
+
+    def module_id(self, addr):
+        """Returns the module id of an address, -1 if it is in no module"""
+        i = bisect_right(self._bases, addr) - 1
+        if i >= 0 and addr < self._ends[i]:
+            return i
+        return -1
+
+    def find(self, addr):
+        """Returns the module of an address or None"""
+        i = bisect_right(self._bases, addr) - 1
+        if i >= 0 and addr < self._ends[i]:
+            return self.modules[i]
+        return None
+
+    def module_ids(self, addresses):
+        """Returns the module id of each of addresses (-1 for those in no
+        module): a numpy array if numpy is available, a list otherwise
+        """
+        if numpy is None:
+            return map(self.module_id, addresses)
+        addresses = column_array(addresses)
+        if not self.modules:
+            return numpy.repeat(numpy.intp(-1), len(addresses))
+        ids = numpy.searchsorted(column_array(self._bases), addresses, \
+                                    side='right') - 1
+        ends = column_array(self._ends)[numpy.maximum(ids, 0)]
+        ids[(ids < 0) | (addresses >= ends)] = -1
+        return ids
+
+
+class ModuleTable(dict):
+    """Dict of modules keyed by name that keeps a ModuleIndex of them"""
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._index = None
+
+    def index(self):
+        """Returns the ModuleIndex of the modules, built on first use after
+        a change
+        """
+        if self._index is None:
+            self._index = ModuleIndex(self.itervalues())
+        return self._index
+
+    def __setitem__(self, name, module):
+        self._index = None
+        dict.__setitem__(self, name, module)
+
+    def __delitem__(self, name):
+        self._index = None
+        dict.__delitem__(self, name)
+
+    def setdefault(self, name, module=None):
+        if name not in self:
+            self._index = None
+        return dict.setdefault(self, name, module)
+
+    def update(self, *args, **kwargs):
+        self._index = None
+        dict.update(self, *args, **kwargs)
+
+    def pop(self, *args):
+        self._index = None
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._index = None
+        return dict.popitem(self)
+
+    def clear(self):
+        self._index = None
+        dict.clear(self)
+
+    def __reduce__(self):
+        # the index is not pickled
+        return (ModuleTable, (dict(self),))
@@ -0,0 +1,416 @@
+# vim:ts=4:sw=4:expandtab
+"""Parallel parsing of a single UMDH log and parallel diffs.
+
+The log is split into byte ranges at heap boundaries and, for large heaps, at
+empty lines within a heap (the parser state after an empty line does not
+depend on what preceded it). Ranges are parsed by a process pool, each worker
+writing a binary snapshot of its range, and the snapshots are merged in file
+order: the first range holding a trace provides its stack and samples are
+concatenated, which yields what the serial parser does.
+
+diff() compares two binary snapshots the same way: both are memory mapped
+by every worker (the page cache shares them), heaps - and ranges of trace
+ids of large heaps - are diffed by a process pool, each worker writing the
+diff of its range as a binary snapshot, and the ranges are gathered in
+trace id order into the columnar storage of the resulting Backtrace.
+"""
+
+import heapq
+from itertools import izip
+from bisect import bisect_left
+import mmap
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool, cpu_count
+from pyumdh.backtrace import Backtrace, _iter_allocations_fast, _parse_modules
+import pyumdh.heapdiff as heapdiff
+import pyumdh.snapshot as snapshot
+import pyumdh.store as store
+import pyumdh.utils as utils
+
+__all__ = ['split_log', 'is_single_chunk', 'convert', 'parse_into', \
+            'split_diff', 'diff']
+
+_HEAP_MARKER = '*- - - - - - - - - - Heap'
+_END_MARKER = '*- - - - - - - - - - End of data for heap'
+# target size of a range
+_CHUNKSIZE = 1 << 26
+# target number of traces of a diff range
+_DIFF_ROWS = 1 << 15
+
+
+def _find_line(mm, marker, start, end=None):
+    """Finds marker at the beginning of a line within [start, end)"""
+    end = len(mm) if end is None else end
+    pos = mm.find(marker, start, end)
+    while pos > 0 and mm[pos-1] != '\n':
+        pos = mm.find(marker, pos + 1, end)
+    return pos
+
+def split_log(path, chunksize=_CHUNKSIZE):
+    """Splits the heaps of an UMDH log into ranges that can be parsed
+    independently.
+    Returns [(heaphandle, start, end)] in file order; empty heaps get an
+    empty range.
+    """
+    ranges = []
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return ranges
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        eol = mm.find('\n')
+        blank = '\n\r\n' if eol > 0 and mm[eol-1] == '\r' else '\n\n'
+        pos = _find_line(mm, _HEAP_MARKER, 0)
+        while pos != -1:
+            eol = mm.find('\n', pos)
+            start = len(mm) if eol == -1 else eol + 1
+            handle = int(Backtrace._heaphandle_re_.search( \
+                            mm[pos:start]).group(1), 16)
+            end = _find_line(mm, _END_MARKER, start)
+            end = len(mm) if end == -1 else end
+            # cut large heaps at empty lines
+            while end - start > chunksize:
+                cut = mm.find(blank, start + chunksize, end)
+                if cut == -1:
+                    break
+                cut += len(blank)
+                ranges.append((handle, start, cut))
+                start = cut
+            ranges.append((handle, start, end))
+            pos = _find_line(mm, _HEAP_MARKER, end)
+    finally:
+        mm.close()
+    return ranges
+
+
+class _RangeReader(object):
+    """Reads [start, end) of a binary file translating newlines like a file
+    opened in text mode.
+    """
+    def __init__(self, f, start, end):
+        f.seek(start)
+        self._f = f
+        self._left = end - start
+
+    def read(self, size):
+        data = self._f.read(min(size, self._left))
+        self._left -= len(data)
+        if data.endswith('\r') and self._left:
+            # do not split a CRLF pair
+            data += self._f.read(1)
+            self._left -= 1
+        return data.replace('\r\n', '\n')
+
+
+def _parse_ranges(args):
+    """Worker: parses ranges of a log into a snapshot of their heaps."""
+    path, ranges, outpath = args
+    trace = Backtrace()
+    with open(path, 'rb') as f:
+        for handle, start, end in ranges:
+            heap = trace._heaps.setdefault(handle, {})
+            for _, traceid, allocation in _iter_allocations_fast( \
+                    _RangeReader(f, start, end), '', None, handle):
+                item = heap.get(traceid)
+                if item:
+                    item.allocs.extend(allocation.allocs)
+                else:
+                    heap[traceid] = allocation
+    trace.save(outpath)
+    return outpath
+
+
+def _merge_heap(handle, chunks):
+    """Merges the heap of handle from chunks (in file order).
+    Yields (traceid, stack, samples) sorted by trace id.
+    """
+    def keyed(i, chunk):
+        for handle_, first, count in chunk.directory():
+            if handle_ == handle:
+                for traceid, stack, samples in chunk.traces(first, count):
+                    yield (traceid, i, stack, samples)
+    merged = None
+    for traceid, _, stack, samples in heapq.merge(*[keyed(i, chunk) \
+                                            for i, chunk in enumerate(chunks)]):
+        if merged and merged[0] == traceid:
+            merged[2].extend(samples)
+            continue
+        if merged:
+            yield merged
+        merged = (traceid, stack, samples)
+    if merged:
+        yield merged
+
+def _parse_chunks(path, processes, chunksize):
+    """Parses the ranges of a log in a pool.
+    Returns (modules, [(handle, [chunk Snapshot])], tempdir) with handles and
+    chunks in file order.
+    """
+    modules = {}
+    with open(path, 'r') as f:
+        _parse_modules(f, modules)
+    # batch small ranges (e.g. empty heaps) together
+    jobs, size = [], chunksize
+    for handle, start, end in split_log(path, chunksize):
+        if size >= chunksize:
+            jobs.append([])
+            size = 0
+        jobs[-1].append((handle, start, end))
+        size += end - start
+    tempdir = tempfile.mkdtemp(prefix='pyumdh')
+    heaps = []
+    try:
+        jobs = [(path, ranges, os.path.join(tempdir, '%d.bin' % i)) \
+                    for i, ranges in enumerate(jobs)]
+        if len(jobs) > 1 and processes != 1:
+            p = Pool(processes or cpu_count())
+            try:
+                chunkpaths = p.map(_parse_ranges, jobs)
+            finally:
+                p.close()
+                p.join()
+        else:
+            chunkpaths = map(_parse_ranges, jobs)
+        # a handle may have several sections in a log
+        chunks = {}
+        for (_, ranges, _), chunkpath in zip(jobs, chunkpaths):
+            with open(chunkpath, 'rb') as f:
+                chunk = snapshot.Snapshot(f, Backtrace)
+            for handle, _, _ in ranges:
+                if handle not in chunks:
+                    heaps.append((handle, chunks.setdefault(handle, [])))
+                if not chunks[handle] or chunks[handle][-1] is not chunk:
+                    chunks[handle].append(chunk)
+    except:
+        _cleanup(heaps, tempdir)
+        raise
+    return (modules, heaps, tempdir)
+
+def _cleanup(heaps, tempdir):
+    for _, chunks in heaps:
+        for chunk in chunks:
+            chunk.close()
+    shutil.rmtree(tempdir, ignore_errors=True)
+
+def is_single_chunk(path, chunksize=_CHUNKSIZE):
+    """Checks if a log is small enough to be parsed in one piece, which
+    convert() and parse_into() then do in this process
+    """
+    return os.path.getsize(path) <= chunksize
+
+def convert(path, outfile, processes=None, chunksize=_CHUNKSIZE, \
+                compress=False, index=True):
+    """Parses a log in parallel straight into a binary snapshot.
+    Chunks are merged heap by heap w/o building dicts.
+
+    |index|     store the interval index of the blocks (see
+                Backtrace.block_index())
+    """
+    if is_single_chunk(path, chunksize):
+        Backtrace(path, fast=True).save(outfile, compress=compress, \
+                                        index=index)
+        return
+    source = snapshot.source_stamp(path)
+    modules, heaps, tempdir = _parse_chunks(path, processes, chunksize)
+    try:
+        f, close = utils.file_open(outfile, 'wb')
+        try:
+            writer = snapshot.SnapshotWriter(f, source, compress, index)
+            for module in modules.itervalues():
+                writer.add_module(module)
+            for handle, chunks in sorted(heaps):
+                writer.add_heap(handle, _merge_heap(handle, chunks))
+            writer.close()
+        finally:
+            if close:
+                f.close()
+    finally:
+        _cleanup(heaps, tempdir)
+
+def parse_into(trace, path, processes=None, chunksize=_CHUNKSIZE):
+    """Parses a log in parallel into trace (see Backtrace(processes=)).
+    Alias stacks are not kept.
+    """
+    if is_single_chunk(path, chunksize):
+        with open(path, 'r') as f:
+            trace._parse(f, fast=True)
+        return
+    modules, heaps, tempdir = _parse_chunks(path, processes, chunksize)
+    try:
+        trace._modules.update(modules)
+        for handle, chunks in heaps:
+            heap = trace._heaps.setdefault(handle, {})
+            for traceid, stack, samples in _merge_heap(handle, chunks):
+                heap[traceid] = trace._intern(trace.allocation(stack=stack, \
+                        aliases=[], allocs=[trace.sample(*s) for s in samples]))
+            trace._allocs.update(heap)
+    finally:
+        _cleanup(heaps, tempdir)
+
+
+def _open_snapshot(path):
+    with open(path, 'rb') as f:
+        s = snapshot.Snapshot(f, Backtrace)
+    if s.flags & snapshot.FLAG_COMPRESSED:
+        s.close()
+        raise ValueError('compressed snapshots cannot be diffed in parallel')
+    return s
+
+def split_diff(old, new, rows=_DIFF_ROWS):
+    """Splits the heaps two snapshots (Snapshot) have in common into ranges
+    of trace ids that can be diffed independently; heaps of more than
+    |rows| traces are cut into ranges of about as many traces.
+    Returns [(handle, (first, count) in old, (first, count) in new)].
+    """
+    olddir = dict((handle, (first, count)) for handle, first, count \
+                    in old.directory())
+    ranges = []
+    for handle, first, count in sorted(new.directory()):
+        if handle not in olddir or not count:
+            continue
+        oldfirst, oldcount = olddir[handle]
+        oldend, end = (oldfirst + oldcount, first + count)
+        cuts = range(first, end, rows)[1:]
+        # traces of old below the first trace id of the next range
+        oldcuts = [bisect_left(old.traceids, new.traceids[cut], oldfirst, \
+                                oldend) for cut in cuts]
+        for start, stop, oldstart, oldstop in zip([first] + cuts, \
+                cuts + [end], [oldfirst] + oldcuts, oldcuts + [oldend]):
+            ranges.append((handle, (oldstart, oldstop - oldstart), \
+                            (start, stop - start)))
+    return ranges
+
+def _diff_range(args):
+    """Worker: diffs a range of a heap into a snapshot of the traces new
+    to it; returns (outpath, ids of the traces missing from old)
+    """
+    oldpath, newpath, (handle, oldrows, newrows), outpath = args
+    old, new = (_open_snapshot(oldpath), _open_snapshot(newpath))
+    try:
+        added, grown = heapdiff.diff_heap(store.HeapView(old, *oldrows), \
+                                            store.HeapView(new, *newrows))
+        grown = dict(grown)
+        wanted = grown.viewkeys() | added
+        def traces():
+            # decoding the range in bulk beats seeking trace after trace
+            for traceid, stack, samples in new.iter_traces(*newrows):
+                if traceid in wanted:
+                    yield (traceid, stack, grown.get(traceid, samples))
+        with open(outpath, 'wb') as f:
+            writer = snapshot.SnapshotWriter(f)
+            writer.add_heap(handle, traces())
+            writer.close()
+    finally:
+        old.close()
+        new.close()
+    return (outpath, added)
+
+def _chunk_traces(chunk):
+    return chunk.traces(0, len(chunk.traceids))
+
+def _append_chunk(columns, chunk):
+    """Appends all traces of a diff chunk to a store in bulk"""
+    base = len(columns.frames)
+    columns.frames.extend(chunk.frames.tolist())
+    samples = chunk.samples.tolist()
+    columns.extend_samples(samples[0::3], samples[1::3], samples[2::3])
+    sampoff = chunk.sampoff.tolist()
+    columns._extend_traces(chunk.traceids.tolist(), \
+            [base + offset for offset in chunk.stackoff.tolist()], \
+            chunk.stacklen.tolist(), \
+            [end - start for start, end in izip(sampoff, sampoff[1:])])
+
+def _gather_heap(diff, chunks, newheap, grepfn):
+    """Appends the traces of the diff chunks of a heap (in trace id order)
+    that pass grepfn to the store of diff. Returns a HeapView over them or
+    None if no trace missing from the older heap passes.
+    """
+    if grepfn is None:
+        chunks = [(chunk, added, added) for chunk, added in chunks]
+    else:
+        allocation, sample = (Backtrace.allocation, Backtrace.sample)
+        # the added traces that pass grepfn, next to all added ones
+        chunks = [(chunk, added, frozenset(traceid for traceid, stack, \
+                    samples in _chunk_traces(chunk) if traceid in added and \
+                    grepfn((traceid, allocation(stack=stack, aliases=[], \
+                        allocs=[sample(*s) for s in samples]))))) \
+                    for chunk, added in chunks]
+    if not any(passed for _, _, passed in chunks):
+        # do not persist an empty heap
+        return None
+    columns = diff._store
+    first = len(columns.traceids)
+    for chunk, added, passed in chunks:
+        if grepfn is None:
+            _append_chunk(columns, chunk)
+            continue
+        traces = []
+        for traceid, stack, samples in _chunk_traces(chunk):
+            if traceid in added:
+                if traceid not in passed:
+                    continue
+            # skip over grown traces if the grep is negative
+            elif not grepfn((None, newheap[traceid])):
+                continue
+            traces.append((traceid, len(columns.frames), len(stack), \
+                            len(samples)))
+            columns.frames.extend(stack)
+            if samples:
+                columns.extend_samples(*zip(*samples))
+        columns._add_traces(traces)
+    return store.HeapView(columns, first, len(columns.traceids) - first)
+
+def diff(old, new, processes=None, grepfn=None, rows=_DIFF_ROWS):
+    """Diffs two plain binary snapshots in parallel and returns the diff as
+    Backtrace.diff_with() does, held in columnar storage.
+
+    |old|, |new|    paths of the snapshots
+    |processes|     size of the pool (defaults to the number of cores)
+    |grepfn|        filter to run on allocations (in this process)
+                    must comply to the filter protocol
+    |rows|          traces per range of large heaps (see split_diff())
+    """
+    oldsnap, newsnap = (_open_snapshot(old), _open_snapshot(new))
+    tempdir = tempfile.mkdtemp(prefix='pyumdh')
+    chunks = []
+    try:
+        trace = Backtrace()
+        for m in newsnap.modules():
+            trace._modules.setdefault(os.path.basename(m.ModuleName), m)
+        jobs = [(old, new, r, os.path.join(tempdir, '%d.bin' % i)) \
+                    for i, r in enumerate(split_diff(oldsnap, newsnap, rows))]
+        if len(jobs) > 1 and processes != 1:
+            p = Pool(min(len(jobs), processes or cpu_count()))
+            try:
+                results = p.map(_diff_range, jobs)
+            finally:
+                p.close()
+                p.join()
+        else:
+            results = map(_diff_range, jobs)
+        heaps = {}
+        for (_, _, (handle, _, _), _), (chunkpath, added) in zip(jobs, \
+                                                                results):
+            with open(chunkpath, 'rb') as f:
+                chunks.append(snapshot.Snapshot(f, Backtrace))
+            heaps.setdefault(handle, []).append((chunks[-1], \
+                                                    frozenset(added)))
+        diff = Backtrace(stacks=trace._stacks)
+        diff._modules = trace._modules
+        diff._store = store.ColumnStore(diff, diff._stacks)
+        newheaps = newsnap.heaps(heaps.keys()) if grepfn else {}
+        for handle in sorted(heaps):
+            heap = _gather_heap(diff, heaps[handle], newheaps.get(handle), \
+                                grepfn)
+            if heap is not None:
+                diff._heaps[handle] = heap
+        diff._allocs = store.AllocationsView(diff._heaps)
+        return diff
+    finally:
+        for chunk in chunks:
+            chunk.close()
+        oldsnap.close()
+        newsnap.close()
+        shutil.rmtree(tempdir, ignore_errors=True)
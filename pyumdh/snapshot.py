@@ -0,0 +1,679 @@
+# vim:ts=4:sw=4:expandtab
+"""Binary snapshot format (version 2).
+
+The file is a header followed by a table of sections and the sections
+themselves. All integers are little-endian and 64 bits wide so files are
+portable between 32 and 64 bit builds, and every section is 8 byte aligned so
+that it can be viewed in place once the file is mapped.
+
+    header      magic, version, flags, number of sections
+    sections    (tag, offset, count) for every section
+    modules     base, size, name length, name (padded) - per module
+    heapdir     heap directory: handle, first trace, trace count - per heap
+    traceids    trace id - per trace (sorted within a heap)
+    stackoff    offset of the stack in frames - per trace
+    stacklen    number of frames - per trace
+    sampoff     offset of the first sample in samples - per trace (+1)
+    frames      stack frame array
+    samples     requested, overhead, address - per sample
+
+An optional `source' section stamps the snapshot with the size, mtime and a
+content digest of the log it was converted from (see source_stamp()).
+An optional `blkindex' section holds the interval index of the blocks of all
+heaps (see blockindex): the starts, ends, maxends, handles and trace ids
+columns one after the other, a qword per block each.
+
+Compressed snapshots (FLAG_COMPRESSED) keep the heap directory and replace
+the remaining columns with
+
+    blockdir    number of traces, offset and size in blocks - per block
+    blocks      zlib compressed blocks of up to _ROWS traces of a heap
+
+A block holds the trace ids, stack lengths and sample counts of its traces,
+the sorted distinct frames of the block, the stacks as indices into them,
+the requested sizes and overheads, and the sample addresses delta encoded
+trace after trace. Trace ids and frames are delta encoded too (zigzag for
+the sign), and the resulting qwords are shuffled into byte planes so that
+zlib sees the runs of zero high bytes. Compressed heaps are decompressed
+block by block into a store.ColumnStore when the snapshot is loaded.
+"""
+
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import zlib
+from bisect import bisect_right
+from itertools import izip
+from array import array
+from pyumdh.store import QWORD_TYPECODE, ColumnStore, HeapView, _ints
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['MAGIC', 'VERSION', 'FLAG_COMPRESSED', 'SnapshotWriter', \
+            'Snapshot', 'QwordView', 'is_snapshot', 'source_stamp', \
+            'read_stamp']
+
+MAGIC = 'umdhsnap'
+VERSION = 2
+FLAG_COMPRESSED = 1
+
+_header = struct.Struct('<8sQQQ')
+_section = struct.Struct('<8sQQ')
+_qword = struct.Struct('<Q')
+# number of qwords packed at once
+_CHUNK = 1 << 16
+# number of traces decoded at once
+_ROWS = 1 << 12
+# source logs are digested in this many blocks of _STAMP_BLOCK bytes
+_STAMP_BLOCKS = 16
+_STAMP_BLOCK = 1 << 16
+
+def _pack(f, values):
+    """Write values as little-endian qwords."""
+    for i in xrange(0, len(values), _CHUNK):
+        chunk = values[i:i+_CHUNK]
+        f.write(struct.pack('<%dQ' % len(chunk), *chunk))
+
+def _padding(size):
+    return '\0' * (-size % 8)
+
+def _shuffle(values):
+    """Packs values as qwords stored byte plane by byte plane."""
+    data = ''.join(struct.pack('<%dQ' % len(values[i:i+_CHUNK]), \
+                        *values[i:i+_CHUNK]) \
+                        for i in xrange(0, len(values), _CHUNK))
+    return ''.join(data[k::8] for k in xrange(8))
+
+def _unshuffle(data):
+    """Inverse of _shuffle(). Returns an array of QWORD_TYPECODE."""
+    count = len(data) / 8
+    packed = bytearray(len(data))
+    for k in xrange(8):
+        packed[k::8] = data[k*count:(k+1)*count]
+    if QWORD_TYPECODE == 'd':
+        return array('d', struct.unpack('<%dQ' % count, str(packed)))
+    values = array(QWORD_TYPECODE)
+    values.fromstring(str(packed))
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+def _zigzag_deltas(values, prev=0):
+    """Returns the differences of consecutive values with the sign folded
+    into the lowest bit.
+    """
+    deltas = []
+    for value in values:
+        delta = value - prev
+        deltas.append(delta << 1 if delta >= 0 else ~delta << 1 | 1)
+        prev = value
+    return deltas
+
+def _undo_zigzag_deltas(deltas, prev=0):
+    values = []
+    for delta in deltas:
+        prev += delta >> 1 if not delta & 1 else ~(delta >> 1)
+        values.append(prev)
+    return values
+
+def _encode_block(traces):
+    """Compresses [(traceid, stack, samples)] of a heap into a block."""
+    traceids = [traceid for traceid, _, _ in traces]
+    values = _zigzag_deltas(traceids)
+    values.extend(len(stack) for _, stack, _ in traces)
+    values.extend(len(samples) for _, _, samples in traces)
+    # frames are indices into the sorted frames of the block
+    table = sorted(set(frame for _, stack, _ in traces for frame in stack))
+    indices = dict(izip(table, xrange(len(table))))
+    values.append(len(table))
+    values.extend(_zigzag_deltas(table))
+    values.extend(indices[frame] for _, stack, _ in traces for frame in stack)
+    for field in (0, 1):
+        values.extend(sample[field] for _, _, samples in traces \
+                        for sample in samples)
+    # consecutive within a trace, carried across traces
+    values.extend(_zigzag_deltas(sample[2] for _, _, samples in traces \
+                                    for sample in samples))
+    return zlib.compress(_shuffle(values))
+
+def _decode_block(data, rows):
+    """Decompresses a block of rows traces.
+    Returns (traceids, stacklens, numsamples, frames, requested, overhead,
+    addresses) arrays.
+    """
+    values = _unshuffle(zlib.decompress(data))
+    traceids = array(values.typecode, _undo_zigzag_deltas( \
+                        _ints(values[:rows])))
+    stacklens, numsamples = (values[rows:2*rows], values[2*rows:3*rows])
+    pos = 3*rows + 1
+    table = _undo_zigzag_deltas(_ints(values[pos:pos+int(values[pos-1])]))
+    pos += len(table)
+    numframes = int(sum(stacklens))
+    frames = array(values.typecode, map(table.__getitem__, \
+                        _ints(values[pos:pos+numframes])))
+    pos += numframes
+    total = int(sum(numsamples))
+    requested, overhead = (values[pos:pos+total], \
+                            values[pos+total:pos+2*total])
+    pos += 2*total
+    addresses = array(values.typecode, _undo_zigzag_deltas( \
+                        _ints(values[pos:pos+total])))
+    return (traceids, stacklens, numsamples, frames, requested, overhead, \
+            addresses)
+
+
+def is_snapshot(fileobject):
+    """Checks if fileobject (positioned at the start) holds a v2 snapshot.
+    Leaves the file positioned past the magic if so.
+    """
+    pos = fileobject.tell()
+    if fileobject.read(len(MAGIC)) == MAGIC:
+        return True
+    fileobject.seek(pos)
+    return False
+
+def source_stamp(path):
+    """Returns (size, mtime, digest) identifying the contents of a log.
+    The digest covers blocks sampled evenly across the file (including its
+    head and tail), so stamping a multi-GB log costs a few reads. mtime is in
+    microseconds.
+    """
+    st = os.stat(path)
+    size = st.st_size
+    crc, adler = 0, 1
+    with open(path, 'rb') as f:
+        if size <= _STAMP_BLOCKS * _STAMP_BLOCK:
+            offsets = (0,)
+            blocksize = size
+        else:
+            offsets = [(size - _STAMP_BLOCK) * i / (_STAMP_BLOCKS - 1) \
+                            for i in xrange(_STAMP_BLOCKS)]
+            blocksize = _STAMP_BLOCK
+        for offset in offsets:
+            f.seek(offset)
+            block = f.read(blocksize)
+            crc = zlib.crc32(block, crc)
+            adler = zlib.adler32(block, adler)
+    digest = (crc & 0xffffffff) << 32 | adler & 0xffffffff
+    return (size, int(st.st_mtime * 1000000), digest)
+
+def read_stamp(fileobject):
+    """Returns the source stamp of the snapshot in fileobject (positioned at
+    the start) or None if it is not a (complete) v2 snapshot or has no stamp.
+    """
+    start = fileobject.tell()
+    fileobject.seek(0, os.SEEK_END)
+    size = fileobject.tell() - start
+    fileobject.seek(start)
+    data = fileobject.read(_header.size)
+    if len(data) < _header.size:
+        return None
+    magic, version, flags, numsections = _header.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+    data = fileobject.read(_section.size * numsections)
+    if len(data) < _section.size * numsections:
+        return None
+    sections = {}
+    for i in xrange(numsections):
+        name, offset, count = _section.unpack_from(data, _section.size * i)
+        if offset > size:
+            return None
+        sections[name.rstrip('\0')] = (offset, count)
+    if 'source' not in sections:
+        return None
+    offset, count = sections['source']
+    fileobject.seek(start + offset)
+    data = fileobject.read(count * 8)
+    if len(data) < count * 8:
+        return None
+    return struct.unpack('<%dQ' % count, data)
+
+
+class QwordView(object):
+    """Read-only view of an array of little-endian qwords within a buffer.
+
+    Values are only unpacked when accessed, so viewing a mapped file costs
+    nothing until its pages are touched. Slices are returned as lists.
+    """
+    def __init__(self, buf, offset, count):
+        self._buf = buf
+        self._offset = offset
+        self._count = count
+        self.array = numpy.frombuffer(buf, dtype='<u8', count=count, \
+                        offset=offset) if numpy is not None else None
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._count)
+            if step != 1:
+                return [self[k] for k in xrange(start, stop, step)]
+            return self.tolist(start, stop)
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('qword index out of range')
+        return _qword.unpack_from(self._buf, self._offset + i*8)[0]
+
+    def __iter__(self):
+        for i in xrange(0, self._count, _CHUNK):
+            for value in self.tolist(i, min(i + _CHUNK, self._count)):
+                yield value
+
+    def tolist(self, start=0, stop=None):
+        stop = self._count if stop is None else stop
+        if stop <= start:
+            return []
+        if self.array is not None:
+            return self.array[start:stop].tolist()
+        return list(struct.unpack_from('<%dQ' % (stop - start), self._buf, \
+                self._offset + start*8))
+
+
+class SnapshotWriter(object):
+    """Writes a snapshot incrementally.
+
+    Columns are spilled to temporary files as heaps are added and assembled
+    into the final file by close(), so memory use does not depend on the
+    snapshot size.
+
+        writer = SnapshotWriter(fileobject, source=source_stamp(logpath))
+        writer.add_module(module)
+        writer.add_heap(handle, [(traceid, stack, samples)])
+        writer.close()
+
+    |source|    stamp of the source log (see source_stamp())
+    |compress|  write a compressed snapshot
+    |index|     write the interval index of the blocks (see blockindex)
+    """
+    _columns = ('heapdir', 'traceids', 'stackoff', 'stacklen', 'sampoff', \
+                'frames', 'samples')
+    _compressed_columns = ('heapdir', 'blockdir', 'blocks')
+
+    def __init__(self, fileobject, source=None, compress=False, \
+                    index=False):
+        self._fileobject = fileobject
+        self._source = source
+        self._compress = compress
+        # starts, ends, handles and trace ids of the blocks (if indexed)
+        self._blocks = [array(QWORD_TYPECODE) for i in xrange(4)] \
+                        if index else None
+        self._columns = self._compressed_columns if compress else \
+                            SnapshotWriter._columns
+        self._modules = []
+        # traces of the block being filled (compressed only)
+        self._pending = []
+        self._numtraces = 0
+        self._spill = dict((name, tempfile.TemporaryFile()) \
+                            for name in self._columns)
+        self._counts = dict.fromkeys(self._columns, 0)
+
+    def _write(self, column, values):
+        _pack(self._spill[column], values)
+        self._counts[column] += len(values)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        block = _encode_block(self._pending)
+        self._write('blockdir', (len(self._pending), self._counts['blocks'], \
+                                    len(block)))
+        self._spill['blocks'].write(block)
+        self._counts['blocks'] += len(block)
+        self._numtraces += len(self._pending)
+        self._pending = []
+
+    def _index(self, handle, traces):
+        starts, ends, handles, traceids = self._blocks
+        for trace in traces:
+            samples = trace[2]
+            starts.extend(address for _, _, address in samples)
+            ends.extend(address + requested + overhead \
+                        for requested, overhead, address in samples)
+            handles.extend([handle] * len(samples))
+            traceids.extend([trace[0]] * len(samples))
+            yield trace
+
+    def add_module(self, module):
+        self._modules.append(module)
+
+    def add_heap(self, handle, traces):
+        """Adds a heap.
+
+        |traces|    iterable of (traceid, stack, samples) sorted by trace id;
+                    samples are (requested, overhead, address) triples
+        """
+        if self._blocks is not None:
+            traces = self._index(handle, traces)
+        if self._compress:
+            first = self._numtraces
+            for trace in traces:
+                self._pending.append(trace)
+                if len(self._pending) == _ROWS:
+                    self._flush()
+            # blocks do not span heaps
+            self._flush()
+            self._write('heapdir', (handle, first, self._numtraces - first))
+            return
+        first = self._counts['traceids']
+        # columns of the traces not written yet
+        pending = dict((name, []) for name in self._columns[1:])
+        numframes, numsamples = (self._counts['frames'], \
+                                    self._counts['samples'] / 3)
+        for traceid, stack, samples in traces:
+            pending['traceids'].append(traceid)
+            pending['stackoff'].append(numframes)
+            pending['stacklen'].append(len(stack))
+            pending['sampoff'].append(numsamples)
+            pending['frames'].extend(stack)
+            pending['samples'].extend(value for sample in samples \
+                                        for value in sample)
+            numframes += len(stack)
+            numsamples += len(samples)
+            if len(pending['traceids']) == _ROWS:
+                for name, values in pending.iteritems():
+                    self._write(name, values)
+                    del values[:]
+        for name, values in pending.iteritems():
+            self._write(name, values)
+        self._write('heapdir', (handle, first, \
+                                    self._counts['traceids'] - first))
+
+    def close(self):
+        """Assembles the file. Does not close the underlying fileobject."""
+        if self._compress:
+            self._flush()
+            self._spill['blocks'].write(_padding(self._counts['blocks']))
+        else:
+            # terminate the sample offsets so that each trace has [start, end)
+            self._write('sampoff', (self._counts['samples'] / 3,))
+        modules = ''.join(_qword.pack(m.BaseOfImage) + _qword.pack( \
+                            m.SizeOfImage) + _qword.pack(len(m.ModuleName)) + \
+                            m.ModuleName + _padding(len(m.ModuleName)) \
+                            for m in self._modules)
+        sections = [('modules', len(self._modules), len(modules))]
+        if self._source:
+            sections.append(('source', len(self._source), \
+                                len(self._source) * 8))
+        index = None
+        if self._blocks is not None:
+            from pyumdh.blockindex import index_columns
+            index = index_columns(*self._blocks)
+            self._blocks = None
+            sections.append(('blkindex', len(index[0]), len(index[0]) * 40))
+        # blocks are counted in bytes
+        sections.extend((name, self._counts[name], self._counts[name] * 8 \
+                            if name != 'blocks' else self._counts[name] + \
+                            len(_padding(self._counts[name]))) \
+                            for name in self._columns)
+        offset = _header.size + _section.size * len(sections)
+        f = self._fileobject
+        f.write(_header.pack(MAGIC, VERSION, \
+                    FLAG_COMPRESSED if self._compress else 0, len(sections)))
+        for name, count, size in sections:
+            f.write(_section.pack(name, offset, count))
+            offset += size
+        f.write(modules)
+        if self._source:
+            _pack(f, self._source)
+        if index is not None:
+            for column in index:
+                if hasattr(column, 'astype'):
+                    # numpy
+                    f.write(column.astype('<u8').tostring())
+                else:
+                    _pack(f, column)
+        for name in self._columns:
+            spill = self._spill[name]
+            spill.seek(0)
+            shutil.copyfileobj(spill, f)
+            spill.close()
+
+
+class Snapshot(object):
+    """Memory mapped v2 snapshot.
+
+    |fileobject|    file positioned at the start of a snapshot; files w/o a
+                    descriptor (e.g. StringIO) are read in memory instead
+    |types|         provides the sample, allocation and module record types
+                    (see Backtrace)
+    |stacks|        optional StackTable to intern decoded stacks with
+    """
+    def __init__(self, fileobject, types, stacks=None):
+        start = fileobject.tell()
+        self._map = None
+        try:
+            fileobject.fileno()
+        except (AttributeError, IOError):
+            self._buf = fileobject.read()
+        else:
+            self._buf = self._map = mmap.mmap(fileobject.fileno(), 0, \
+                                    access=mmap.ACCESS_READ)
+            if start:
+                self._buf = buffer(self._buf, start)
+        self._types = types
+        self._stacks = stacks
+        magic, version, flags, numsections = _header.unpack_from(self._buf)
+        if magic != MAGIC:
+            raise ValueError('not binary trace file')
+        if version != VERSION:
+            raise ValueError('unsupported snapshot version: %d' % version)
+        self.flags = flags
+        self._sections = {}
+        for i in xrange(numsections):
+            name, offset, count = _section.unpack_from(self._buf, \
+                                    _header.size + _section.size * i)
+            self._sections[name.rstrip('\0')] = (offset, count)
+        if flags & FLAG_COMPRESSED:
+            self.heapdir = self._column('heapdir')
+            self.blockdir = self._column('blockdir')
+        else:
+            for name in SnapshotWriter._columns:
+                setattr(self, name, self._column(name))
+
+    def close(self):
+        """Unmaps the file. Views of the snapshot are unusable afterwards"""
+        if self._map is not None:
+            self._buf = None
+            self._map.close()
+            self._map = None
+
+    def _column(self, name):
+        offset, count = self._sections[name]
+        return QwordView(self._buf, offset, count)
+
+    def source(self):
+        """Returns the source stamp (see source_stamp()) or None"""
+        if 'source' not in self._sections:
+            return None
+        return tuple(self._column('source'))
+
+    def block_index(self):
+        """Returns the blockindex.BlockIndex stored in the snapshot (viewing
+        the file) or None
+        """
+        if 'blkindex' not in self._sections:
+            return None
+        from pyumdh.blockindex import BlockIndex
+        offset, count = self._sections['blkindex']
+        return BlockIndex(*[QwordView(self._buf, offset + i*count*8, count) \
+                                for i in xrange(5)])
+
+    def modules(self):
+        """Returns the list of modules"""
+        offset, count = self._sections['modules']
+        modules = []
+        for i in xrange(count):
+            base, size, namelen = struct.unpack_from('<3Q', self._buf, offset)
+            offset += 24
+            name = str(self._buf[offset:offset+namelen])
+            offset += namelen + len(_padding(namelen))
+            modules.append(self._types.module(base, size, name))
+        return modules
+
+    def heaps(self, handles=None):
+        """Returns a dict of handle -> HeapView
+
+        |handles|   handles of the heaps to return (defaults to all)
+
+        Heaps of a compressed snapshot are decompressed block by block into
+        a store.ColumnStore, those of a plain one are views of the file.
+        """
+        directory = [(handle, first, count) for handle, first, count in \
+                        self.directory() if handles is None or handle in handles]
+        if self.flags & FLAG_COMPRESSED:
+            return self._decompress(directory)
+        return dict((handle, HeapView(self, first, count)) \
+                        for handle, first, count in directory)
+
+    def _blocks(self, first, end):
+        """Yields (first row, decoded block) of the compressed blocks holding
+        rows [first, end) (see _decode_block())
+        """
+        values = self.blockdir.tolist()
+        blockdir = zip(values[0::3], values[1::3], values[2::3])
+        # first trace of each block
+        firsts = [0]
+        for rows, _, _ in blockdir:
+            firsts.append(firsts[-1] + rows)
+        base = self._sections['blocks'][0]
+        index = bisect_right(firsts, first) - 1
+        while index < len(blockdir) and firsts[index] < end:
+            rows, offset, size = blockdir[index]
+            yield (firsts[index], _decode_block( \
+                        self._buf[base+offset:base+offset+size], rows))
+            index += 1
+
+    def _decompress(self, directory):
+        store = ColumnStore(self._types, self._stacks)
+        heaps = {}
+        for handle, first, count in directory:
+            row = len(store.traceids)
+            for _, (traceids, stacklens, numsamples, frames, requested, \
+                    overhead, addresses) in self._blocks(first, first + count):
+                stackoff = len(store.frames)
+                store.frames.extend(frames)
+                offsets = []
+                for stacklen in _ints(stacklens):
+                    offsets.append(stackoff)
+                    stackoff += stacklen
+                store._extend_traces(traceids, offsets, stacklens, numsamples)
+                store.extend_samples(requested, overhead, addresses)
+            heaps[handle] = HeapView(store, row, count)
+        return heaps
+
+    def _iter_compressed(self, first, end):
+        for blockfirst, (traceids, stacklens, numsamples, frames, requested, \
+                overhead, addresses) in self._blocks(first, end):
+            stackoff = sampoff = 0
+            for row, (traceid, stacklen, count) in enumerate(izip( \
+                    _ints(traceids), _ints(stacklens), _ints(numsamples)), \
+                    blockfirst):
+                if first <= row < end:
+                    yield (traceid, _ints(frames[stackoff:stackoff+stacklen]), \
+                            zip(_ints(requested[sampoff:sampoff+count]), \
+                                _ints(overhead[sampoff:sampoff+count]), \
+                                _ints(addresses[sampoff:sampoff+count])))
+                stackoff += stacklen
+                sampoff += count
+
+    def iter_traces(self, first, count):
+        """Yields raw (traceid, stack, samples) of rows [first, first+count)
+        as traces() does, decoding _ROWS traces (or a compressed block) at a
+        time so that memory use does not depend on count.
+        """
+        end = first + count
+        if self.flags & FLAG_COMPRESSED:
+            for trace in self._iter_compressed(first, end):
+                yield trace
+            return
+        for start in xrange(first, end, _ROWS):
+            for trace in self.traces(start, min(_ROWS, end - start)):
+                yield trace
+
+    def directory(self):
+        """Returns the heap directory as [(handle, first trace, count)]"""
+        values = self.heapdir.tolist()
+        return zip(values[0::3], values[1::3], values[2::3])
+
+    def trace_ids(self, first, count):
+        """Returns the trace ids of rows [first, first+count) as a list;
+        nothing else is decoded (but the blocks holding them if compressed)
+        """
+        end = first + count
+        if not self.flags & FLAG_COMPRESSED:
+            return self.traceids.tolist(first, end)
+        traceids = []
+        for blockfirst, block in self._blocks(first, end):
+            rows = _ints(block[0])
+            traceids.extend(rows[max(first - blockfirst, 0): \
+                                    end - blockfirst])
+        return traceids
+
+    def traces(self, first, count):
+        """Yields raw (traceid, stack, samples) of rows [first, first+count)
+        decoding the columns in bulk; samples are (requested, overhead,
+        address) tuples. Not available for compressed snapshots.
+        """
+        end = first + count
+        if not count:
+            return
+        traceids = self.traceids.tolist(first, end)
+        stackoff = self.stackoff.tolist(first, end)
+        stacklen = self.stacklen.tolist(first, end)
+        sampoff = self.sampoff.tolist(first, end + 1)
+        base = stackoff[0]
+        frames = self.frames.tolist(base, stackoff[-1] + stacklen[-1])
+        values = self.samples.tolist(sampoff[0]*3, sampoff[-1]*3)
+        samples = zip(values[0::3], values[1::3], values[2::3])
+        for i, traceid in enumerate(traceids):
+            offset = stackoff[i] - base
+            yield (traceid, frames[offset:offset+stacklen[i]], \
+                    samples[sampoff[i]-sampoff[0]:sampoff[i+1]-sampoff[0]])
+
+    def allocations(self, first, end):
+        """Decodes the allocations stored in rows [first, end) in bulk"""
+        allocation, sample = (self._types.allocation, self._types.sample)
+        stacks = self._stacks
+        for _, stack, samples in self.iter_traces(first, end - first):
+            if stacks is not None:
+                stack = stacks.stack(stack)
+            yield allocation(stack=stack, aliases=[], \
+                                allocs=[sample(*s) for s in samples])
+
+    def columns(self, first, end):
+        """Returns (traceids, sampoff, requested, overhead, address) of rows
+        [first, end) as in store.ColumnStore.columns(); numpy arrays viewing
+        the file if numpy is available, lists otherwise.
+        """
+        sampoff = self.sampoff.tolist(first, end + 1)
+        start, stop = (sampoff[0], sampoff[-1])
+        if numpy is not None:
+            samples = self.samples.array[start*3:stop*3]
+            return (self.traceids.array[first:end], \
+                    self.sampoff.array[first:end+1] - start, \
+                    samples[0::3], samples[1::3], samples[2::3])
+        values = self.samples.tolist(start*3, stop*3)
+        return (self.traceids.tolist(first, end), \
+                [offset - start for offset in sampoff], \
+                values[0::3], values[1::3], values[2::3])
+
+    def allocation(self, row):
+        """Decodes the allocation stored in the row-th trace"""
+        stackoff = self.stackoff[row]
+        stack = self.frames[stackoff:stackoff+self.stacklen[row]]
+        if self._stacks is not None:
+            stack = self._stacks.stack(stack)
+        start, end = self.sampoff[row:row+2]
+        values = self.samples[start*3:end*3]
+        sample = self._types.sample
+        allocs = [sample(*values[i:i+3]) for i in xrange(0, len(values), 3)]
+        return self._types.allocation(stack=stack, aliases=[], allocs=allocs)
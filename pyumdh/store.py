@@ -0,0 +1,422 @@
+# vim:ts=4:sw=4:expandtab
+"""Columnar allocation storage.
+
+Instead of an allocation namedtuple per trace holding lists of ints and
+sample namedtuples, allocations are kept in flat arrays of integers:
+
+    trace columns   traceids, stackoff, stacklen (one entry per trace)
+                    sampoff (CSR offsets into the sample columns, one extra
+                    entry terminating the last trace)
+    sample columns  requested, overhead, address
+    frames          all stack frames, indexed by stackoff/stacklen
+
+Trace ids, addresses and frames take 64 bits, the offsets, lengths and
+block sizes 32: those columns are widened only once a value does not fit.
+The heap of a trace is not stored, heaps are ranges of rows (see
+HeapView).
+
+HeapView and AllocationsView provide the dict-like protocol the rest of
+pyumdh expects on top of any store implementing allocation(row).
+
+StackTable interns stacks so that Backtraces of the same process share a
+single copy of each distinct stack.
+"""
+
+import bisect
+from array import array
+from itertools import imap, izip
+from collections import Mapping
+
+__all__ = ['QWORD_TYPECODE', 'DWORD_TYPECODE', 'StackTable', 'ColumnStore', \
+            'HeapBuilder', 'HeapView', 'AllocationsView']
+
+def _qword_typecode():
+    for typecode in ('Q', 'L'):
+        try:
+            if array(typecode).itemsize >= 8:
+                return typecode
+        except ValueError:
+            pass
+    # no 64-bit integer arrays (e.g. python 2 on windows): doubles hold
+    # integers up to 2**53 exactly which covers user mode addresses
+    return 'd'
+
+# typecode of arrays holding 64-bit values
+QWORD_TYPECODE = _qword_typecode()
+
+def _dword_typecode():
+    for typecode in ('I', 'L'):
+        if array(typecode).itemsize == 4:
+            return typecode
+    return QWORD_TYPECODE
+
+# typecode of arrays holding 32-bit values
+DWORD_TYPECODE = _dword_typecode()
+
+if QWORD_TYPECODE == 'd':
+    def _ints(values):
+        return map(int, values)
+else:
+    _ints = list
+
+
+class StackTable(object):
+    """Interns stacks (sequences of frame addresses) by content.
+
+    Each distinct stack is stored once as a tuple and gets an integer id;
+    interning an equal stack returns the same id and the very same tuple, so
+    stacks interned by one table compare by id (or identity). Sharing a
+    table between the Backtraces of one session makes memory grow with new
+    stacks only.
+    """
+    def __init__(self):
+        self._stacks = []
+        # stack -> id
+        self._ids = {}
+
+    def intern(self, stack):
+        """Returns the id of stack, adding it if it has not been seen"""
+        stack = tuple(stack)
+        stackid = self._ids.get(stack)
+        if stackid is None:
+            stackid = self._ids[stack] = len(self._stacks)
+            self._stacks.append(stack)
+        return stackid
+
+    def stack(self, stack):
+        """Returns the interned (shared) copy of stack"""
+        return self._stacks[self.intern(stack)]
+
+    def __getitem__(self, stackid):
+        return self._stacks[stackid]
+
+    def __len__(self):
+        return len(self._stacks)
+
+
+class HeapView(Mapping):
+    """Heap (traceid -> allocation) backed by the columns of a store.
+
+    Traces of a heap occupy rows [first, first+count) of the store and are
+    sorted by trace id; allocations are decoded on access.
+    """
+    def __init__(self, store, first, count):
+        self._store = store
+        self._first = first
+        self._end = first + count
+
+    def _find(self, traceid):
+        traceids = self._store.traceids
+        view = getattr(traceids, 'array', None)
+        if view is not None:
+            # numpy view of a mapped column (see snapshot.QwordView)
+            row = self._first + int(view[self._first:self._end].searchsorted( \
+                                                view.dtype.type(traceid)))
+        else:
+            row = bisect.bisect_left(traceids, traceid, self._first, self._end)
+        if row < self._end and traceids[row] == traceid:
+            return row
+        raise KeyError(traceid)
+
+    def __getitem__(self, traceid):
+        return self._store.allocation(self._find(traceid))
+
+    def __contains__(self, traceid):
+        try:
+            self._find(traceid)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return self._end - self._first
+
+    def __iter__(self):
+        return iter(_ints(self._store.traceids[self._first:self._end]))
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        return izip(self, self._store.allocations(self._first, self._end))
+
+    def itervalues(self):
+        for _, allocation in self.iteritems():
+            yield allocation
+
+    def columns(self):
+        """Returns the heap as columns (see ColumnStore.columns())"""
+        return self._store.columns(self._first, self._end)
+
+
+class AllocationsView(Mapping):
+    """Top-level allocations (traceid -> allocation) of a set of heaps.
+    Looks trace ids up heap by heap instead of indexing them upfront.
+    """
+    def __init__(self, heaps):
+        self._heaps = heaps
+
+    def __getitem__(self, traceid):
+        for heap in self._heaps.itervalues():
+            try:
+                return heap[traceid]
+            except KeyError:
+                pass
+        raise KeyError(traceid)
+
+    def __iter__(self):
+        seen = set()
+        for heap in self._heaps.itervalues():
+            for traceid in heap:
+                if traceid not in seen:
+                    seen.add(traceid)
+                    yield traceid
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class HeapBuilder(object):
+    """Builds the columns of a heap from a stream of allocation records
+    (see backtrace.iter_allocations) w/o materializing the heap as a dict.
+
+    Traces and samples go to the columns of the store in arrival order and
+    are sorted by trace id in place by finish(), so nothing may be added to
+    the store until then. Besides the trace of each sample the only state
+    kept is the trace id -> row entries.
+    """
+    def __init__(self, store):
+        self._store = store
+        # traceid -> row of the trace within the heap
+        self._rows = {}
+        # first trace and sample of the heap
+        self._first = len(store.traceids)
+        self._firstsample = len(store.address)
+        # trace row of each sample
+        self._samplerows = array(DWORD_TYPECODE)
+
+    def add(self, traceid, allocation):
+        row = self._rows.get(traceid)
+        store = self._store
+        if row is None:
+            # the first record of a trace carries the stack
+            row = self._rows[traceid] = len(self._rows)
+            store.append_trace(traceid, len(store.frames), \
+                                len(allocation.stack))
+            store.frames.extend(allocation.stack)
+        samplerows = self._samplerows
+        requested, overhead, address = (store.requested, store.overhead, \
+                                        store.address)
+        for sample in allocation.allocs:
+            samplerows.append(row)
+            try:
+                requested.append(sample[0])
+            except OverflowError:
+                store._append('requested', sample[0])
+                requested = store.requested
+            try:
+                overhead.append(sample[1])
+            except OverflowError:
+                store._append('overhead', sample[1])
+                overhead = store.overhead
+            address.append(sample[2])
+
+    def finish(self):
+        """Appends the heap to the store and returns a HeapView over it"""
+        store, first = (self._store, self._first)
+        numtraces = len(self._rows)
+        self._rows = None
+        counts = array(DWORD_TYPECODE, [0]) * numtraces
+        for row in self._samplerows:
+            counts[row] += 1
+        traceids = store.traceids
+        order = sorted(xrange(numtraces), \
+                        key=lambda row: traceids[first + row])
+        # position of the first sample of each trace within the heap
+        positions = counts
+        offset = 0
+        end = int(store.sampoff[-1])
+        sampoff = []
+        for row in order:
+            count = counts[row]
+            positions[row] = offset
+            offset += count
+            sampoff.append(end + offset)
+        store._extend('sampoff', sampoff)
+        del sampoff
+        ranks = array(DWORD_TYPECODE, [0]) * numtraces
+        for rank, row in enumerate(order):
+            ranks[row] = rank
+        del order
+        store._permute(('traceids', 'stackoff', 'stacklen'), first, ranks)
+        del ranks
+        # the position of each sample keeping the arrival order of a trace
+        destinations = self._samplerows
+        for i, row in enumerate(destinations):
+            destinations[i] = positions[row]
+            positions[row] += 1
+        store._permute(store._sample_columns, self._firstsample, \
+                        destinations)
+        self._samplerows = None
+        return HeapView(store, first, numtraces)
+
+
+class ColumnStore(object):
+    """In-memory columnar storage for the heaps of a Backtrace.
+
+    |types|     provides the sample and allocation record types (see
+                Backtrace)
+    |stacks|    optional StackTable to intern decoded stacks with
+
+    Alias stacks are not kept.
+    """
+    _trace_columns = ('traceids', 'stackoff', 'stacklen', 'sampoff')
+    _sample_columns = ('requested', 'overhead', 'address')
+    # columns of 32-bit values until one does not fit (see _widen())
+    _dword_columns = ('stackoff', 'stacklen', 'sampoff', 'requested', \
+                        'overhead')
+
+    def __init__(self, types, stacks=None):
+        self._types = types
+        self._stacks = stacks
+        for name in self._trace_columns + self._sample_columns + ('frames',):
+            setattr(self, name, array(DWORD_TYPECODE \
+                        if name in self._dword_columns else QWORD_TYPECODE))
+        self.sampoff.append(0)
+
+    def add_heap(self, handle, heap):
+        """Appends the allocations of heap (traceid -> allocation).
+        Returns a HeapView over them.
+        """
+        builder = HeapBuilder(self)
+        for traceid, allocation in heap.iteritems():
+            builder.add(traceid, allocation)
+        return builder.finish()
+
+    def _widen(self, name):
+        """Makes a 32-bit column 64 bits wide"""
+        setattr(self, name, array(QWORD_TYPECODE, getattr(self, name)))
+
+    def _append(self, name, value):
+        try:
+            getattr(self, name).append(value)
+        except OverflowError:
+            self._widen(name)
+            getattr(self, name).append(value)
+
+    def _extend(self, name, values):
+        """Appends a sequence of ints or an array to a column"""
+        column = getattr(self, name)
+        if isinstance(values, array) and values.typecode != column.typecode:
+            values = _ints(values)
+        size = len(column)
+        try:
+            column.extend(values)
+        except OverflowError:
+            # values appended before the one that does not fit stay
+            del column[size:]
+            self._widen(name)
+            getattr(self, name).extend(values)
+
+    def append_trace(self, traceid, stackoff, stacklen):
+        """Appends a trace w/o samples offsets (see HeapBuilder)"""
+        self.traceids.append(traceid)
+        self._append('stackoff', stackoff)
+        self._append('stacklen', stacklen)
+
+    def append_sample(self, requested, overhead, address):
+        """Appends a sample to the sample columns"""
+        self._append('requested', requested)
+        self._append('overhead', overhead)
+        self.address.append(address)
+
+    def extend_samples(self, requested, overhead, address):
+        """Appends the sample columns requested, overhead and address
+        (sequences of ints or arrays)
+        """
+        for name, values in izip(self._sample_columns, \
+                                    (requested, overhead, address)):
+            self._extend(name, values)
+
+    def _permute(self, names, first, destinations):
+        """Moves the entry at first+i of the columns names to
+        first+destinations[i] in place, following the cycles of the
+        permutation
+        """
+        columns = [getattr(self, name) for name in names]
+        done = bytearray(len(destinations))
+        for start in xrange(len(destinations)):
+            if done[start]:
+                continue
+            i = start
+            values = [column[first+i] for column in columns]
+            while not done[i]:
+                done[i] = 1
+                j = first + destinations[i]
+                for k, column in enumerate(columns):
+                    values[k], column[j] = (column[j], values[k])
+                i = destinations[i]
+
+    def _add_traces(self, traces):
+        """Appends rows for (traceid, stackoff, stacklen, numsamples) sorted
+        by trace id. Returns the first row.
+        """
+        first = len(self.traceids)
+        end = int(self.sampoff[-1])
+        for traceid, stackoff, stacklen, numsamples in traces:
+            self.append_trace(traceid, stackoff, stacklen)
+            end += numsamples
+            self._append('sampoff', end)
+        return first
+
+    def _extend_traces(self, traceids, stackoff, stacklen, numsamples):
+        """Bulk counterpart of _add_traces() taking a sequence per column.
+        Returns the first row.
+        """
+        first = len(self.traceids)
+        self._extend('traceids', traceids)
+        self._extend('stackoff', stackoff)
+        self._extend('stacklen', stacklen)
+        end = int(self.sampoff[-1])
+        sampoff = []
+        for count in _ints(numsamples):
+            end += count
+            sampoff.append(end)
+        self._extend('sampoff', sampoff)
+        return first
+
+    def allocation(self, row):
+        """Decodes the allocation stored in the row-th trace"""
+        stackoff = int(self.stackoff[row])
+        stack = _ints(self.frames[stackoff:stackoff+int(self.stacklen[row])])
+        if self._stacks is not None:
+            stack = self._stacks.stack(stack)
+        start, end = (int(self.sampoff[row]), int(self.sampoff[row+1]))
+        sample = self._types.sample
+        allocs = map(sample, _ints(self.requested[start:end]), \
+                        _ints(self.overhead[start:end]), \
+                        _ints(self.address[start:end]))
+        return self._types.allocation(stack=stack, aliases=[], allocs=allocs)
+
+    def allocations(self, first, end):
+        """Decodes the allocations stored in rows [first, end)"""
+        return imap(self.allocation, xrange(first, end))
+
+    def columns(self, first, end):
+        """Returns (traceids, sampoff, requested, overhead, address) of rows
+        [first, end); sampoff has an extra entry and is relative to the first
+        sample of the range.
+        """
+        sampoff = self.sampoff[first:end+1]
+        start, stop = (int(sampoff[0]), int(sampoff[-1]))
+        return (self.traceids[first:end], \
+                array(QWORD_TYPECODE, [offset - start for offset in sampoff]), \
+                self.requested[start:stop], self.overhead[start:stop], \
+                self.address[start:stop])
+
+    def nbytes(self):
+        """Returns the size of the columns in bytes"""
+        return sum(len(getattr(self, name)) * getattr(self, name).itemsize \
+                    for name in self._trace_columns + self._sample_columns + \
+                                ('frames',))
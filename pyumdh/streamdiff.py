@@ -0,0 +1,247 @@
+# vim:ts=4:sw=4:expandtab
+"""Out-of-core diff of two binary snapshots.
+
+Backtrace.diff_with() needs both snapshots loaded. StreamingDiff reads the
+traces of each heap of two v2 snapshots (plain or compressed) as streams -
+they are stored sorted by trace id within a heap (see snapshot) - and joins
+them with a merge:
+
+    traces only in the newer snapshot           added in full
+    traces of both with samples only in newer   added with those samples
+
+Only a batch of traces of either snapshot (see Snapshot.iter_traces()) and
+the samples of the trace at hand are held at any time, so memory use does
+not depend on the snapshot size. The diff goes straight to a binary
+snapshot (save()) or to the report of Backtrace.dump_allocs() (dump_allocs())
+and equals that of diff_with() with the same filter.
+
+Heaps w/o an added trace are left out of the diff, which is only known
+once such a trace shows. Each heap is merged once: its diff is held back
+until then (past _SPOOL_ROWS traces in a temporary file) and dropped if the
+heap ends first.
+
+    diff = StreamingDiff('0.bin', '1.bin')
+    grepfn = filter_on_foreign_module(diff.trace, symbols=sym)
+    diff.dump_allocs(symbols=sym, grepfn=grepfn)
+    diff.close()
+"""
+
+import cPickle
+import os
+import tempfile
+from itertools import chain
+import pyumdh.snapshot as snapshot
+from pyumdh.backtrace import Backtrace
+from pyumdh.heapdiff import unique_samples
+import pyumdh.utils as utils
+
+__all__ = ['StreamingDiff', 'merge_traces']
+
+# traces of a heap held in memory before they are spooled to a file
+_SPOOL_ROWS = 1 << 12
+
+
+def merge_traces(old, new):
+    """Merge joins two streams of (traceid, stack, samples) sorted by trace
+    id. Yields (traceid, stack, samples, oldsamples) for every trace of new;
+    oldsamples is None for traces missing from old.
+    """
+    old = iter(old)
+    oldtrace = next(old, None)
+    for traceid, stack, samples in new:
+        while oldtrace is not None and oldtrace[0] < traceid:
+            oldtrace = next(old, None)
+        if oldtrace is not None and oldtrace[0] == traceid:
+            yield (traceid, stack, samples, oldtrace[2])
+        else:
+            yield (traceid, stack, samples, None)
+
+
+class _Spool(object):
+    """Traces held back until their heap is known to be in the diff; they
+    go to a temporary file every _SPOOL_ROWS traces
+    """
+    def __init__(self):
+        self._rows = []
+        self._file = None
+        self._batches = 0
+
+    def append(self, trace):
+        self._rows.append(trace)
+        if len(self._rows) >= _SPOOL_ROWS:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile()
+            cPickle.dump(self._rows, self._file, 2)
+            self._batches += 1
+            self._rows = []
+
+    def __iter__(self):
+        """Yields the traces in order and closes the spool"""
+        if self._file is not None:
+            self._file.seek(0)
+            for _ in xrange(self._batches):
+                for trace in cPickle.load(self._file):
+                    yield trace
+        for trace in self._rows:
+            yield trace
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._rows = []
+
+
+class _Heap(object):
+    """Heap of a StreamingDiff over its stream of traces"""
+    def __init__(self, traces):
+        self._traces = traces
+
+    def iteritems(self):
+        allocation, sample = (Backtrace.allocation, Backtrace.sample)
+        for traceid, stack, samples in self._traces:
+            yield (traceid, allocation(stack=stack, aliases=[], \
+                                    allocs=[sample(*s) for s in samples]))
+
+
+class _Heaps(object):
+    """Heaps of a StreamingDiff for Backtrace.dump_allocs()"""
+    def __init__(self, heaps):
+        self._heaps = heaps
+
+    def iteritems(self):
+        for handle, traces in self._heaps:
+            yield (handle, _Heap(traces))
+
+
+class StreamingDiff(object):
+    """Diff of two binary snapshots computed as they are read.
+
+    |old|, |new|    paths or files of v2 snapshots of the same process
+
+    The legacy binary format has no sorted columns to stream and is
+    rejected (ValueError).
+    """
+    def __init__(self, old, new):
+        self._files = []
+        self._old = self._open(old)
+        self._new = self._open(new)
+        # module registry of the diff (for filters and symbols)
+        self.trace = Backtrace(stacks=None)
+        for m in self._new.modules():
+            self.trace._modules.setdefault(os.path.basename(m.ModuleName), m)
+        olddir = dict((handle, (first, count)) for handle, first, count \
+                        in self._old.directory())
+        # (handle, old rows, new rows) of the heaps in both snapshots
+        self._heaps = [(handle, olddir[handle], (first, count)) \
+                        for handle, first, count in \
+                        sorted(self._new.directory()) \
+                        if handle in olddir and count]
+
+    def _open(self, fileobject):
+        if isinstance(fileobject, basestring):
+            fileobject = open(fileobject, 'rb')
+            self._files.append(fileobject)
+        return snapshot.Snapshot(fileobject, Backtrace)
+
+    def close(self):
+        for s in (self._old, self._new):
+            s.close()
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def _merge(self, handle):
+        for h, old, new in self._heaps:
+            if h == handle:
+                return merge_traces(self._old.iter_traces(*old), \
+                                    self._new.iter_traces(*new))
+        raise KeyError(handle)
+
+    def _has_added(self, handle, grepfn):
+        """Checks if a trace only in the newer heap passes grepfn; heaps
+        w/o one are left out of the diff (as by Backtrace.diff_with())
+        """
+        allocation, sample = (Backtrace.allocation, Backtrace.sample)
+        for traceid, stack, samples, oldsamples in self._merge(handle):
+            if oldsamples is None and grepfn((traceid, allocation( \
+                    stack=stack, aliases=[], \
+                    allocs=[sample(*s) for s in samples]))):
+                return True
+        return False
+
+    def _diff_heap(self, handle, grepfn):
+        """Yields (traceid, stack, samples, added) of the diff of a heap;
+        added is True for traces only in the newer heap
+        """
+        allocation, sample = (Backtrace.allocation, Backtrace.sample)
+        for traceid, stack, samples, oldsamples in self._merge(handle):
+            if samples == oldsamples:
+                continue
+            alloc = allocation(stack=stack, aliases=[], \
+                                allocs=[sample(*s) for s in samples])
+            if oldsamples is None:
+                if grepfn((traceid, alloc)):
+                    yield (traceid, stack, samples, True)
+                continue
+            oldsamples = frozenset(oldsamples)
+            fresh = [s for s in samples if s not in oldsamples]
+            # skip over this trace if the grep is negative
+            if fresh and grepfn((None, alloc)):
+                yield (traceid, stack, unique_samples(fresh), False)
+
+    def _diff_heaps(self, grepfn):
+        """Yields (handle, traces) of the heaps of the diff; traces yields
+        (traceid, stack, samples) and must be consumed before the next heap
+        """
+        for handle, _, _ in self._heaps:
+            traces = self._diff_heap(handle, grepfn)
+            spool = _Spool()
+            for trace in traces:
+                if trace[3]:
+                    break
+                spool.append(trace[:3])
+            else:
+                spool.close()
+                continue
+            yield (handle, chain(spool, (trace[:3],), \
+                                    (t[:3] for t in traces)))
+
+    def handles(self, grepfn=None):
+        """Returns the handles of the heaps of the diff"""
+        grepfn = grepfn or bool
+        return [handle for handle, _, _ in self._heaps \
+                    if self._has_added(handle, grepfn)]
+
+    def save(self, fileobject, grepfn=None, compress=False):
+        """Writes the diff as a binary snapshot (see Backtrace.load())
+
+        |grepfn|    filter to run on allocations
+                    must comply to the filter protocol
+        |compress|  write a compressed snapshot
+        """
+        grepfn = grepfn or bool
+        try:
+            fileobject, close = utils.file_open(fileobject, 'wb')
+            writer = snapshot.SnapshotWriter(fileobject, compress=compress)
+            for m in self._new.modules():
+                writer.add_module(m)
+            for handle, traces in self._diff_heaps(grepfn):
+                writer.add_heap(handle, traces)
+            writer.close()
+        finally:
+            if close:
+                fileobject.close()
+
+    def dump_allocs(self, symbols=None, grepfn=None, fileobject=None):
+        """Dumps the diff as Backtrace.dump_allocs() does
+
+        |grepfn|    filter to run on allocations
+                    must comply to the filter protocol
+        """
+        grepfn = grepfn or bool
+        report = Backtrace(stacks=None)
+        report._modules = self.trace._modules
+        report._heaps = _Heaps(self._diff_heaps(grepfn))
+        report.dump_allocs(symbols=symbols, fileobject=fileobject)
@@ -0,0 +1,112 @@
+# vim:ts=4:sw=4:expandtab
+"""Batch symbolization of stack frames.
+
+Stacks share most of their frames, so resolving symbols frame by frame asks
+the symbol provider about the same hot addresses over and over. A
+SymbolTable resolves the unique addresses of a set of stacks at once, each
+a single time, and keeps
+
+    symbol ids  (symbol, module name) resolved so far, each once, along
+                with its module!symbol name (as filters match it)
+    frames      address -> (symbol id, displacement)
+
+Addresses are resolved in sorted order: modules do not overlap, so that is
+module by module and by rva within a module, which keeps the provider (and
+its caches) on one module at a time. Filters and dumps then look frames up
+in the table; addresses missing from it are resolved on first use and
+added. SymbolTable implements sym_from_addr() of the symbol provider
+protocol, so it may be passed wherever a provider is expected.
+
+    table = SymbolTable(symbols)
+    table.add(trace, frames(alloc.stack for alloc in heap.itervalues()))
+"""
+
+from ctypes import c_ulonglong
+from pyumdh.symprovider import format_symbol_module
+
+__all__ = ['SymbolTable', 'symbol_table', 'frames']
+
+
+def frames(stacks):
+    """Returns the set of unique frame addresses of stacks"""
+    addresses = set()
+    for stack in stacks:
+        addresses.update(stack)
+    return addresses
+
+def symbol_table(symbols):
+    """Returns symbols if it is a SymbolTable, a table over it otherwise"""
+    if isinstance(symbols, SymbolTable):
+        return symbols
+    return SymbolTable(symbols)
+
+
+class SymbolTable(object):
+    """Symbols of frame addresses, each resolved once (see above).
+
+    |symbols|   symbol provider to resolve addresses with
+
+    lookups counts the addresses resolved by the provider.
+    """
+    def __init__(self, symbols):
+        self.symbols = symbols
+        # address -> (symbol id, displacement)
+        self._frames = {}
+        # (symbol, module name) -> symbol id
+        self._ids = {}
+        # by symbol id
+        self._symbols = []
+        self._names = []
+        self.lookups = 0
+
+    def __len__(self):
+        """Returns the number of addresses resolved"""
+        return len(self._frames)
+
+    def __contains__(self, addr):
+        return addr in self._frames
+
+    def add(self, trace, addresses):
+        """Resolves the addresses not in the table yet in sorted order.
+
+        |trace|     module registry of the addresses
+        """
+        for addr in sorted(addr for addr in addresses \
+                            if addr not in self._frames):
+            self._resolve(trace, addr)
+
+    def _resolve(self, trace, addr):
+        symbol, disp, module_name = self.symbols.sym_from_addr(trace, addr)
+        self.lookups += 1
+        key = (symbol, module_name)
+        symid = self._ids.get(key)
+        if symid is None:
+            symid = self._ids[key] = len(self._symbols)
+            self._symbols.append(key)
+            self._names.append('%s!%s' % (format_symbol_module(module_name), \
+                                            symbol))
+        frame = self._frames[addr] = (symid, disp.value)
+        return frame
+
+    def symbol_id(self, trace, addr):
+        """Returns the symbol id of an address"""
+        frame = self._frames.get(addr)
+        if frame is None:
+            frame = self._resolve(trace, addr)
+        return frame[0]
+
+    def symbol(self, symid):
+        """Returns the (symbol, module name) of a symbol id"""
+        return self._symbols[symid]
+
+    def name(self, symid):
+        """Returns module!symbol of a symbol id"""
+        return self._names[symid]
+
+    def sym_from_addr(self, trace, addr):
+        """Symbol provider protocol (see symprovider.SymbolProvider)"""
+        frame = self._frames.get(addr)
+        if frame is None:
+            frame = self._resolve(trace, addr)
+        symbol, module_name = self._symbols[frame[0]]
+        return (symbol, c_ulonglong(frame[1]), module_name)
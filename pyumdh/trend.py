@@ -0,0 +1,149 @@
+# vim:ts=4:sw=4:expandtab
+"""Growth trends of traces over a series of snapshots.
+
+Snapshots are aggregated one at a time: per snapshot only the number of
+live blocks and their bytes (requested + overhead) are kept per trace id,
+summed over heaps, so a series of any length costs a few numbers per trace
+and snapshot rather than the snapshots themselves.
+
+For every trace the series yields
+
+    counts, bytes   live blocks and bytes at each snapshot
+    slope           least squares growth in bytes per snapshot since the
+                    trace first appeared
+    monotonic       bytes never dropped and grew overall
+    persistent      the trace stayed live ever since it first appeared
+    score           leak likelihood: the slope weighted by the share of
+                    steps that did not shrink, halved for non persistent
+                    traces (0 unless the slope is positive)
+"""
+
+from array import array
+from collections import namedtuple
+from itertools import izip
+import pyumdh.heapdiff as heapdiff
+from pyumdh.store import QWORD_TYPECODE
+
+__all__ = ['trend', 'SeriesTrend', 'analyze']
+
+trend = namedtuple('trend', 'traceid counts bytes slope monotonic ' \
+                    'persistent score')
+
+
+def _slope(values):
+    """Least squares slope of values over their indices"""
+    n = len(values)
+    if n < 2:
+        return 0.0
+    meanx = (n - 1) / 2.0
+    meany = sum(values) / float(n)
+    num = sum((x - meanx) * (y - meany) for x, y in enumerate(values))
+    den = sum((x - meanx) ** 2 for x in xrange(n))
+    return num / den
+
+
+class SeriesTrend(object):
+    """Per-trace growth over snapshots added in order (see add()).
+
+    |backtraces| optional iterable of Backtraces to add right away
+    """
+    def __init__(self, backtraces=()):
+        # traceid -> slot in the per-snapshot columns
+        self._slots = {}
+        self._traceids = []
+        # per snapshot: live blocks and bytes per slot
+        self._counts = []
+        self._bytes = []
+        # the last snapshot added, for the stacks of live traces
+        self._last = None
+        for backtrace in backtraces:
+            self.add(backtrace)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, backtrace):
+        """Aggregates the next snapshot of the series"""
+        slots = self._slots
+        totals = []
+        for heap in backtrace._heaps.itervalues():
+            traceids, counts, sizes = heapdiff.totals(heap)
+            for traceid in traceids:
+                if traceid not in slots:
+                    slots[traceid] = len(self._traceids)
+                    self._traceids.append(traceid)
+            totals.append((traceids, counts, sizes))
+        numslots = len(self._traceids)
+        counts = array(QWORD_TYPECODE, [0]) * numslots
+        sizes = array(QWORD_TYPECODE, [0]) * numslots
+        for traceids, tracecounts, tracesizes in totals:
+            for traceid, count, size in izip(traceids, tracecounts, \
+                                                tracesizes):
+                slot = slots[traceid]
+                counts[slot] += count
+                sizes[slot] += size
+        self._counts.append(counts)
+        self._bytes.append(sizes)
+        self._last = backtrace
+
+    def _series(self, column, slot):
+        return [int(values[slot]) if slot < len(values) else 0 \
+                    for values in column]
+
+    def trends(self):
+        """Yields a trend per trace id seen in the series"""
+        for slot, traceid in enumerate(self._traceids):
+            counts = self._series(self._counts, slot)
+            sizes = self._series(self._bytes, slot)
+            first = next((i for i, count in enumerate(counts) if count), 0)
+            span = sizes[first:]
+            slope = _slope(span)
+            steps = len(span) - 1
+            growing = sum(1 for a, b in izip(span, span[1:]) if b >= a)
+            monotonic = steps > 0 and growing == steps and span[-1] > span[0]
+            persistent = all(counts[first:])
+            score = 0.0
+            if slope > 0:
+                score = slope * growing / steps * (1.0 if persistent else 0.5)
+            yield trend(traceid, counts, sizes, slope, monotonic, \
+                        persistent, score)
+
+    def ranked(self, limit=None):
+        """Returns trends sorted by leak likelihood (see trend.score)"""
+        ranked = sorted(self.trends(), key=lambda t: (t.score, t.bytes[-1]), \
+                        reverse=True)
+        return ranked[:limit] if limit is not None else ranked
+
+    def dump(self, symbols=None, limit=20, fileobject=None):
+        """Dumps the |limit| traces most likely to leak along with the
+        stacks of those still live in the last snapshot.
+        """
+        backtrace = self._last
+        print_ = backtrace._print
+        print_('Growth over %d snapshots:' % len(self), fileobject)
+        for t in self.ranked(limit):
+            print_('Traceid: 0x%x score=%.1f slope=%.1f bytes/snapshot%s%s' % \
+                    (t.traceid, t.score, t.slope, \
+                        ' monotonic' if t.monotonic else '', \
+                        ' persistent' if t.persistent else ''), fileobject)
+            print_('Blocks: %s' % ' '.join(map(str, t.counts)), fileobject)
+            print_('Bytes: %s' % ' '.join(map(str, t.bytes)), fileobject)
+            if symbols is not None and t.counts[-1]:
+                backtrace._dump_stack(backtrace._allocs[t.traceid].stack, \
+                        symbols=symbols, fileobject=fileobject)
+
+
+def analyze(snapshots, stacks=None):
+    """Aggregates a series of snapshots in one pass.
+
+    |snapshots| iterable of Backtraces or paths of binary snapshots or logs;
+                paths are loaded one at a time and dropped once aggregated
+    |stacks|    store.StackTable to load snapshots with
+    """
+    from pyumdh.backtrace import load_backtrace
+    series = SeriesTrend()
+    for snapshot in snapshots:
+        if isinstance(snapshot, basestring):
+            snapshot = load_backtrace(snapshot, stacks)
+        series.add(snapshot)
+    return series
@@ -5,14 +5,15 @@
 import os
 import sys
 import pdb
+import sqlite3
+import tempfile
 import types
-try:
-    import cpickle as pickle
-except ImportError:
-    import pickle
+from contextlib import contextmanager
+from ctypes import c_ulonglong
 
-__all__ = ['file_open', 'SymProxy', 'module_to_dict', 'module_path', \
-            'data_dir', 'Attributify', 'frozen', 'duplicate_levels']
+__all__ = ['file_open', 'atomic_file', 'SymProxy', 'module_to_dict', \
+            'module_path', 'data_dir', 'Attributify', 'frozen', \
+            'duplicate_levels']
 
 def frozen():
     return hasattr(sys, 'frozen')
@@ -51,6 +52,25 @@ def file_open(fileobject, mode):
         close = True
     return (fileobject, close)
 
+@contextmanager
+def atomic_file(path, mode='wb'):
+    """Opens a temporary file next to path that replaces path once the block
+    completes; path is left untouched if the block fails or the process dies.
+    """
+    fd, temppath = tempfile.mkstemp(prefix=os.path.basename(path) + '.', \
+            suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, mode) as fileobject:
+            yield fileobject
+        if os.name == 'nt' and os.path.exists(path):
+            # rename does not replace files on windows
+            os.remove(path)
+        os.rename(temppath, path)
+    except:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+
 # thanks to stackoverflow.com for the idea
 def fmt_size(size):
     for klass in ['bytes', 'K', 'Mb', 'Gb']:
@@ -91,6 +111,53 @@ class Attributify(object):
     def iteritems(self):
         return self._dict.iteritems()
 
+_SQLITE_HEADER = 'SQLite format 3\0'
+# first opcodes of a pickled dict: protocol 2, protocol 0 (MARK) and
+# protocol 1 (EMPTY_DICT)
+_PICKLE_HEADERS = ('\x80\x02', '(', '}')
+
+def _is_pickled_symcache(path):
+    """Checks if path holds a symbol cache of the former pickled format,
+    judging by the first bytes of the file
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(2)
+    except IOError:
+        return False
+    return header.startswith(_PICKLE_HEADERS)
+
+def _open_symcache(path):
+    """Opens (creating if needed) the sqlite symbol cache of SymProxy.
+
+    A cache of the former pickled format (keyed by rva only, so it cannot
+    be converted) is moved aside to path.old; other files that are not
+    sqlite databases are left alone (ValueError). Empty files are databases
+    being created by another process.
+    """
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            sqlite = f.read(len(_SQLITE_HEADER)) == _SQLITE_HEADER
+        if not sqlite:
+            if not _is_pickled_symcache(path):
+                raise ValueError('not a symbol cache: %s' % path)
+            try:
+                if os.path.exists(path + '.old'):
+                    os.remove(path + '.old')
+                os.rename(path, path + '.old')
+            except OSError:
+                # moved aside by another process meanwhile
+                if os.path.exists(path) and _is_pickled_symcache(path):
+                    raise
+    # concurrent writers wait for each other
+    db = sqlite3.connect(path, timeout=60)
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS symbols (module TEXT, ' \
+                    'size INTEGER, rva INTEGER, symbol TEXT, disp INTEGER, ' \
+                    'modulename TEXT, PRIMARY KEY (module, size, rva))')
+    return db
+
+
 class SymPassthrough(object):
     def __init__(self, symbols):
         self._symbols = symbols
@@ -100,38 +167,68 @@ class SymPassthrough(object):
         pass
 
 class SymProxy(object):
-    """Basic symbol caching proxy capable of serializing itself in binary form."""
+    """Symbol caching proxy persisting symbols in an sqlite database.
+
+    Symbols are keyed by (module name, image size, rva), so that equal
+    offsets into different modules (or builds of a module) do not collide.
+    Lookups go to the database lazily, an address at a time, and are kept in
+    memory for the rest of the run. save() adds the symbols resolved since
+    the last save in a single transaction, so differ processes can share a
+    cache file: sqlite locks it while one of them writes.
+
+    A cache file in the former pickled format (keyed by rva only) is moved
+    aside (see _open_symcache()). Unlike the pickling proxy, save() writes
+    to the database only and there is no load(): the database is read as
+    symbols are looked up.
+    """
     def __init__(self, symbols, cachefile):
         self._symbols = symbols
+        # (module name, image size, rva) -> [frequency, symbol]
         self._symcache = {}
+        # rows resolved by the symbol provider and not saved yet
+        self._pending = []
         self._cachefile = cachefile
-        if cachefile and os.path.exists(cachefile):
-            self.load()
+        self._db = _open_symcache(cachefile) if cachefile else None
 
     def sym_from_addr(self, trace, addr):
         module = trace.map_to_module(addr)
         if module:
             rva = addr - module.BaseOfImage
-            sym = self._symcache.get(rva)
+            key = (module.ModuleName, module.SizeOfImage, rva)
+            sym = self._symcache.get(key)
             if not sym:
-                sym = self._symbols.sym_from_addr(trace, addr)
-                sym = self._symcache.setdefault(rva, [0, sym])
+                sym = self._symcache[key] = [0, self._lookup(trace, addr, \
+                                                                key)]
             sym[0] += 1
             return sym[1]
         else:
-            return self._symbols.sym_from_addr(addr)
-
-    def save(self, fileobject=None):
-        fileobject, close = file_open(fileobject or self._cachefile, 'wb')
-        pickle.dump(self._symcache, fileobject)
-        if close:
-            fileobject.close()
-
-    def load(self, fileobject=None):
-        fileobject, close = file_open(fileobject or self._cachefile, 'rb')
-        self._symcache = pickle.load(fileobject)
-        if close:
-            fileobject.close()
+            return self._symbols.sym_from_addr(trace, addr)
+
+    def _lookup(self, trace, addr, key):
+        if self._db is not None:
+            row = self._db.execute('SELECT symbol, disp, modulename FROM ' \
+                    'symbols WHERE module = ? AND size = ? AND rva = ?', \
+                    key).fetchone()
+            if row is not None:
+                return (row[0], c_ulonglong(row[1]), row[2])
+        sym = self._symbols.sym_from_addr(trace, addr)
+        self._pending.append(key + (sym[0], sym[1].value, sym[2]))
+        return sym
+
+    def save(self):
+        """Adds the symbols resolved since the last save to the cache"""
+        if self._db is None or not self._pending:
+            return
+        with self._db:
+            self._db.executemany('INSERT OR IGNORE INTO symbols VALUES ' \
+                                    '(?, ?, ?, ?, ?, ?)', self._pending)
+        self._pending = []
+
+    def close(self):
+        self.save()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
 
     def dump_stats(self, fileobject=None):
         import sys
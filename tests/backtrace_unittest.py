@@ -1,16 +1,43 @@
 
-from pyumdh.backtrace import Backtrace
+from pyumdh.backtrace import Backtrace, iter_allocations
+from pyumdh.store import StackTable, ColumnStore, DWORD_TYPECODE
+import pyumdh.heapdiff as heapdiff
+import pyumdh.blockindex as blockindex
+from pyumdh.calltree import CallTree
+import pyumdh.parallel as parallel
+import pyumdh.trend as trend
+import pyumdh.diffchain as diffchain
+import pyumdh.duplicates as duplicates
+import pyumdh.filters as filters
+import pyumdh.snapshot as snapshot
+import pyumdh.streamdiff as streamdiff
+from pyumdh.streamdiff import StreamingDiff
+import pyumdh.utils as utils
 from unittest import TestCase, main
+from cStringIO import StringIO
+from ctypes import c_ulonglong
+import difflib
 import os
+import pickle
+import shutil
+import tempfile
 import pdb
 
+class _Symbols(object):
+    def sym_from_addr(self, trace, addr):
+        return ('sym', c_ulonglong(0), 'module.dll')
+
 class BacktraceParseTest(TestCase):
     def setUp(self):
         self._trace = Backtrace('test.log')
+        # directory of the files a test needs besides test.tmp
+        self._datadir = tempfile.mkdtemp()
 
     def tearDown(self):
-        if os.path.exists('test.tmp'):
-            os.remove('test.tmp')
+        for path in ('test.tmp', 'test.tmp.old'):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(self._datadir)
 
     def test_Common(self):
         self.assertEquals(len(self._trace._modules), 17)
@@ -33,5 +60,753 @@ class BacktraceParseTest(TestCase):
         self.assertEquals(len(dummy._heaps[0x2E60000]), \
                             len(self._trace._heaps[0x2E60000]))
 
+    def _assertSameAllocs(self, trace):
+        self.assertEquals(trace._modules, self._trace._modules)
+        self.assertEquals(sorted(trace._heaps), sorted(self._trace._heaps))
+        for handle, heap in self._trace._heaps.iteritems():
+            other = trace._heaps[handle]
+            self.assertEquals(sorted(other), sorted(heap))
+            for traceid, alloc in heap.iteritems():
+                self.assertEquals(list(other[traceid].stack), \
+                                    list(alloc.stack))
+                self.assertEquals(other[traceid].allocs, alloc.allocs)
+        self.assertEquals(sorted(trace._allocs), sorted(self._trace._allocs))
+
+    def test_SaveLoadSnapshot(self):
+        self._trace.save('test.tmp')
+        with open('test.tmp', 'rb') as f:
+            self.assertEquals(f.read(8), 'umdhsnap')
+        dummy = Backtrace()
+        dummy.load('test.tmp')
+        self._assertSameAllocs(dummy)
+        self.assertEquals(len(dummy._allocs[0x1AF07D3C].allocs), 3)
+
+    def test_SaveLoadLegacy(self):
+        self._trace.save('test.tmp', version=1)
+        dummy = Backtrace()
+        dummy.load('test.tmp')
+        self._assertSameAllocs(dummy)
+
+    def test_SaveLoadCompressed(self):
+        self._trace.save('test.tmp', compress=True)
+        dummy = Backtrace()
+        dummy.load('test.tmp')
+        self.assertTrue(dummy._snapshot.flags & snapshot.FLAG_COMPRESSED)
+        self._assertSameAllocs(dummy)
+        self.assertEquals(dummy._source, self._trace._source)
+        dummy = Backtrace()
+        dummy.load('test.tmp', heaps=[0x2E60000])
+        self.assertEquals(dummy._heaps.keys(), [0x2E60000])
+        self.assertEquals(len(dummy._allocs[0x1AF07D3C].allocs), 3)
+        parallel.convert('test.log', 'test.tmp', processes=2, chunksize=256, \
+                            compress=True)
+        dummy = Backtrace()
+        dummy.load('test.tmp')
+        self._assertSameAllocs(dummy)
+
+    def test_LoadHeaps(self):
+        for version in (1, snapshot.VERSION):
+            self._trace.save('test.tmp', version=version)
+            dummy = Backtrace()
+            dummy.load('test.tmp', heaps=[0x1D890000])
+            self.assertEquals(dummy._heaps.keys(), [0x1D890000])
+            self.assertEquals(len(dummy._allocs), 0)
+            dummy = Backtrace()
+            dummy.load('test.tmp', heaps=[0x2E60000])
+            self.assertEquals(dummy._heaps.keys(), [0x2E60000])
+            self.assertEquals(len(dummy._modules), 17)
+            self.assertEquals(len(dummy._allocs[0x1AF07D3C].allocs), 3)
+            for traceid, alloc in self._trace._heaps[0x2E60000].iteritems():
+                other = dummy._heaps[0x2E60000][traceid]
+                self.assertEquals(list(other.stack), list(alloc.stack))
+                self.assertEquals(other.allocs, alloc.allocs)
+
+    def test_Columnar(self):
+        trace = Backtrace('test.log', columnar=True)
+        self._assertSameAllocs(trace)
+        self.assertEquals(len(trace._heaps[0x1D890000]), 0)
+        self.assertTrue(0x1BA12BFA in trace._heaps[0x2E60000])
+        self.assertFalse(0x1BA12BFB in trace._heaps[0x2E60000])
+        self._trace.compact()
+        self._assertSameAllocs(trace)
+        self.assertEquals(trace._store.requested.typecode, DWORD_TYPECODE)
+        # 32-bit columns are widened for values that do not fit
+        samples = [Backtrace.sample(0x10, 0x8, 0x2E9FF00), \
+                    Backtrace.sample(1 << 40, 0x8, 0x2E9FF40)]
+        columns = ColumnStore(trace)
+        heap = columns.add_heap(0x2E60000, {0x1AF00000: \
+                    Backtrace.allocation(stack=[0x10], aliases=[], \
+                                        allocs=samples)})
+        self.assertEquals(heap[0x1AF00000].allocs, samples)
+        self.assertEquals(columns.overhead.typecode, DWORD_TYPECODE)
+        self.assertNotEquals(columns.requested.typecode, DWORD_TYPECODE)
+
+    def test_SharedStacks(self):
+        stacks = StackTable()
+        trace = Backtrace('test.log', stacks=stacks)
+        other = Backtrace('test.log', stacks=stacks)
+        numstacks = len(stacks)
+        heap, otherheap = (trace._heaps[0x2E60000], other._heaps[0x2E60000])
+        for traceid, alloc in heap.iteritems():
+            self.assertTrue(alloc.stack is otherheap[traceid].stack)
+        self.assertEquals(stacks.intern(heap[0x1AF06BFC].stack), \
+                            stacks.intern(list(heap[0x1AF06BFC].stack)))
+        self._trace.save('test.tmp')
+        loaded = Backtrace(stacks=stacks)
+        loaded.load('test.tmp')
+        diff = trace.diff_with(loaded)
+        for traceid, alloc in loaded._heaps[0x2E60000].iteritems():
+            self.assertTrue(alloc.stack is heap[traceid].stack)
+        self.assertEquals(len(stacks), numstacks)
+
+    def test_Diff(self):
+        newer = Backtrace('test.log')
+        heap = newer._heaps[0x2E60000]
+        sample = Backtrace.sample(0x10, 0x8, 0x2E9FF00)
+        heap[0x1AF07D3C].allocs.append(sample)
+        heap[0x1AF00000] = heap[0x1AF083B4]._replace(allocs=[sample])
+        expected = {0x1AF00000: [sample], 0x1AF07D3C: [sample]}
+        numpy = heapdiff.numpy
+        try:
+            for engine in (numpy, None):
+                heapdiff.numpy = engine
+                diff = self._trace.diff_with(newer)
+                self.assertEquals(diff._heaps.keys(), [0x2E60000])
+                self.assertEquals(dict((traceid, alloc.allocs) for traceid, \
+                                    alloc in diff._heaps[0x2E60000].items()), \
+                                    expected)
+                self.assertEquals(list(diff._allocs[0x1AF07D3C].stack), \
+                                    list(heap[0x1AF07D3C].stack))
+                newer.save('test.tmp')
+                loaded = Backtrace()
+                loaded.load('test.tmp')
+                for trace in (Backtrace('test.log', columnar=True), \
+                                self._trace):
+                    diff = trace.diff_with(loaded)
+                    self.assertEquals(sorted(diff._heaps[0x2E60000]), \
+                                        sorted(expected))
+                    self.assertEquals(diff._heaps[0x2E60000][0x1AF07D3C]. \
+                                        allocs, [sample])
+                self.assertEquals(self._trace.diff_with(self._trace)._heaps, \
+                                    {})
+        finally:
+            heapdiff.numpy = numpy
+
+    def test_CrossHeapDiff(self):
+        newer = Backtrace('test.log')
+        # the heap is recreated under a new handle
+        heap = newer._heaps.pop(0x2E60000)
+        newer._heaps[0x7770000] = heap
+        sample = Backtrace.sample(0x10, 0x8, 0x2E9FF00)
+        heap[0x1AF07D3C].allocs.append(sample)
+        heap[0x1AF00000] = heap[0x18D0A0D0]._replace(allocs=[sample])
+        expected = {0x1AF00000: [sample], 0x1AF07D3C: [sample]}
+        numpy = heapdiff.numpy
+        try:
+            for engine in (numpy, None):
+                heapdiff.numpy = engine
+                self.assertEquals(self._trace.diff_with(newer)._heaps, {})
+                for trace in (self._trace, Backtrace('test.log', \
+                                                        columnar=True)):
+                    diff = trace.diff_with(newer, crossheap=True)
+                    self.assertEquals(diff._heaps.keys(), [0x7770000])
+                    self.assertEquals(dict((traceid, alloc.allocs) for \
+                                        traceid, alloc in \
+                                        diff._heaps[0x7770000].items()), \
+                                        expected)
+                index = heapdiff.AddressIndex(self._trace._heaps)
+                self.assertEquals(len(index), 11)
+                self.assertEquals(index.find([0x1AF07D3C], [0, 2], \
+                                    [heap[0x1AF07D3C].allocs[0].address, \
+                                    sample.address]), [0x2E60000, None])
+        finally:
+            heapdiff.numpy = numpy
+
+    def test_StreamingDiff(self):
+        newer = Backtrace('test.log')
+        heap = newer._heaps[0x2E60000]
+        sample = Backtrace.sample(0x10, 0x8, 0x2E9FF00)
+        heap[0x1AF07D3C].allocs.append(sample)
+        heap[0x1AF00000] = heap[0x18D0A0D0]._replace(allocs=[sample])
+        expected = {0x1AF00000: [sample], 0x1AF07D3C: [sample]}
+        for compress in (False, True):
+            files = [StringIO(), StringIO()]
+            self._trace.save(files[0], compress=compress)
+            newer.save(files[1], compress=compress)
+            for f in files:
+                f.seek(0)
+            diff = StreamingDiff(*files)
+            self.assertEquals(diff.handles(), [0x2E60000])
+            self.assertEquals(diff.handles(lambda item: False), [])
+            merges = []
+            merge = diff._merge
+            diff._merge = lambda handle: merges.append(handle) or \
+                                            merge(handle)
+            out = StringIO()
+            diff.save(out)
+            # each heap is merged once
+            self.assertEquals(merges, [0x2E60000])
+            out.seek(0)
+            loaded = Backtrace()
+            loaded.load(out)
+            self.assertEquals(dict((traceid, alloc.allocs) for traceid, \
+                                alloc in loaded._heaps[0x2E60000].items()), \
+                                expected)
+            self.assertEquals(list(loaded._allocs[0x1AF00000].stack), \
+                                list(heap[0x18D0A0D0].stack))
+            report = StringIO()
+            diff.dump_allocs(symbols=_Symbols(), fileobject=report)
+            self.assertEquals(report.getvalue().count('Traceid:'), 2)
+            self.assertEquals(report.getvalue().count('!sym+'), 32)
+            self.assertTrue('Traceid: 0x1af00000' in report.getvalue())
+            diff.close()
+        # traces held back before the first added one keep their order
+        rows = streamdiff._SPOOL_ROWS
+        try:
+            streamdiff._SPOOL_ROWS = 2
+            spool = streamdiff._Spool()
+            traces = [(i, [i], [(i, 8, i)]) for i in range(5)]
+            for trace in traces:
+                spool.append(trace)
+            self.assertEquals(list(spool), traces)
+        finally:
+            streamdiff._SPOOL_ROWS = rows
+
+    def test_Growth(self):
+        newer = Backtrace('test.log')
+        heap = newer._heaps[0x2E60000]
+        heap[0x1AF07D3C].allocs.append(Backtrace.sample(0x10, 0x8, 0x2E9FF00))
+        del heap[0x1AF083B4]
+        numpy = heapdiff.numpy
+        try:
+            for engine in (numpy, None):
+                heapdiff.numpy = engine
+                top = self._trace.top_growth(newer)
+                self.assertEquals([(d.traceid, d.count, d.bytes) \
+                                    for d in top], \
+                                    [(0x1AF07D3C, 1, 0x18), \
+                                    (0x1AF083B4, -2, -0x100)])
+                self.assertEquals(top[0].handle, 0x2E60000)
+                self.assertEquals(self._trace.top_growth(newer, 1, \
+                                    '-count')[0].traceid, 0x1AF083B4)
+                grepfn = lambda item: item[0] != 0x1AF07D3C
+                self.assertEquals([d.traceid for d in self._trace. \
+                                    top_growth(newer, grepfn=grepfn)], \
+                                    [0x1AF083B4])
+                self.assertEquals(self._trace.top_growth(self._trace), [])
+        finally:
+            heapdiff.numpy = numpy
+        self.assertEquals(heapdiff.top_deltas(xrange(100), 3, lambda d: -d), \
+                            [0, 1, 2])
+
+    def test_BlockIndex(self):
+        heap = self._trace._heaps[0x2E60000]
+        # a block overlapping the next one
+        heap[0x1AF00000] = heap[0x18D0A0D0]._replace( \
+                        allocs=[Backtrace.sample(0x400, 0x8, 0x2E9FF00)])
+        blocks = sorted(blockindex.block(s.address, s.address + \
+                        s.requested + s.overhead, handle, traceid) \
+                        for handle, heap in self._trace._heaps.iteritems() \
+                        for traceid, alloc in heap.iteritems() \
+                        for s in alloc.allocs)
+        outer = max(blocks, key=lambda b: b.end)
+        numpy = blockindex.numpy
+        try:
+            for engine in (numpy, None):
+                blockindex.numpy = engine
+                for save in (None, {}, dict(compress=True)):
+                    trace = self._trace
+                    if save is not None:
+                        self._trace.save('test.tmp', index=True, **save)
+                        trace = Backtrace()
+                        trace.load('test.tmp')
+                        self.assertTrue(trace._blockindex is not None)
+                    index = trace.block_index()
+                    self.assertEquals(len(index), len(blocks))
+                    self.assertEquals(index.lookup([b.start for b in \
+                                                    blocks]), blocks)
+                    for b in blocks:
+                        found = index.find(b.end - 1)
+                        self.assertTrue(found.start < b.end <= found.end)
+                    # inside the overlapping block only
+                    self.assertEquals(index.find(0x2EA0300).traceid, \
+                                        0x1AF00000)
+                    self.assertEquals(index.lookup([0, outer.end, \
+                                        blocks[0].start - 1]), [None] * 3)
+                    self.assertEquals(index.overlapping(0, 1 << 62), blocks)
+                    self.assertEquals(index.overlapping(blocks[0].start + 1, \
+                                        blocks[0].start + 2), [blocks[0]])
+                    self.assertEquals(index.overlapping(outer.end, \
+                                        outer.end + 0x100), [])
+        finally:
+            blockindex.numpy = numpy
+        fileobject = StringIO()
+        self._trace.dump_blocks([blocks[0].start + 4, 0], \
+                                fileobject=fileobject)
+        self.assertEquals(fileobject.getvalue().splitlines()[1:], \
+                ['0x%X: [0x%X, 0x%X) +0x4 Heap @ 0x%X Traceid: 0x%x' % \
+                    ((blocks[0].start + 4,) + blocks[0]), '0x0: no block'])
+        # conversions store the index, loading some heaps keeps it
+        for chunksize in (parallel._CHUNKSIZE, 256):
+            parallel.convert('test.log', 'test.tmp', processes=1, \
+                                chunksize=chunksize)
+            trace = Backtrace()
+            trace.load('test.tmp', heaps=[0x1D890000])
+            self.assertEquals(sorted(trace._heaps), [0x1D890000])
+            self.assertTrue(trace._blockindex is not None)
+            # a block of a heap left out
+            other = blocks[0]
+            self.assertEquals(trace.block_index().find(other.start), other)
+            fileobject = StringIO()
+            trace.dump_blocks([other.start], symbols=_Symbols(), \
+                                fileobject=fileobject)
+            self.assertEquals(fileobject.getvalue().count('\t'), \
+                    len(self._trace._heaps[other.handle] \
+                        [other.traceid].stack))
+            trace._snapshot.close()
+
+    def test_CallTree(self):
+        sample = Backtrace.sample
+        trace = Backtrace()
+        # allocation point first: 0x1 and 0x4 both called by 0x2 from 0x3
+        trace._heaps = {
+            0x10: {1: Backtrace.allocation(stack=(0x1, 0x2, 0x3), aliases=[], \
+                        allocs=[sample(0x10, 0x8, 0x100), \
+                                sample(0x10, 0x8, 0x200)]),
+                    2: Backtrace.allocation(stack=(0x4, 0x2, 0x3), \
+                        aliases=[], allocs=[sample(0x20, 0x8, 0x300)])},
+            0x20: {1: Backtrace.allocation(stack=(0x1, 0x2, 0x3), aliases=[], \
+                        allocs=[sample(0x40, 0x0, 0x400)]),
+                    3: Backtrace.allocation(stack=(0x2, 0x3), aliases=[], \
+                        allocs=[sample(0x8, 0x0, 0x500)])}}
+        tree = CallTree(trace)
+        self.assertEquals(len(tree), 3)
+        self.assertEquals((tree.counts[0], tree.bytes[0]), (5, 0xA0))
+        nodes = dict((frame, node) for node, frame in enumerate(tree.frames))
+        self.assertEquals(tree.parents[nodes[0x2]], nodes[0x3])
+        self.assertEquals((tree.bytes[nodes[0x2]], tree.selfbytes[nodes[0x2]], \
+                            tree.selfcounts[nodes[0x2]]), (0xA0, 0x8, 1))
+        self.assertEquals(tree.counts[nodes[0x1]], 3)
+        self.assertEquals(tree.folded(), ['0x3;0x2 8', '0x3;0x2;0x1 112', \
+                                            '0x3;0x2;0x4 40'])
+        self.assertEquals(tree.folded(symbols=_Symbols(), metric='count'), \
+                ['module.dll!sym;module.dll!sym 1', \
+                    'module.dll!sym;module.dll!sym;module.dll!sym 4'])
+        tree = CallTree(trace, bottomup=True, handle=0x10)
+        self.assertEquals(tree.frames[1:], [0x1, 0x2, 0x3, 0x4, 0x2, 0x3])
+        self.assertEquals(tree.bytes[:2], [0x58, 0x30])
+        fileobject = StringIO()
+        tree.dump(fileobject=fileobject)
+        self.assertEquals(fileobject.getvalue().splitlines(), [
+            'Call tree (bottom-up): 3 blocks, 88 bytes',
+            '  0x1 [48 bytes, 2 blocks, self 0 bytes, 0 blocks]',
+            '    0x2 [48 bytes, 2 blocks, self 0 bytes, 0 blocks]',
+            '      0x3 [48 bytes, 2 blocks, self 48 bytes, 2 blocks]',
+            '  0x4 [40 bytes, 1 blocks, self 0 bytes, 0 blocks]',
+            '    0x2 [40 bytes, 1 blocks, self 0 bytes, 0 blocks]',
+            '      0x3 [40 bytes, 1 blocks, self 40 bytes, 1 blocks]'])
+
+    def test_DiffChain(self):
+        sample = Backtrace.sample(0x10, 0x8, 0x2E9FF00)
+        series = [Backtrace('test.log') for i in xrange(3)]
+        heaps = [trace._heaps[0x2E60000] for trace in series]
+        # new, freed and back again, added in two steps
+        freed = heaps[1][0x1AF083B4].allocs.pop()
+        heaps[1][0x1AF00000] = heaps[1][0x18D0A0D0]._replace(allocs=[sample])
+        heaps[2][0x1AF00000] = heaps[2][0x18D0A0D0]._replace(allocs=[sample])
+        heaps[2][0x1AF07D3C].allocs.append(sample)
+        heaps[2][0x1AF083B4].allocs.append(freed)
+        paths = []
+        for i, trace in enumerate(series):
+            paths.append(os.path.join(self._datadir, '%d.bin' % i))
+            trace.save(paths[-1])
+        numpy = diffchain.numpy
+        try:
+            for engine in (numpy, None):
+                diffchain.numpy = engine
+                chain = diffchain.DiffChain(paths)
+                for first, last in ((0, 2), (1, 2), (0, 1)):
+                    expected = series[first].diff_with(series[last])
+                    diff = chain.diff(series[first], series[last], \
+                                        first, last)
+                    self.assertEquals(diff._heaps.keys(), \
+                                        expected._heaps.keys())
+                    for handle, heap in expected._heaps.iteritems():
+                        self.assertEquals(dict((t, sorted(a.allocs)) \
+                            for t, a in diff._heaps[handle].items()), \
+                            dict((t, sorted(a.allocs)) for t, a in \
+                                heap.items()))
+                    # the snapshots at either end looked up only
+                    looked = chain.diff(diffchain.lookup_snapshot( \
+                                paths[first]), diffchain.lookup_snapshot( \
+                                paths[last]), first, last)
+                    self.assertEquals(dict((h, sorted(heap)) for h, heap \
+                            in looked._heaps.iteritems()), \
+                        dict((h, sorted(heap)) for h, heap in \
+                            diff._heaps.iteritems()))
+                self.assertEquals(chain.update(), 0)
+        finally:
+            diffchain.numpy = numpy
+        # steps of a snapshot that has changed are recomputed
+        series[1].save(paths[1], compress=True)
+        self.assertEquals(diffchain.lookup_snapshot(paths[1])._heaps, \
+                dict((h, frozenset(heap)) for h, heap in \
+                    series[1]._heaps.iteritems()))
+        chain = diffchain.DiffChain(paths)
+        self.assertFalse(chain.is_cached(0))
+        self.assertEquals(chain.update(), 2)
+
+    def test_PrefixClusters(self):
+        base = tuple(xrange(1, 9))
+        traces = [(1, base + (9, 10)), (2, base + (20, 21)), \
+                    (3, base + (20, 21, 30, 31, 32, 33)), (4, (50,)), \
+                    (5, []), (6, [])]
+        self.assertEquals(duplicates.prefix_clusters(traces), \
+                            [[5, 6], [1, 2], [3], [4]])
+        self.assertEquals(duplicates.prefix_clusters(traces, threshold=1.0), \
+                            [[5, 6], [1], [2], [3], [4]])
+
+    def test_SimilarClusters(self):
+        base = range(1, 21)
+        # a frame off in the middle, three frames off, the frames reversed
+        near = base[:9] + [100] + base[10:]
+        far = base[:2] + [200] + base[3:9] + [201] + base[10:16] + [202] + \
+                base[17:]
+        traces = [(1, base), (2, near), (3, far), (4, base[::-1]), \
+                    (5, []), (6, []), (7, [300])]
+        for stack1, stack2 in ((base, near), (base, far), (near, far)):
+            self.assertAlmostEquals(duplicates.similarity( \
+                duplicates._tokens(stack1), duplicates._tokens(stack2)), \
+                difflib.SequenceMatcher(None, stack1, stack2).quick_ratio())
+        numpy = duplicates.numpy
+        try:
+            for engine in (numpy, None):
+                duplicates.numpy = engine
+                self.assertEquals(duplicates.similar_clusters(traces), \
+                                    [[1, 2, 4], [3], [5, 6], [7]])
+        finally:
+            duplicates.numpy = numpy
+
+    def test_ClusterCache(self):
+        base = tuple(xrange(1, 21))
+        near = base[:15] + (100,) + base[16:]
+        other = tuple(xrange(500, 520))
+        traces = [(1, base), (2, other)]
+        for clusterfn in (duplicates.similar_clusters, \
+                            duplicates.prefix_clusters):
+            cache = duplicates.ClusterCache(session=1)
+            self.assertEquals(cache.clusters(traces, clusterfn), [[1], [2]])
+            # a new stack joins the cluster of a known one
+            self.assertEquals(cache.clusters([(3, near), (4, base), \
+                                (5, base)], clusterfn), [[3, 4, 5]])
+            self.assertEquals((cache.hits, cache.misses), (2, 3))
+            self.assertEquals(len(cache), 3)
+        cache.save('test.tmp')
+        loaded = duplicates.ClusterCache('test.tmp', session=1)
+        self.assertEquals(loaded.clusters([(6, near), (7, other)], \
+                            duplicates.similar_clusters), [[6], [7]])
+        self.assertEquals((loaded.hits, loaded.misses), (2, 0))
+        self.assertEquals(len(duplicates.ClusterCache('test.tmp', \
+                                                        session=2)), 0)
+        # the diff is compressed as w/o the cache
+        self._trace.compress_duplicates(utils.duplicate_levels.aggressive)
+        expected = self._trace._uniqueallocs
+        for i in xrange(2):
+            self._trace._uniqueallocs = {}
+            self._trace.compress_duplicates( \
+                    utils.duplicate_levels.aggressive, cache)
+            self.assertEquals(self._trace._uniqueallocs, expected)
+        self.assertEquals(cache.misses, 3 + len(self._trace._allocs))
+
+    def test_CompressDuplicates(self):
+        heap = self._trace._heaps[0x2E60000]
+        numsamples = sum(len(a.allocs) for a in heap.itervalues())
+        self._trace.compress_duplicates(utils.duplicate_levels.strict)
+        unique = self._trace._uniqueallocs
+        # the two traces w/o a stack and the one with a single frame
+        self.assertEquals(sorted(unique), sorted(set(heap) - \
+                            set([0x1AF083B4, 0x1BA12BFA])))
+        self.assertEquals(sorted(unique[0x1AF07D3C]), \
+                            sorted(heap[0x1AF083B4].allocs + \
+                                    heap[0x1BA12BFA].allocs))
+        self._trace.save('test.tmp')
+        dummy = Backtrace()
+        dummy.load('test.tmp')
+        heap = dummy._heaps[0x2E60000]
+        self.assertEquals(len(heap), 5)
+        self.assertEquals(sum(len(a.allocs) for a in heap.itervalues()), \
+                            numsamples)
+
+    def test_Trend(self):
+        series = []
+        for i in xrange(3):
+            trace = Backtrace('test.log')
+            allocs = trace._heaps[0x2E60000][0x1AF07D3C].allocs
+            allocs.extend(Backtrace.sample(0x10, 0x8, 0x2E9FF00 + k*0x20) \
+                            for k in xrange(i))
+            # shrinks and vanishes
+            del trace._heaps[0x2E60000][0x1AF083B4].allocs[2-i:]
+            if i == 2:
+                del trace._heaps[0x2E60000][0x1AF083B4]
+            series.append(trace)
+        series[1].save('test.tmp')
+        series[1] = 'test.tmp'
+        numpy = heapdiff.numpy
+        try:
+            for engine in (numpy, None):
+                heapdiff.numpy = engine
+                result = trend.analyze(series)
+                self.assertEquals(len(result), 3)
+                ranked = result.ranked()
+                top = ranked[0]
+                self.assertEquals(top.traceid, 0x1AF07D3C)
+                self.assertEquals(top.counts, [3, 4, 5])
+                self.assertEquals(top.bytes, [0x180, 0x198, 0x1B0])
+                self.assertEquals(top.slope, 0x18)
+                self.assertTrue(top.monotonic and top.persistent)
+                gone = [t for t in ranked if t.traceid == 0x1AF083B4][0]
+                self.assertEquals(gone.counts, [2, 1, 0])
+                self.assertFalse(gone.monotonic or gone.persistent)
+                self.assertEquals(gone.score, 0)
+                steady = [t for t in ranked if t.traceid == 0x18D0A0D0][0]
+                self.assertEquals((steady.slope, steady.monotonic, \
+                                    steady.persistent), (0, False, True))
+        finally:
+            heapdiff.numpy = numpy
+
+    def test_Parallel(self):
+        ranges = parallel.split_log('test.log', chunksize=256)
+        self.assertTrue(len(ranges) > 3)
+        self.assertEquals(ranges[-1][0], 0x1D890000)
+        trace = Backtrace()
+        parallel.parse_into(trace, 'test.log', processes=2, chunksize=256)
+        self._assertSameAllocs(trace)
+        parallel.convert('test.log', 'test.tmp', processes=2, chunksize=256)
+        dummy = Backtrace()
+        dummy.load('test.tmp')
+        self._assertSameAllocs(dummy)
+        self._assertSameAllocs(Backtrace('test.log', processes=2))
+
+    def test_ParallelDiff(self):
+        newer = Backtrace('test.log')
+        heap = newer._heaps[0x2E60000]
+        heap[0x1AF00000] = heap[0x18D0A0D0]._replace( \
+                        allocs=[Backtrace.sample(0x10, 0x8, 0x2E9FF00)])
+        heap[0x1AF00001] = heap[0x18D0A0D0]._replace( \
+                        allocs=[Backtrace.sample(0x30, 0x8, 0x2E9FF80)])
+        heap[0x1AF07D3C].allocs.append(Backtrace.sample(0x20, 0x8, 0x2E9FF40))
+        path = os.path.join(self._datadir, 'newer.bin')
+        self._trace.save('test.tmp')
+        newer.save(path)
+        # an added trace the filter drops is not taken for a grown one
+        for grepfn in (None, lambda (traceid, alloc): traceid is None, \
+                        lambda (traceid, alloc): traceid != 0x1AF00001):
+            expected = self._trace.diff_with(newer, grepfn=grepfn)
+            for rows in (1, 100):
+                diff = parallel.diff('test.tmp', path, processes=2, \
+                                        grepfn=grepfn, rows=rows)
+                self.assertEquals(sorted(diff._heaps.keys()), \
+                                    sorted(expected._heaps.keys()))
+                for handle, heap in expected._heaps.iteritems():
+                    self.assertEquals(dict((t, (list(a.stack), a.allocs)) \
+                        for t, a in diff._heaps[handle].items()), \
+                        dict((t, (list(a.stack), a.allocs)) for t, a in \
+                            heap.items()))
+        newer.save(path, compress=True)
+        self.assertRaises(ValueError, parallel.diff, 'test.tmp', path)
+
+    def test_SymProxy(self):
+        class Symbols(object):
+            def __init__(self):
+                self.lookups = 0
+            def sym_from_addr(self, trace, addr):
+                self.lookups += 1
+                module = trace.map_to_module(addr)
+                return ('sym_%x' % addr, c_ulonglong(addr & 0xF), \
+                        module.ModuleName if module else '<no module>')
+        # two modules with a frame at the same rva
+        first, second = sorted(self._trace._modules.itervalues())[:2]
+        addrs = [first.BaseOfImage + 0x10, second.BaseOfImage + 0x10]
+        with open('test.tmp', 'wb') as f:
+            pickle.dump({0x10: [1, ('stale', c_ulonglong(0), '')]}, f)
+        for i in xrange(2):
+            symbols = Symbols()
+            proxy = utils.SymProxy(symbols, 'test.tmp')
+            for addr in addrs * 2:
+                sym = proxy.sym_from_addr(self._trace, addr)
+                self.assertEquals(sym[0], 'sym_%x' % addr)
+                self.assertEquals(sym[1].value, addr & 0xF)
+            # resolved once, then from the cache file
+            self.assertEquals(symbols.lookups, 2 - 2*i)
+            proxy.save()
+            if not i:
+                # saves of another process are merged
+                other = utils.SymProxy(Symbols(), 'test.tmp')
+                other.sym_from_addr(self._trace, first.BaseOfImage + 0x20)
+                other.close()
+            proxy.close()
+        proxy = utils.SymProxy(Symbols(), 'test.tmp')
+        proxy.sym_from_addr(self._trace, first.BaseOfImage + 0x20)
+        self.assertEquals(proxy._symbols.lookups, 0)
+        proxy.close()
+        # the pickled cache was moved aside
+        self.assertTrue(os.path.exists('test.tmp.old'))
+        for protocol in (1, 2):
+            with open('test.tmp', 'wb') as f:
+                pickle.dump({}, f, protocol)
+            utils.SymProxy(Symbols(), 'test.tmp').close()
+            with open('test.tmp.old', 'rb') as f:
+                self.assertEquals(pickle.load(f), {})
+        # an empty file is a database being created, other files are kept
+        for content in ('', 'not a symbol cache'):
+            with open('test.tmp', 'wb') as f:
+                f.write(content)
+            if content:
+                self.assertRaises(ValueError, utils.SymProxy, Symbols(), \
+                                    'test.tmp')
+                with open('test.tmp', 'rb') as f:
+                    self.assertEquals(f.read(), content)
+            else:
+                utils.SymProxy(Symbols(), 'test.tmp').close()
+
+    def test_SymbolTable(self):
+        class Symbols(object):
+            def __init__(self):
+                self.lookups = []
+            def sym_from_addr(self, trace, addr):
+                self.lookups.append(addr)
+                return ('sym_%x' % (addr >> 8), c_ulonglong(addr & 0xFF), \
+                        'module.dll')
+        frames = set(addr for heap in self._trace._heaps.itervalues() \
+                        for alloc in heap.itervalues() for addr in alloc.stack)
+        symbols = Symbols()
+        table = self._trace.symbolize(symbols)
+        # every frame once, in address order
+        self.assertEquals(symbols.lookups, sorted(frames))
+        self.assertTrue(self._trace.symbolize(symbols) is table)
+        for addr in frames:
+            sym = table.sym_from_addr(self._trace, addr)
+            self.assertEquals((sym[0], sym[1].value, sym[2]), \
+                                ('sym_%x' % (addr >> 8), addr & 0xFF, \
+                                    'module.dll'))
+        # filters resolve the frames of the stacks they filter only
+        trace = Backtrace('test.log')
+        lazy = Symbols()
+        grepfn = filters.grep_filter(trace, lazy, r'!nomatch$')
+        self.assertEquals(lazy.lookups, [])
+        item = trace._heaps[0x2E60000].items()[0]
+        self.assertFalse(grepfn(item))
+        self.assertEquals(sorted(lazy.lookups), sorted(set(item[1].stack)))
+        # filters and dumps read from the table
+        addr = min(frames)
+        grepfn = filters.grep_filter(self._trace, symbols, \
+                                        r'!sym_%x$' % (addr >> 8))
+        self.assertEquals(sorted(traceid for heap in \
+                    self._trace._heaps.itervalues() \
+                    for traceid, alloc in heap.iteritems() \
+                    if grepfn((traceid, alloc))), \
+                sorted(traceid for heap in self._trace._heaps.itervalues() \
+                    for traceid, alloc in heap.iteritems() \
+                    if any(a >> 8 == addr >> 8 for a in alloc.stack)))
+        fileobject = StringIO()
+        self._trace.dump_allocs(symbols=symbols, fileobject=fileobject)
+        self.assertEquals(len(symbols.lookups), len(frames))
+        self.assertEquals(fileobject.getvalue().count('\t'), \
+                            sum(len(alloc.stack) for heap in \
+                                self._trace._heaps.itervalues() \
+                                for alloc in heap.itervalues()))
+        # a table passed on resolves the frames it lacks only
+        trace = Backtrace()
+        trace._modules = self._trace._modules
+        trace._heaps = {0x10: {1: Backtrace.allocation(stack=(addr, 0x7), \
+                aliases=[], allocs=[Backtrace.sample(0x10, 0x8, 0x100)])}}
+        trace.dump_allocs(symbols=table, fileobject=StringIO())
+        self.assertEquals(symbols.lookups[len(frames):], [0x7])
+        self.assertEquals(len(table), len(frames) + 1)
+
+    def test_ModuleIndex(self):
+        modules = self._trace._modules.values()
+        addrs = sorted(set([0, 0x7FFFFFFF] + [m.BaseOfImage + offset \
+                    for m in modules for offset in (-1, 0, 0x10, \
+                        m.SizeOfImage - 1, m.SizeOfImage)]))
+        def scan(addr):
+            for m in modules:
+                if m.BaseOfImage <= addr < m.BaseOfImage + m.SizeOfImage:
+                    return m
+        self.assertEquals(map(self._trace.map_to_module, addrs), \
+                            map(scan, addrs))
+        index = self._trace.module_index()
+        self.assertEquals([index.modules[i] if i >= 0 else None for i in \
+                            heapdiff.column_list(index.module_ids(addrs))], \
+                            map(scan, addrs))
+        # the index follows changes of the module table
+        module = Backtrace.module(BaseOfImage=0x10000, SizeOfImage=0x1000, \
+                                    ModuleName=r'c:\new.dll')
+        self.assertEquals(self._trace.map_to_module(0x10010), None)
+        self._trace._modules['new.dll'] = module
+        self.assertEquals(self._trace.map_to_module(0x10010), module)
+        self.assertEquals(len(self._trace.module_index()), len(modules) + 1)
+
+    def test_SourceStamp(self):
+        stamp = snapshot.source_stamp('test.log')
+        self.assertEquals(stamp[0], os.path.getsize('test.log'))
+        self._trace.save('test.tmp')
+        with open('test.tmp', 'rb') as f:
+            self.assertEquals(snapshot.read_stamp(f), stamp)
+        with open('test.tmp', 'rb') as f:
+            data = f.read()
+        # truncated files are never up-to-date
+        with open('test.tmp', 'wb') as f:
+            f.write(data[:40])
+        with open('test.tmp', 'rb') as f:
+            self.assertEquals(snapshot.read_stamp(f), None)
+        # neither are files w/o a stamp
+        Backtrace().save('test.tmp')
+        with open('test.tmp', 'rb') as f:
+            self.assertEquals(snapshot.read_stamp(f), None)
+
+    def test_AtomicFile(self):
+        with utils.atomic_file('test.tmp') as f:
+            f.write('data')
+        try:
+            with utils.atomic_file('test.tmp') as f:
+                f.write('garbage')
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        with open('test.tmp', 'rb') as f:
+            self.assertEquals(f.read(), 'data')
+        self.assertEquals([fn for fn in os.listdir('.') \
+                            if fn.startswith('test.tmp.')], [])
+
+class IterAllocationsTest(TestCase):
+    def setUp(self):
+        # registries filled in by iter_allocations()
+        self._modules, self._heaps = ({}, [])
+
+    def test_Records(self):
+        records = list(iter_allocations('test.log', self._modules, \
+                                        self._heaps))
+        self.assertEquals(len(self._modules), 17)
+        self.assertEquals(self._heaps, [0x2E60000, 0x1D890000])
+        self.assertEquals(len(records), 11)
+        for handle, traceid, allocation in records:
+            self.assertEquals(handle, 0x2E60000)
+            self.assertEquals(len(allocation.allocs), 1)
+        # stacks are dumped once per trace
+        handle, traceid, allocation = records[3]
+        self.assertEquals(traceid, 0x1AF06BFC)
+        self.assertEquals(allocation.stack, [])
+        self.assertEquals(len(records[1][2].stack), 32)
+
+    def test_Fast(self):
+        records = list(iter_allocations('test.log', self._modules, \
+                                        self._heaps, fast=True))
+        self.assertEquals(records, list(iter_allocations('test.log')))
+        self.assertEquals(len(self._modules), 17)
+        self.assertEquals(self._heaps, [0x2E60000, 0x1D890000])
+        trace = Backtrace('test.log', fast=True)
+        self.assertEquals(trace._heaps, Backtrace('test.log')._heaps)
+
 if __name__ == '__main__':
     main()